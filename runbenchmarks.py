@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+"""Runs benchmarks located in `tests/benchmarks` against a test database.
+
+    python runbenchmarks.py [benchmark_name ...]
+
+"""
+import os, sys, pkgutil, importlib
+
+test_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, test_dir)
+sys.path.insert(0, os.path.join(test_dir, "tests"))
+
+import django
+from django.conf import settings
+from django.test.utils import get_runner, setup_test_environment, \
+    teardown_test_environment
+
+def runbenchmarks(names=None):
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'tests.settings'
+    if hasattr(django, 'setup'):
+        django.setup()
+    import benchmarks
+    if not names:
+        names = [name for _, name, _ in pkgutil.iter_modules(benchmarks.__path__)
+                 if name.startswith('bench_')]
+    setup_test_environment()
+    test_runner = get_runner(settings)(verbosity=0)
+    old_config = test_runner.setup_databases()
+    try:
+        for name in names:
+            module = importlib.import_module('benchmarks.%s' % name)
+            print("%s\n%s" % (name, '=' * len(name)))
+            module.run()
+            print("")
+    finally:
+        test_runner.teardown_databases(old_config)
+        teardown_test_environment()
+
+if __name__ == "__main__":
+    runbenchmarks(sys.argv[1:])
@@ -0,0 +1,91 @@
+import threading
+
+from django.utils.module_loading import import_string
+from six.moves import queue
+
+from smartfields.settings import ASYNC_BACKEND, ASYNC_MAX_WORKERS, ASYNC_QUEUE_SIZE, \
+    ASYNC_QUEUE_FULL, ASYNC_PARALLELISM
+from smartfields.utils import ProcessingError, WorkerPool
+
+__all__ = [
+    'BaseBackend', 'ThreadBackend', 'get_backend', 'get_worker_pool', 'get_helper_pool'
+]
+
+_backend = None
+_worker_pool = None
+_helper_pool = None
+_lock = threading.Lock()
+
+
+def get_backend():
+    """Returns an instance of a backend specified by ``SMARTFIELDS_ASYNC_BACKEND``
+    setting, which is used for asynchronous processing.
+
+    """
+    global _backend
+    if _backend is None:
+        with _lock:
+            if _backend is None:
+                _backend = import_string(ASYNC_BACKEND)()
+    return _backend
+
+
+def get_worker_pool():
+    """Returns a process wide pool of workers used for asynchronous processing."""
+    global _worker_pool
+    if _worker_pool is None:
+        with _lock:
+            if _worker_pool is None:
+                _worker_pool = WorkerPool(ASYNC_MAX_WORKERS, queue_size=ASYNC_QUEUE_SIZE)
+    return _worker_pool
+
+
+def get_helper_pool():
+    """Returns a process wide pool of workers, which help processing independent
+    asynchronous dependencies of a field in parallel, see ``SMARTFIELDS_ASYNC_PARALLELISM``.
+    It is separate from the pool returned by :func:`get_worker_pool`, since its workers
+    wait for the helpers.
+
+    """
+    global _helper_pool
+    if _helper_pool is None:
+        with _lock:
+            if _helper_pool is None:
+                _helper_pool = WorkerPool(ASYNC_MAX_WORKERS*max(ASYNC_PARALLELISM - 1, 1))
+    return _helper_pool
+
+
+class BaseBackend(object):
+    """Backends are responsible for running asynchronous dependencies of a field
+    outside of the request/response cycle, which is done by eventually calling
+    :meth:`FieldManager.process_async<smartfields.managers.FieldManager.process_async>`.
+
+    """
+
+    def dispatch(self, manager, instance):
+        """Called during processing, right after all synchronous dependencies where
+        processed, keep in mind that instance could have not been saved yet.
+
+        """
+        raise NotImplementedError("'dispatch' method should be implemented by a backend.")
+
+    def post_save(self, manager, instance):
+        """Called whenever an instance with asynchronous dependencies was saved."""
+        pass
+
+
+class ThreadBackend(BaseBackend):
+    """Processing is done within the same process by a pool of worker threads."""
+
+    def dispatch(self, manager, instance):
+        """Depending on ``SMARTFIELDS_ASYNC_QUEUE_FULL`` setting it will either wait for
+        a room in the queue or fail right away, whenever there are too many pending
+        tasks.
+
+        """
+        try:
+            get_worker_pool().submit(
+                lambda: manager.process_async(instance), block=ASYNC_QUEUE_FULL != 'reject')
+        except queue.Full:
+            raise ProcessingError(
+                "Too many files are being processed at the moment, try again later.")
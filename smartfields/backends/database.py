@@ -0,0 +1,159 @@
+import datetime, json, time
+
+from django.db import transaction
+from django.db.models import F
+from django.db.models.fields import files
+from django.utils import timezone
+import six
+
+from smartfields.backends import BaseBackend
+from smartfields.models import ProcessingTask
+from smartfields.utils import apps, get_model_name, logger, VALUE_NOT_SET, \
+    stash_value, get_stashed_value, pop_stashed_value
+
+__all__ = [
+    'DatabaseBackend',
+]
+
+
+class DatabaseBackend(BaseBackend):
+    """Stores tasks in a database table, so they can be picked up by
+    ``smartfields_worker`` management command, possibly running on a different
+    node. Since tasks survive restarts of web workers, nothing is lost when a
+    process is recycled. Make sure a cache shared between processes is used, so
+    status of processing is reported properly.
+
+    Previous values stashed during processing are stored together with a task and
+    put back onto an instance by a worker, so just like with other backends, they
+    are cleaned up once processing finishes, or restored if it fails.
+
+    """
+
+    def dispatch(self, manager, instance):
+        # instance is not written to the database yet, so a task is created only once
+        # it is saved, otherwise a worker could pick up the previous row.
+        instance.__dict__.setdefault('_smartfields_pending', []).append(manager)
+
+    def post_save(self, manager, instance):
+        pending = instance.__dict__.get('_smartfields_pending', [])
+        if manager in pending:
+            pending.remove(manager)
+            task = self.get_task(manager, instance)
+            # a task is of no use until saved values are visible to workers
+            transaction.on_commit(task.save, using=instance._state.db)
+
+    def get_task(self, manager, instance):
+        return ProcessingTask(
+            app_label=instance._meta.app_label,
+            model_name=get_model_name(instance),
+            object_pk=str(instance.pk),
+            field_name=manager.field.name,
+            stash=self.dump_stash(manager, instance)
+        )
+
+    def get_stash_owners(self, manager):
+        yield manager.field.name, manager.field
+        for d in manager.dependencies:
+            yield d.stash_key, d if d._dependee is None else d._dependee
+
+    def dump_stash(self, manager, instance):
+        """Moves previous values, stashed on the ``instance`` by the ``manager`` and
+        it's dependencies, into a json string. Files are stored by their names,
+        values that cannot be represented in json are dropped, since there is
+        nothing to cleanup for them anyways.
+
+        """
+        stash = []
+        for key, owner in self.get_stash_owners(manager):
+            value = get_stashed_value(instance, key)
+            if value is VALUE_NOT_SET:
+                continue
+            pop_stashed_value(instance, key)
+            if isinstance(value, files.FieldFile):
+                stash.append([key, {'file': value.name}])
+            elif value is None or isinstance(value, (bool, float) + six.integer_types +
+                                             six.string_types):
+                stash.append([key, {'value': value}])
+        return json.dumps(stash) if stash else ''
+
+    def load_stash(self, manager, instance, stash):
+        """Stashes values previously dumped with :meth:`dump_stash` onto the
+        ``instance``."""
+        stored = dict((key if isinstance(key, six.string_types) else tuple(key), value)
+                      for key, value in json.loads(stash or '[]'))
+        for key, owner in self.get_stash_owners(manager):
+            if key not in stored:
+                continue
+            value = stored[key]
+            if 'file' in value:
+                if not hasattr(owner, 'attr_class'):
+                    continue
+                stash_value(instance, key, owner.attr_class(instance, owner, value['file']))
+            else:
+                stash_value(instance, key, value['value'])
+
+    def requeue_stale(self, timeout):
+        """Puts tasks, that were taken by workers which didn't finish within
+        ``timeout`` seconds (most likely because they were killed), back into the
+        queue.
+
+        """
+        started = timezone.now() - datetime.timedelta(seconds=timeout)
+        return ProcessingTask.objects.filter(
+            state=ProcessingTask.RUNNING, started__lt=started).update(
+                state=ProcessingTask.PENDING)
+
+    def claim(self):
+        """Marks the oldest pending task as running and returns it, ``None`` is
+        returned if queue is empty.
+
+        """
+        while True:
+            task = ProcessingTask.objects.filter(
+                state=ProcessingTask.PENDING).order_by('pk').first()
+            if task is None:
+                return None
+            # other workers could have claimed this task already
+            claimed = ProcessingTask.objects.filter(
+                pk=task.pk, state=ProcessingTask.PENDING).update(
+                    state=ProcessingTask.RUNNING, started=timezone.now(),
+                    attempts=F('attempts') + 1)
+            if claimed:
+                return task
+
+    def run_task(self, task):
+        model = apps.get_model(task.app_label, task.model_name)
+        try:
+            instance = model._default_manager.get(pk=task.object_pk)
+        except model.DoesNotExist:
+            task.delete()
+            return
+        manager = model._smartfields_managers[task.field_name]
+        self.load_stash(manager, instance, task.stash)
+        try:
+            # instance is discarded afterwards, so restored values have to be saved
+            manager.process_async(instance, save_restored=True)
+        except Exception as e:
+            logger.exception("Processing of task %s has failed.", task.pk)
+            ProcessingTask.objects.filter(pk=task.pk).update(
+                state=ProcessingTask.FAILED, error="%s: %s" % (type(e).__name__, e))
+        else:
+            task.delete()
+
+    def work(self, once=False, sleep_time=1, stale_timeout=3600):
+        """Processes tasks from the queue. Will return as soon as queue is empty, if
+        ``once=True``, otherwise keeps on polling for new tasks every
+        ``sleep_time`` seconds.
+
+        """
+        count = 0
+        while True:
+            self.requeue_stale(stale_timeout)
+            task = self.claim()
+            while task is not None:
+                self.run_task(task)
+                count+= 1
+                task = self.claim()
+            if once:
+                return count
+            time.sleep(sleep_time)
@@ -0,0 +1,238 @@
+import os, calendar, hashlib, shutil, threading, time
+from collections import OrderedDict
+
+from django.core.files.base import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from smartfields.settings import FILE_CACHE, FILE_CACHE_STORAGE, FILE_CACHE_LOCATION, \
+    FILE_CACHE_MAX_SIZE, FILE_CACHE_RESCAN_INTERVAL
+from smartfields.utils import NamedTemporaryFile, get_content_hash, get_fingerprint, \
+    logger
+
+__all__ = [
+    'FileCache', 'get_file_cache'
+]
+
+_file_cache = None
+_lock = threading.Lock()
+
+
+def get_file_cache():
+    """Returns a process wide :class:`FileCache`, or ``None`` unless it is enabled with
+    ``SMARTFIELDS_FILE_CACHE`` setting.
+
+    """
+    global _file_cache
+    if not FILE_CACHE:
+        return None
+    if _file_cache is None:
+        with _lock:
+            if _file_cache is None:
+                storage = default_storage
+                if FILE_CACHE_STORAGE is not None:
+                    storage = import_string(FILE_CACHE_STORAGE)()
+                _file_cache = FileCache(
+                    storage=storage, location=FILE_CACHE_LOCATION, max_size=FILE_CACHE_MAX_SIZE,
+                    rescan_interval=FILE_CACHE_RESCAN_INTERVAL)
+    return _file_cache
+
+
+class FileCache(object):
+    """Content addressed cache of files produced by file processors. Keys are
+    generated from a content of the source file, processor and its parameters, so
+    the same file processed in the same way is never processed twice. Total size of
+    cached files is bounded by ``max_size``, least recently used files are evicted
+    first. Index of cached files is kept in memory and updated as files are added, it is
+    also rebuilt from the storage at most every ``rescan_interval`` seconds, so the
+    bound holds for all processes sharing the storage, without listing the storage on
+    every write.
+
+    """
+
+    def __init__(self, storage=None, location=FILE_CACHE_LOCATION,
+                 max_size=FILE_CACHE_MAX_SIZE, rescan_interval=FILE_CACHE_RESCAN_INTERVAL):
+        self.storage = storage or default_storage
+        self.location = location
+        self.max_size = max_size
+        self.rescan_interval = rescan_interval
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index = None
+        self._size = 0
+        self._scanned = None
+        # times files were last used by this process, which other processes know nothing
+        # about, so they are taken into account when the index is rebuilt.
+        self._used = {}
+        self._lock = threading.RLock()
+
+    @property
+    def size(self):
+        """Total size of all cached files in bytes."""
+        with self._lock:
+            self._load_index()
+            return self._size
+
+    def __len__(self):
+        with self._lock:
+            return len(self._load_index())
+
+    def _get_path(self, key, ext):
+        return os.path.join(self.location, "%s%s" % (key, ext))
+
+    def _load_index(self, rescan=False):
+        if self._index is None or rescan:
+            self._scanned = time.time()
+            entries = []
+            try:
+                _, names = self.storage.listdir(self.location)
+            except (OSError, NotImplementedError):
+                names = []
+            for name in names:
+                path = os.path.join(self.location, name)
+                key = os.path.splitext(name)[0]
+                try:
+                    size = self.storage.size(path)
+                except OSError:
+                    # evicted by another process in the meantime
+                    continue
+                try:
+                    used = self._get_timestamp(self.storage.get_modified_time(path))
+                except (OSError, NotImplementedError):
+                    used = None
+                if key in self._used:
+                    used = max(used or 0, self._used[key])
+                entries.append(((used is not None, used), key, path, size))
+            # files with unknown time of use will be evicted first
+            entries.sort(key=lambda entry: entry[0])
+            self._index, self._size = OrderedDict(), 0
+            for _, key, path, size in entries:
+                self._add(key, path, size)
+            for key in list(self._used):
+                if key not in self._index:
+                    del self._used[key]
+        return self._index
+
+    def _get_timestamp(self, dt):
+        if timezone.is_aware(dt):
+            seconds = calendar.timegm(dt.utctimetuple())
+        else:
+            seconds = time.mktime(dt.timetuple())
+        return seconds + dt.microsecond/1000000.0
+
+    def _add(self, key, path, size):
+        self._index[key] = (path, size)
+        self._size+= size
+
+    def _remove(self, key):
+        path, size = self._index.pop(key)
+        self._size-= size
+        return path
+
+    def is_cacheable(self, value, processor):
+        """Only results of file processors, that declare themselves as cacheable, applied
+        to actual files, can be cached."""
+        return getattr(processor, 'cacheable', False) and isinstance(value, File) and \
+            bool(value)
+
+    def get_key(self, value, processor, params):
+        """Generates a key from a content of a ``value``, ``processor`` and it's
+        ``params``."""
+        return hashlib.sha256(":".join([
+            get_content_hash(value), get_fingerprint(processor), get_fingerprint(params)
+        ]).encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        """Returns a temporary copy of a cached file, or ``None`` if there is no such file
+        in the cache. Copy is deleted once it is closed, which happens as soon as it is
+        saved by a dependency, so cached file itself is never left open."""
+        cached_file = None
+        with self._lock:
+            index = self._load_index()
+            if key in index:
+                # mark as most recently used
+                path, size = index[key] = index.pop(key)
+                self._used[key] = time.time()
+                try:
+                    cached_file = self._copy(path)
+                except (IOError, OSError):
+                    self._remove(key)
+            if cached_file is None:
+                self.misses+= 1
+            else:
+                self.hits+= 1
+        return cached_file
+
+    def _copy(self, path):
+        f = self.storage.open(path, 'rb')
+        try:
+            temp_file = NamedTemporaryFile(mode='w+b', suffix=os.path.splitext(path)[1])
+            try:
+                shutil.copyfileobj(f, temp_file)
+            except:
+                temp_file.close()
+                raise
+        finally:
+            f.close()
+        temp_file.seek(0)
+        return temp_file
+
+    def set(self, key, value):
+        """Stores a copy of a file ``value`` in the cache, which is then trimmed down to
+        ``max_size``. File's position is preserved.
+
+        """
+        if not isinstance(value, File):
+            return
+        _, ext = os.path.splitext(value.name or "")
+        path = self._get_path(key, ext)
+        cur_pos = value.tell()
+        value.seek(0)
+        try:
+            size = value.size
+            # content is addressed by the key, so a file stored by another process is
+            # just as good as this one.
+            if not self.storage.exists(path):
+                # wrapping makes sure temporary files will be copied instead of moved
+                saved_path = self.storage.save(path, File(value))
+                if saved_path != path:
+                    # storage renamed it, since another process saved it concurrently
+                    self.storage.delete(saved_path)
+        except (IOError, OSError) as e:
+            logger.warning("Could not cache a file: %s" % e)
+            return
+        finally:
+            value.seek(cur_pos)
+        evicted = []
+        with self._lock:
+            now = time.time()
+            self._used[key] = now
+            # other processes may have added or evicted files since the index was loaded
+            index = self._load_index(
+                rescan=self._scanned is not None and
+                now - self._scanned >= self.rescan_interval)
+            if key in index:
+                # mark as most recently used
+                index[key] = index.pop(key)
+            else:
+                self._add(key, path, size)
+            while self._size > self.max_size and len(self._index) > 1:
+                evicted_key = next(iter(self._index))
+                evicted.append(self._remove(evicted_key))
+                self._used.pop(evicted_key, None)
+                self.evictions+= 1
+        for evicted_path in evicted:
+            self.storage.delete(evicted_path)
+
+    def clear(self):
+        """Removes all files from the cache."""
+        with self._lock:
+            index = self._load_index()
+            paths = [path for path, _ in index.values()]
+            index.clear()
+            self._used.clear()
+            self._size = 0
+        for path in paths:
+            self.storage.delete(path)
@@ -1,8 +1,8 @@
-import os, datetime, inspect
+import os, datetime, hashlib, inspect, threading
 from django.core.files.base import File
 from django.core.files.storage import default_storage
 from django.db.models.fields import files, NOT_PROVIDED
-from django.utils.encoding import force_text, force_str
+from django.utils.encoding import force_bytes, force_text, force_str
 import six
 
 try:  # django>=3.1
@@ -10,22 +10,64 @@ try:  # django>=3.1
 except ImportError:  # django<3.1
     from django.db.models import FieldDoesNotExist
 
+from smartfields.cache import get_file_cache
 from smartfields.fields import FieldFile, FileField
 from smartfields.settings import KEEP_ORPHANS
 from smartfields.processors.base import BaseProcessor
+from smartfields.resources import get_resource_limiter
 from smartfields.utils import VALUE_NOT_SET, deconstructible, apps, AppRegistryNotReady, \
-    get_empty_values
+    get_empty_values, stash_value, get_stashed_value, pop_stashed_value, \
+    get_processing_context, get_fingerprint
 
 __all__ = [
     'Dependency', 'FileDependency'
 ]
 
 
+class DependencyDescriptor(object):
+    """Descriptor for an attribute, which is set by a dependency, but is not a field.
+    In case when the field it depends on was deferred, attribute will be initialized
+    upon first access.
+
+    """
+
+    def __init__(self, dependency):
+        self.dependency = dependency
+
+    def __get__(self, instance, model=None):
+        if instance is None:
+            return self
+        name = self.dependency.name
+        if name not in instance.__dict__:
+            self.dependency.load_deferred(instance)
+        try:
+            return instance.__dict__[name]
+        except KeyError:
+            raise AttributeError("'%s' object has no attribute '%s'" % (
+                type(instance).__name__, name))
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.dependency.name] = value
+
+
+class DependencyFileDescriptor(files.FileDescriptor):
+    """Same as :class:`DependencyDescriptor`, but for file like attributes."""
+
+    def __get__(self, instance, cls=None):
+        if instance is not None and self.field.name not in instance.__dict__:
+            self.field.load_deferred(instance)
+        return super(DependencyFileDescriptor, self).__get__(instance, cls)
+
+
 @deconstructible
 class Dependency(object):
-    _stashed_value = VALUE_NOT_SET
+    _compiled_dependee = VALUE_NOT_SET
+    descriptor_class = DependencyDescriptor
+    cleanup_on_delete = False
     field = None
     model = None
+    # dependencies of the same field, which are processed by a single processor call
+    group = None
 
     @property
     def name(self):
@@ -37,21 +79,33 @@ class Dependency(object):
 
     @property
     def _dependee(self):
+        if self._compiled_dependee is not VALUE_NOT_SET:
+            return self._compiled_dependee
+        return self._get_dependee()
+
+    def _get_dependee(self):
         try:
             return self.model._meta.get_field(self.name)
         except (FieldDoesNotExist, AppRegistryNotReady): pass
 
     @property
-    def has_stashed_value(self):
-        return self._stashed_value is not VALUE_NOT_SET
+    def stash_key(self):
+        return (self.field.name, self.name)
+
+    def has_stashed_value(self, instance):
+        return get_stashed_value(instance, self.stash_key) is not VALUE_NOT_SET
 
     def __init__(self, attname=None, suffix=None, processor=None, pre_processor=None,
-                 async_=False, default=NOT_PROVIDED, processor_params=None, uid=None):
+                 async_=False, default=NOT_PROVIDED, processor_params=None, uid=None,
+                 after=None):
         """
         Every Dependency depends on a field, either itself or another field specified
         by a ``field_name``.
         if field_name is None and attname or suffix are also None, this
         dependency becomes a forward dependency. All ``async_=True`` will run last.
+        ``after`` is a list of attnames or suffixes of other dependencies of the same
+        field, that have to be processed before this one, which is only relevant
+        when asynchronous dependencies are processed in parallel.
 
         """
         assert attname is None or suffix is None, \
@@ -76,6 +130,7 @@ class Dependency(object):
                 self._processor.check_params(**self._processor_params)
         self.async_ = async_
         self._uid = uid
+        self._after = tuple(after or ())
         assert not async_ or self.has_processor(), \
             "Asynchrounous processing doesn't make sense without a processor."
         if not (self.has_pre_processor() or self.has_processor() or self._default):
@@ -88,30 +143,64 @@ class Dependency(object):
                 self._processor == other._processor and
                 self._default == other._default and
                 self._processor_params == other._processor_params and
-                self._uid == other._uid)
+                self._uid == other._uid and
+                self._after == other._after)
+
+    def is_named(self, name):
+        """Checks if ``name`` refers to this dependency."""
+        return name in (self.name, self._attname, self._suffix)
+
+    def is_after(self, other):
+        """Checks if this dependency has to be processed after the ``other`` one."""
+        return any(other.is_named(name) for name in self._after)
+
+    def get_config_fingerprint(self):
+        """Returns a hash of processor's class, its parameters and a version of a library
+        it relies on. Values produced with a different configuration are stale, see
+        ``SMARTFIELDS_DEPENDENCY_FINGERPRINTS`` setting.
+
+        """
+        fingerprint = self.__dict__.get('_config_fingerprint')
+        if fingerprint is None:
+            processor = self._processor
+            version = processor.get_version() \
+                if isinstance(processor, BaseProcessor) else None
+            fingerprint = hashlib.sha256(force_bytes(get_fingerprint(
+                [processor, self._processor_params, version]))).hexdigest()
+            self._config_fingerprint = fingerprint
+        return fingerprint
+
+    def get_group_key(self):
+        """Returns a key, which is the same for dependencies that can be processed
+        together, or ``None`` if this one has to be processed on its own."""
+        if not isinstance(self._processor, BaseProcessor):
+            return None
+        key = self._processor.get_group_key()
+        if key is not None:
+            return (self.async_, key)
 
     def get_stashed_value(self, instance, value):
         if self._dependee is self.field:
-            return self.field.manager.get_stashed_value()
-        if self.has_stashed_value:
-            return self._stashed_value
+            return self.field.manager.get_stashed_value(instance)
+        stashed_value = get_stashed_value(instance, self.stash_key)
+        if stashed_value is not VALUE_NOT_SET:
+            return stashed_value
         return self.get_default(instance, value)
 
     def stash_previous_value(self, instance, value):
-        if self._stashed_value is VALUE_NOT_SET and self._dependee is not self.field:
-            self._stashed_value = value
+        if not self.has_stashed_value(instance) and self._dependee is not self.field:
+            stash_value(instance, self.stash_key, value)
             instance.__dict__[self.name] = None
 
     def restore_stash(self, instance):
-        if self.has_stashed_value:
-            instance.__dict__[self.name] = self._stashed_value
-            self._stashed_value =  VALUE_NOT_SET
+        if self.has_stashed_value(instance):
+            instance.__dict__[self.name] = pop_stashed_value(instance, self.stash_key)
 
     def cleanup(self, instance):
         pass
 
-    def cleanup_stash(self):
-        self._stashed_value = VALUE_NOT_SET
+    def cleanup_stash(self, instance):
+        pop_stashed_value(instance, self.stash_key)
 
     def contribute_to_model(self, model):
         self.model = model
@@ -122,6 +211,19 @@ class Dependency(object):
         #    "Regular Dependency doesn't make sense with non-field type dependee and a " \
         #    "specified processor. Dependee attname: %s " % self.name
 
+    def compile(self):
+        """Resolves a dependee once the model is fully prepared."""
+        self._compiled_dependee = self._get_dependee()
+        if self._compiled_dependee is None and self.name not in self.model.__dict__:
+            setattr(self.model, self.name, self.descriptor_class(self))
+
+    def load_deferred(self, instance):
+        """Loads a value of the field, in case it was deferred, so this dependency can be
+        initialized."""
+        manager = self.field.manager
+        if manager.is_deferred(instance):
+            instance.smartfields_load_deferred([self.field])
+
     def set_field(self, field):
         assert self.field is None, \
             "This %s is already handling a field: %s. Create a new instance." % (
@@ -166,6 +268,12 @@ class Dependency(object):
     def post_init(self, instance, value, *args, **kwargs):
         self.set_default(instance, value)
 
+    def from_db(self, instance, value, *args, **kwargs):
+        # values of fields are loaded from the database as is, but an attribute
+        # that is not a field still needs to be initialized.
+        if self._dependee is None:
+            self.post_init(instance, value, *args, **kwargs)
+
     def pre_save(self, instance, value, *args, **kwargs):
         pass
 
@@ -202,26 +310,81 @@ class Dependency(object):
                 value = self.get_value(instance)
                 field = self._dependee
         if self.has_processor():  
-            if self.async_:
-                self._processor.progress_setter = progress_setter
+            if not self.async_:
+                progress_setter = None
+            elif progress_setter is not None:
                 progress_setter(self._processor, 0)
-            try:
-                if isinstance(self._processor, BaseProcessor):
-                    new_value = self._processor(
-                        value, instance=instance, field=self.field, dependee=self._dependee,
-                        stashed_value=self.get_stashed_value(instance, value),
-                        **self._processor_params
-                    )
-                else:
-                    new_value = self._processor(value)
-            finally:
-                if self.async_:
-                    delattr(self._processor, 'progress_setter')
-            if self.async_:
+            if isinstance(self._processor, BaseProcessor):
+                new_value = self.call_processor(instance, value, progress_setter)
+            else:
+                new_value = self._processor(value)
+            if progress_setter is not None:
                 progress_setter(self._processor, 1)
             if new_value is not VALUE_NOT_SET:
                 self.set_value(instance, new_value)
 
+    def call_processor(self, instance, value, progress_setter=None):
+        """Invokes the processor, unless its output for the same input is available in
+        the file cache."""
+        file_cache = get_file_cache()
+        if file_cache is None or not file_cache.is_cacheable(value, self._processor):
+            return self._call_processor(instance, value, progress_setter)
+        key = file_cache.get_key(value, self._processor, self._processor_params)
+        new_value = file_cache.get(key)
+        if new_value is None:
+            new_value = self._call_processor(instance, value, progress_setter)
+            file_cache.set(key, new_value)
+        return new_value
+
+    def _call_processor(self, instance, value, progress_setter=None):
+        limiter = get_resource_limiter(self._processor.resource)
+        if limiter is None:
+            return self._invoke_processor(instance, value, progress_setter)
+        manager = self.field.manager
+        waited = []
+        def on_wait():
+            waited.append(True)
+            manager.set_status(instance, {
+                'state': 'queued',
+                'task': self._processor.task,
+                'task_name': self._processor.task_name
+            })
+        with limiter.slot(on_wait=on_wait):
+            if waited:
+                if progress_setter is not None:
+                    progress_setter(self._processor, 0)
+                else:
+                    manager.set_status(instance, {'state': 'busy'})
+            return self._invoke_processor(instance, value, progress_setter)
+
+    def _invoke_processor(self, instance, value, progress_setter=None):
+        context = get_processing_context(instance)
+        if self.group is not None and context is not None:
+            return self._invoke_group_processor(context, instance, value, progress_setter)
+        return self._processor.with_progress_setter(progress_setter)(
+            value, instance=instance, field=self.field, dependee=self._dependee,
+            stashed_value=self.get_stashed_value(instance, value),
+            **self._processor_params
+        )
+
+    def _invoke_group_processor(self, context, instance, value, progress_setter=None):
+        # whichever dependency of the group comes first, produces values for all of
+        # them, which are then picked up by the rest of the group.
+        lock = context.setdefault(('group_lock', id(self.group)), threading.Lock())
+        selected = context.get(('selected', id(self.field.manager)))
+        group = [d for d in self.group if selected is None or id(d) in selected]
+        with lock:
+            key = ('group', id(self.group), id(value))
+            outputs = context.get(key)
+            if outputs is None:
+                jobs = [(d._processor, d._processor.get_params(**d._processor_params))
+                        for d in group]
+                processor = self._processor.with_progress_setter(progress_setter)
+                outputs = context[key] = processor.process_many(
+                    value, jobs, instance=instance, field=self.field,
+                    dependee=self._dependee)
+        return next(output for d, output in zip(group, outputs) if d is self)
+
     def pre_process(self, instance, value):
         if self.has_pre_processor():
             if isinstance(self._pre_processor, BaseProcessor):
@@ -240,7 +403,8 @@ class Dependency(object):
 
 @deconstructible
 class FileDependency(Dependency):
-    descriptor_class = files.FileDescriptor
+    descriptor_class = DependencyFileDescriptor
+    cleanup_on_delete = True
 
     @property
     def attr_class(self):
@@ -259,20 +423,19 @@ class FileDependency(Dependency):
                 self.upload_to == other.upload_to and
                 self.keep_orphans == other.keep_orphans)
         
-    def cleanup_stash(self):
-        if self.has_stashed_value and self._stashed_value:
-            if isinstance(self._stashed_value, FieldFile):
-                if self._stashed_value._committed and \
-                   not self._stashed_value.field.keep_orphans:
-                    self._stashed_value.delete(instance_update=False)
-            elif isinstance(self._stashed_value, files.FieldFile) and \
-                 self._stashed_value._committed and not self.keep_orphans:
-                stashed_value = FieldFile(self._stashed_value.instance, 
-                                          self._stashed_value.field,
-                                          self._stashed_value.name)
-                self._stashed_value.close()
-                stashed_value.delete(instance_update=False)
-        super(FileDependency, self).cleanup_stash()
+    def cleanup_stash(self, instance):
+        stashed_value = get_stashed_value(instance, self.stash_key)
+        if stashed_value is not VALUE_NOT_SET and stashed_value:
+            if isinstance(stashed_value, FieldFile):
+                if stashed_value._committed and not stashed_value.field.keep_orphans:
+                    stashed_value.delete(instance_update=False)
+            elif isinstance(stashed_value, files.FieldFile) and \
+                 stashed_value._committed and not self.keep_orphans:
+                field_file = FieldFile(stashed_value.instance, stashed_value.field,
+                                       stashed_value.name)
+                stashed_value.close()
+                field_file.delete(instance_update=False)
+        super(FileDependency, self).cleanup_stash(instance)
 
     def restore_stash(self, instance):
         field_file = self.get_value(instance)
@@ -30,12 +30,13 @@ class SmartfieldsDescriptor(object):
         self.field = field
 
     def __set__(self, instance, value):
-        if self.field.manager is not None:
+        if self.field.manager is not None and \
+           '_smartfields_loading' not in instance.__dict__:
             value = self.field.manager.pre_process(instance, value)
             if self.field.manager.should_process:
                 previous_value = instance.__dict__.get(self.field.name)
                 if previous_value is not VALUE_NOT_SET:
-                    self.field.manager.stash_previous_value(previous_value)
+                    self.field.manager.stash_previous_value(instance, previous_value)
         instance.__dict__[self.field.name] = self.field.to_python(value)
 
     def __get__(self, instance=None, model=None):
@@ -43,7 +44,12 @@ class SmartfieldsDescriptor(object):
             raise AttributeError(
                 "The '%s' attribute can only be accessed from %s instances."
                 % (self.field.name, model.__name__))
-        return instance.__dict__[self.field.name]
+        try:
+            return instance.__dict__[self.field.name]
+        except KeyError:
+            # field was deferred, load it without any processing
+            instance.smartfields_load_deferred([self.field])
+            return instance.__dict__[self.field.name]
 
 
 class Field(fields.Field):
@@ -51,12 +57,22 @@ class Field(fields.Field):
     manager_class = FieldManager
     manager = None
     
-    def __init__(self, verbose_name=None, name=None, dependencies=None, **kwargs):
+    def __init__(self, verbose_name=None, name=None, dependencies=None, fingerprint=False,
+                 **kwargs):
+        # skip processing of a value, which is the same as the previous one, for files
+        # their contents are compared
+        self.fingerprint = fingerprint
         if dependencies is not None:
             self.manager = self.manager_class(self, dependencies)
         self._dependencies = dependencies
         super(Field, self).__init__(verbose_name=verbose_name, name=name, **kwargs)
 
+    def deconstruct(self):
+        name, path, args, kwargs = super(Field, self).deconstruct()
+        if self.fingerprint:
+            kwargs['fingerprint'] = self.fingerprint
+        return name, path, args, kwargs
+
     def contribute_to_class(self, cls, name, **kwargs):
         super(Field, self).contribute_to_class(cls, name, **kwargs)
         if not issubclass(cls, SmartfieldsModelMixin):
@@ -242,14 +258,22 @@ class FieldFile(files.FieldFile):
 
 class FileDescriptor(files.FileDescriptor):
 
+    def __get__(self, instance, cls=None):
+        if instance is not None and self.field.manager is not None and \
+           self.field.name not in instance.__dict__:
+            # field was deferred, load it without any processing
+            instance.smartfields_load_deferred([self.field])
+        return super(FileDescriptor, self).__get__(instance, cls)
+
     def __set__(self, instance, value):
-        if self.field.manager is not None:
+        if self.field.manager is not None and \
+           '_smartfields_loading' not in instance.__dict__:
             value = self.field.manager.pre_process(instance, value)
             previous_value = self.__get__(instance)
             if previous_value is not VALUE_NOT_SET and previous_value._committed and \
                previous_value != value:
                 # make sure form saving doesn't replace current file with itself
-                self.field.manager.stash_previous_value(previous_value)
+                self.field.manager.stash_previous_value(instance, previous_value)
         super(FileDescriptor, self).__set__(instance, value)
 
 
@@ -0,0 +1,292 @@
+import collections
+import itertools
+import json
+import multiprocessing
+import os
+import time
+
+from django.apps import apps
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from smartfields.backends import ThreadBackend, get_backend, get_worker_pool
+from smartfields.models import get_smartfields_managers, get_stale_dependencies
+from smartfields.settings import DEPENDENCY_FINGERPRINTS
+
+
+def reprocess(model_label, field_names, pks, stale_only=False):
+    """Reprocesses fields of instances with primary keys ``pks`` and saves them. With
+    ``stale_only`` only dependencies with outdated fingerprints are reprocessed. Returns
+    the last primary key of the chunk, a number of processed instances and a list of
+    ``(pk, error)`` tuples for the ones that failed.
+
+    """
+    model = apps.get_model(model_label)
+    processed, failed = 0, []
+    last_pk, stale = pks[-1], None
+    if stale_only:
+        stale = get_stale_dependencies(model, pks, field_names)
+        pks = [pk for pk in pks if pk in stale]
+    for instance in model._default_manager.filter(pk__in=pks).order_by('pk'):
+        try:
+            if stale is None:
+                instance.smartfields_process(field_names)
+            else:
+                instance.smartfields_process_stale(stale=stale[instance.pk])
+            instance.save()
+            processed+= 1
+        except Exception as e:
+            failed.append((instance.pk, "%s: %s" % (type(e).__name__, e)))
+    backend = get_backend()
+    if isinstance(backend, ThreadBackend):
+        # asynchronous dependencies are processed within this process, so they
+        # have to be finished before chunk can be considered done.
+        get_worker_pool().join()
+    return last_pk, processed, failed
+
+
+class Checkpoint(object):
+    """Keeps track of the last reprocessed primary key in a json file, so an
+    interrupted run can be resumed where it left off, together with primary keys of
+    instances that failed, so they can be retried later.
+
+    """
+
+    def __init__(self, path, model_label, field_names, stale_only=False):
+        self.path = path
+        self.key = {'model': model_label, 'fields': field_names, 'stale_only': stale_only}
+        self.last_pk = None
+        self.processed = 0
+        self.failed = []
+
+    def load(self):
+        if self.path is None or not os.path.exists(self.path):
+            return False
+        with open(self.path) as f:
+            data = json.load(f)
+        # checkpoints of full runs may lack the flag
+        data.setdefault('stale_only', False)
+        if any(data.get(k) != v for k, v in self.key.items()):
+            raise CommandError(
+                "Checkpoint '%s' was created for a different model or fields." % self.path)
+        self.last_pk = data['last_pk']
+        self.processed = data.get('processed', 0)
+        self.failed = data.get('failed', [])
+        return True
+
+    def save(self, last_pk, processed, failed=()):
+        self.last_pk, self.processed = last_pk, processed
+        # primary keys are kept as strings, since not all of them can be serialized
+        self.failed.extend(str(pk) for pk in failed)
+        if self.path is None:
+            return
+        data = dict(self.key, last_pk=last_pk, processed=processed, failed=self.failed)
+        tmp_path = "%s.tmp" % self.path
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        # rename is atomic, so checkpoint is never left half written
+        os.rename(tmp_path, self.path)
+
+    def remove(self):
+        if self.path is not None and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class Command(BaseCommand):
+    help = "Reprocesses fields of all instances of a model, for instance after " \
+           "dependencies have been changed."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'model', help="Model in a form of 'app_label.ModelName'.")
+        parser.add_argument(
+            'fields', nargs='*',
+            help="Names of fields to reprocess, all fields with dependencies by default.")
+        parser.add_argument(
+            '--chunk-size', type=int, default=100,
+            help="Number of instances fetched from the database at once.")
+        parser.add_argument(
+            '--workers', type=int, default=1,
+            help="Number of processes that reprocess chunks concurrently.")
+        parser.add_argument(
+            '--checkpoint', default=None,
+            help="File where the progress is recorded. Whenever it exists, reprocessing "
+            "is resumed from the last completed chunk, and it is removed once "
+            "everything is done.")
+        parser.add_argument(
+            '--max-rate', type=float, default=None,
+            help="Maximum number of instances reprocessed per second.")
+        parser.add_argument(
+            '--stale-only', action='store_true', default=False,
+            help="Only reprocess dependencies, which produced current values with a "
+            "configuration different from the current one, or which weren't recorded, "
+            "see SMARTFIELDS_DEPENDENCY_FINGERPRINTS setting.")
+        parser.add_argument(
+            '--retry-failed', action='store_true', default=False,
+            help="Reprocess instances, that failed during previous runs and were "
+            "recorded in the --checkpoint, before resuming.")
+        parser.add_argument(
+            '--dry-run', action='store_true', default=False,
+            help="Only report how much work there is to be done.")
+
+    def get_model(self, label):
+        try:
+            return apps.get_model(label)
+        except (LookupError, ValueError) as e:
+            raise CommandError(str(e))
+
+    def get_managers(self, model, field_names):
+        managers = dict((m.field.name, m) for m in get_smartfields_managers(model))
+        if not field_names:
+            return [m for m in managers.values() if m.should_process]
+        unknown = [name for name in field_names if name not in managers]
+        if unknown:
+            raise CommandError("%s has no fields with dependencies named: %s" % (
+                model.__name__, ", ".join(unknown)))
+        return [managers[name] for name in field_names]
+
+    def iter_chunks(self, queryset, last_pk, chunk_size):
+        """Keyset pagination over primary keys, which unlike offsets does not get slower
+        towards the end of a table and is not affected by rows being added or removed.
+
+        """
+        while True:
+            qs = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+            pks = list(qs.values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                return
+            last_pk = pks[-1]
+            yield pks
+
+    def imap(self, pool, chunks, workers):
+        """Distributes chunks among the pool, while yielding results in order. Only a few
+        chunks are queued ahead, so they are fetched as workers become available.
+
+        """
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(pool.apply_async(reprocess, chunk))
+            if len(pending) > workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+
+    def write(self, msg, verbosity=1):
+        if self.verbosity >= verbosity:
+            self.stdout.write(msg)
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        chunk_size, workers = options['chunk_size'], options['workers']
+        if chunk_size < 1 or workers < 1:
+            raise CommandError("--chunk-size and --workers have to be positive numbers.")
+        model = self.get_model(options['model'])
+        managers = self.get_managers(model, options['fields'])
+        model_label = model._meta.label
+        field_names = [m.field.name for m in managers]
+        stale_only = options['stale_only']
+        if stale_only and not DEPENDENCY_FINGERPRINTS:
+            raise CommandError(
+                "--stale-only requires SMARTFIELDS_DEPENDENCY_FINGERPRINTS setting, "
+                "otherwise nothing is recorded and everything would be reprocessed.")
+        checkpoint = Checkpoint(options['checkpoint'], model_label, field_names, stale_only)
+        if options['retry_failed'] and checkpoint.path is None:
+            raise CommandError("--retry-failed requires --checkpoint.")
+        if checkpoint.load():
+            self.write("Resuming after pk=%s, %s instance(s) were already reprocessed." % (
+                checkpoint.last_pk, checkpoint.processed))
+        retry = []
+        if options['retry_failed']:
+            retry = [model._meta.pk.to_python(pk) for pk in checkpoint.failed]
+            checkpoint.failed = []
+            self.write("Retrying %s failed instance(s)." % len(retry))
+        elif checkpoint.failed:
+            self.write("%s failed instance(s) are skipped, use --retry-failed to retry "
+                       "them." % len(checkpoint.failed))
+        queryset = model._default_manager.order_by('pk')
+        remaining = queryset if checkpoint.last_pk is None else \
+                    queryset.filter(pk__gt=checkpoint.last_pk)
+        total = remaining.count() + len(retry)
+        if options['dry_run']:
+            stale = None
+            if stale_only:
+                stale = {}
+                for pks in self.iter_chunks(queryset, checkpoint.last_pk, chunk_size):
+                    stale.update(get_stale_dependencies(model, pks, field_names))
+            self.dry_run(model_label, managers, total, chunk_size, workers, stale=stale)
+            return
+        retry_chunks = [retry[idx:idx + chunk_size]
+                        for idx in range(0, len(retry), chunk_size)]
+        chunks = ((model_label, field_names, pks, stale_only) for pks in itertools.chain(
+            retry_chunks, self.iter_chunks(queryset, checkpoint.last_pk, chunk_size)))
+        pool = None
+        if workers > 1:
+            # connections must not be shared with forked processes, each worker
+            # opens its own.
+            connections.close_all()
+            pool = multiprocessing.Pool(workers)
+            results = self.imap(pool, chunks, workers)
+        else:
+            results = (reprocess(*chunk) for chunk in chunks)
+        processed, failed_total, started = 0, 0, time.time()
+        max_rate = options['max_rate']
+        try:
+            # results come in order, so everything up to the last pk of a chunk is done,
+            # regardless of how chunks were distributed among workers.
+            for idx, (last_pk, chunk_processed, failed) in enumerate(results):
+                if idx < len(retry_chunks):
+                    # retried instances are behind the last pk already
+                    last_pk = checkpoint.last_pk
+                processed+= chunk_processed
+                failed_total+= len(failed)
+                for pk, error in failed:
+                    self.stderr.write("Failed to reprocess pk=%s: %s" % (pk, error))
+                checkpoint.save(last_pk, checkpoint.processed + chunk_processed,
+                                [pk for pk, _ in failed])
+                elapsed = time.time() - started
+                self.write("Reprocessed %s/%s instance(s), %.2f per second." % (
+                    processed, total, processed / elapsed if elapsed else 0), verbosity=2)
+                if max_rate:
+                    delay = processed / max_rate - elapsed
+                    if delay > 0:
+                        time.sleep(delay)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        elapsed = time.time() - started
+        self.write("Reprocessed %s instance(s) of %s in %.2f seconds (%.2f per second), "
+                   "%s failed." % (processed, model_label, elapsed,
+                                   processed / elapsed if elapsed else 0, failed_total))
+        if checkpoint.failed and checkpoint.path is not None:
+            # checkpoint is kept, so failed instances can be retried
+            self.write("Primary keys of %s failed instance(s) are kept in '%s', rerun "
+                       "with --retry-failed to retry them." % (
+                           len(checkpoint.failed), checkpoint.path))
+        else:
+            checkpoint.remove()
+
+    def dry_run(self, model_label, managers, count, chunk_size, workers, stale=None):
+        self.write("%s instance(s) of %s would be %s in %s chunk(s) by %s worker(s)." % (
+            count, model_label, "checked" if stale is not None else "reprocessed",
+            (count + chunk_size - 1) // chunk_size, workers))
+        if stale is not None:
+            self.write("%s instance(s) have stale dependencies." % len(stale))
+        invocations = 0
+        for manager in managers:
+            dependencies = manager.process_dependencies
+            if stale is None:
+                invocations+= count * len(dependencies)
+            else:
+                counts = {}
+                for fields in stale.values():
+                    for d in fields.get(manager.field.name, ()):
+                        counts[id(d)] = counts.get(id(d), 0) + 1
+                dependencies = [d for d in dependencies if id(d) in counts]
+                invocations+= sum(counts.values())
+            self.write("  %s: %s" % (manager.field.name, ", ".join(
+                "%s%s%s" % (getattr(d._processor, '__name__', type(d._processor).__name__),
+                            " (async)" if d.async_ else "",
+                            "" if stale is None else " x%s" % counts[id(d)])
+                for d in dependencies) or "no processors"))
+        self.write("%s processor invocation(s) in total." % invocations)
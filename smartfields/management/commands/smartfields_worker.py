@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from smartfields.backends.database import DatabaseBackend
+
+
+class Command(BaseCommand):
+    help = "Processes asynchronous dependencies queued by DatabaseBackend."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--once', action='store_true', default=False,
+            help="Exit as soon as there are no more pending tasks.")
+        parser.add_argument(
+            '--sleep', type=float, default=1,
+            help="Number of seconds to wait before checking for new tasks.")
+        parser.add_argument(
+            '--stale-timeout', type=int, default=3600,
+            help="Number of seconds after which a running task is considered abandoned "
+            "and is put back into the queue.")
+
+    def handle(self, *args, **options):
+        count = DatabaseBackend().work(
+            once=options['once'], sleep_time=options['sleep'],
+            stale_timeout=options['stale_timeout'])
+        if count is not None and options['verbosity'] > 0:
+            self.stdout.write("Processed %s task(s)." % count)
@@ -1,102 +1,285 @@
-import threading
+import sys, threading, time
 
+import six
 from django.core.cache import cache
+from django.db.models.fields import files
 
-from smartfields.utils import ProcessingError, VALUE_NOT_SET, get_model_name
+from smartfields.backends import get_backend, get_helper_pool
+from smartfields.models import DependencyFingerprint
+from smartfields.settings import ASYNC_PARALLELISM, DEPENDENCY_FINGERPRINTS, \
+    STATUS_UPDATE_INTERVAL
+from smartfields.utils import ProcessingError, VALUE_NOT_SET, get_model_name, \
+    get_topological_order, stash_value, get_stashed_value, pop_stashed_value, \
+    processing_context, get_content_hash
 
 __all__ = [
     'FieldManager',
 ]
 
-class AsyncHandler(threading.Thread):
+class AsyncHandler(object):
+    """Processes asynchronous dependencies of a field. Independent dependencies are
+    processed concurrently, up to ``parallelism`` at a time, while the ones that
+    target the same attribute or were declared with ``after`` are processed in
+    order. Progress of each dependency is written to the cache at most once per
+    ``status_interval`` seconds. Whenever ``instance`` doesn't outlive processing,
+    ``save_restored`` should be set, so previous values, restored after a failure,
+    are saved back.
 
-    def __init__(self, manager, instance):
+    """
+
+    def __init__(self, manager, instance, parallelism=None, status_interval=None,
+                 save_restored=False):
         self.manager, self.instance = manager, instance
-        super(AsyncHandler, self).__init__()
+        self.save_restored = save_restored
+        self.parallelism = parallelism or ASYNC_PARALLELISM
+        self.status_interval = STATUS_UPDATE_INTERVAL \
+            if status_interval is None else status_interval
+        self._progress = {}
+        self._updated = {}
+        self._lock = threading.Lock()
+        self._cond = threading.Condition()
 
     def get_progress_setter(self, multiplier, index):
-        def progress_setter(processor, progress):
-            try:
-                progress = multiplier * (index + progress)
-            except TypeError as e:
-                raise ProcessingError("Problem setting progress: %s" % e)
-            self.manager.set_status(self.instance, {
+        def progress_setter(processor, progress, **info):
+            with self._lock:
+                try:
+                    progress = float(progress)
+                except (TypeError, ValueError) as e:
+                    raise ProcessingError("Problem setting progress: %s" % e)
+                # progress is kept weighted, since a group weighs as much as all of
+                # its dependencies together
+                weighted = multiplier * progress
+                if isinstance(index, tuple):
+                    # progress of a group is shared by all of its dependencies
+                    weighted = max(weighted, self._progress.get(index, 0))
+                self._progress[index] = weighted
+                now = time.time()
+                if 0 < progress < 1 and \
+                   now - self._updated.get(index, 0) < self.status_interval:
+                    return
+                self._updated[index] = now
+                progress = sum(self._progress.values())
+            status = {
                 'task': getattr(processor, 'task', 'processing'),
                 'task_name': getattr(processor, 'task_name', "Processing"),
                 'state': 'in_progress',
                 'progress': progress
-            })
+            }
+            status.update(info)
+            self.manager.set_status(self.instance, status)
         return progress_setter
 
-    def run(self):
-        dependencies = list(filter(lambda d: d.async_, self.manager.dependencies))
+    def _process(self, index, dependency, multiplier):
+        if dependency.group is not None:
+            index, multiplier = ('group', id(dependency.group)), \
+                multiplier*len(dependency.group)
+        self.manager._process(
+            dependency, self.instance,
+            progress_setter=self.get_progress_setter(multiplier, index))
+
+    def _process_ready(self, dependencies, multiplier):
+        # processes dependencies, which are ready to go, until there is none left
+        graph, state = self.manager.async_graph, self._state
+        while True:
+            with self._cond:
+                if state['exc_info'] or not state['ready']:
+                    return
+                idx = state['ready'].pop(0)
+                state['running']+= 1
+            try:
+                self._process(idx, dependencies[idx], multiplier)
+                exc_info = None
+            except BaseException:
+                exc_info = sys.exc_info()
+            with self._cond:
+                state['running']-= 1
+                state['finished'].add(idx)
+                if exc_info is not None and state['exc_info'] is None:
+                    state['exc_info'] = exc_info
+                for pending_idx in [i for i in state['pending']
+                                    if graph[i] <= state['finished']]:
+                    state['pending'].remove(pending_idx)
+                    state['ready'].append(pending_idx)
+                self._cond.notify_all()
+
+    def _help(self, dependencies, multiplier):
+        try:
+            self._process_ready(dependencies, multiplier)
+        finally:
+            with self._cond:
+                self._state['helpers']-= 1
+                self._cond.notify_all()
+
+    def _submit_helpers(self, dependencies, multiplier):
+        # the calling thread is busy with dependencies as well, hence one less helper
+        state = self._state
+        with self._cond:
+            count = min(len(state['ready']), self.parallelism - 1 - state['helpers'])
+            state['helpers']+= max(count, 0)
+        for _ in range(count):
+            get_helper_pool().submit(lambda: self._help(dependencies, multiplier))
+
+    def process(self, dependencies):
+        """Processes ``dependencies`` in topological order. With ``parallelism`` above
+        one, the calling thread is joined by helpers from a process wide pool of
+        workers, so no threads are created per processed field.
+
+        """
+        graph = self.manager.async_graph
         multiplier = 1.0/len(dependencies)
+        if self.parallelism < 2:
+            for idx in get_topological_order(graph):
+                self._process(idx, dependencies[idx], multiplier)
+            return
+        ready = [idx for idx in range(len(dependencies)) if not graph[idx]]
+        state = self._state = {
+            'pending': [idx for idx in range(len(dependencies)) if idx not in ready],
+            'ready': ready, 'running': 0, 'finished': set(), 'helpers': 0,
+            'exc_info': None
+        }
+        while True:
+            self._submit_helpers(dependencies, multiplier)
+            self._process_ready(dependencies, multiplier)
+            with self._cond:
+                while state['running'] and (state['exc_info'] or not state['ready']):
+                    self._cond.wait()
+                if not state['running'] and (state['exc_info'] or not state['ready']):
+                    break
+        if state['exc_info'] is not None:
+            six.reraise(*state['exc_info'])
+
+    def run(self):
         try:
-            for idx, d in enumerate(dependencies):
-                self.manager._process(
-                    d, self.instance,
-                    progress_setter=self.get_progress_setter(multiplier, idx)
-                )
+            with processing_context(self.instance):
+                self.process(self.manager.async_dependencies)
             self.manager.finished_processing(self.instance)
+            self.manager.save_fingerprints(self.instance)
         except BaseException as e:
-            self.manager.failed_processing(self.instance, error=e)
+            self.manager.failed_processing(
+                self.instance, error=e, is_async=self.save_restored)
             if not isinstance(e, ProcessingError):
                 raise
 
 
 class FieldManager(object):
-    _stashed_value = VALUE_NOT_SET
+    async_graph = ()
+    # model field, where a content hash of a file is stored, see `fingerprint`
+    fingerprint_field = None
 
     def __init__(self, field, dependencies):
         self.field = field
         self.dependencies = dependencies
-        self.has_async = False
-        self.should_process = False
         for d in self.dependencies:
             d.set_field(self.field)
-            if not self.has_async:
-                self.has_async = d.async_
-            if not self.should_process:
-                self.should_process = d.should_process()
+        # dependencies are split up once, so they don't need to be filtered on each save
+        self.processor_dependencies = tuple(
+            d for d in self.dependencies if d.has_processor())
+        self.pre_processor_dependencies = tuple(
+            d for d in self.dependencies if d.has_pre_processor())
+        self.process_dependencies = tuple(
+            d for d in self.dependencies if d.should_process())
+        self.sync_dependencies = tuple(
+            d for d in self.process_dependencies if not d.async_)
+        self.async_dependencies = tuple(d for d in self.dependencies if d.async_)
+        # dependencies with values, that are checked for collisions only once saving fails
+        self.optimistic_dependencies = tuple(
+            d for d in self.sync_dependencies if getattr(d._processor, 'optimistic', False))
+        self.has_async = bool(self.async_dependencies)
+        self.should_process = bool(self.process_dependencies)
+        # values of fields that will have something to cleanup after the instance is
+        # deleted, have to be known prior to deletion.
+        self.cleanup_on_delete = isinstance(field, files.FileField) or any(
+            d.cleanup_on_delete for d in self.dependencies)
+
+    def set_groups(self):
+        """Groups dependencies, which can be processed by a single processor call, ex:
+        video renditions that are transcoded in one pass. Dependencies, which are
+        ordered with ``after``, are always processed on their own.
+
+        """
+        groups = {}
+        for d in self.process_dependencies:
+            if d._after or any(other.is_after(d) for other in self.dependencies):
+                continue
+            key = d.get_group_key()
+            if key is not None:
+                # synchronous and asynchronous dependencies are processed separately
+                groups.setdefault((d.async_, key), []).append(d)
+        for group in groups.values():
+            if len(group) > 1:
+                group = tuple(group)
+                for d in group:
+                    d.group = group
+
+    def has_stashed_value(self, instance):
+        return get_stashed_value(instance, self.field.name) is not VALUE_NOT_SET
+
+    def get_stashed_value(self, instance):
+        value = get_stashed_value(instance, self.field.name)
+        if value is VALUE_NOT_SET:
+            return self.field.get_default()
+        return value
+
+    def stash_previous_value(self, instance, value):
+        stash_value(instance, self.field.name, value)
 
-    @property
-    def has_stashed_value(self):
-        return self._stashed_value is not VALUE_NOT_SET
+    def is_deferred(self, instance):
+        """Checks if field's value was deferred, while instance was loaded."""
+        return self.field.attname not in instance.__dict__
 
-    def get_stashed_value(self):
-        if self.has_stashed_value:
-            return self._stashed_value
-        return self.field.get_default()
+    def get_dependees(self):
+        """Returns fields, other than this one, that are set during processing."""
+        dependees = [d._dependee for d in self.process_dependencies
+                     if d._dependee is not None and d._dependee is not self.field]
+        if self.fingerprint_field is not None:
+            dependees.append(self.fingerprint_field)
+        return dependees
 
-    def stash_previous_value(self, value):
-        if not self.has_stashed_value:
-            self._stashed_value = value
+    def get_deferred_dependees(self, instance):
+        """Returns fields, other than this one, that are set during processing, but
+        were deferred, while instance was loaded."""
+        return [field for field in self.get_dependees()
+                if field.attname not in instance.__dict__]
 
     def handle(self, instance, event, *args, **kwargs):
+        if event == 'post_delete' and DEPENDENCY_FINGERPRINTS and \
+           self.processor_dependencies:
+            # regardless of whether the field was loaded
+            DependencyFingerprint.forget(instance, self.field.name,
+                                         instance.__dict__.get('_smartfields_deleted_pk'))
         if event == 'pre_init':
             instance.__dict__[self.field.name] = VALUE_NOT_SET
             field_value = None
+        elif self.is_deferred(instance):
+            # there is nothing to handle for a field that was not loaded, dependencies
+            # will be initialized whenever the value is accessed.
+            return
         else:
             field_value = self.field.value_from_object(instance)
             if event == 'post_init':
                 # mark manager for processing by stashing default value
                 if instance.pk is None and self.field.name in kwargs:
-                    self.stash_previous_value(self.field.get_default())
+                    self.stash_previous_value(instance, self.field.get_default())
             elif event == 'post_delete' and field_value:
                 self.delete_value(field_value)
+            elif event == 'post_save':
+                self.save_fingerprints(instance)
+                if self.has_async:
+                    get_backend().post_save(self, instance)
         for d in self.dependencies:
             d.handle(instance, event, *args, **kwargs)
 
     def failed_processing(self, instance, error=None, is_async=False):
         self.restore_stash(instance)
+        instance.__dict__.get('_smartfields_fingerprints', {}).pop(self.field.name, None)
         if is_async:
             instance.save()
         if error is not None:
             self.set_error_status(instance, "%s: %s" % (type(error).__name__, str(error)))
 
     def finished_processing(self, instance):
-        if self.has_stashed_value:
-            self.cleanup_stash()
+        if self.has_stashed_value(instance):
+            self.cleanup_stash(instance)
         self.set_status(instance, {'state': 'complete'})
 
     def cleanup(self, instance):
@@ -108,60 +291,160 @@ class FieldManager(object):
            and value and not value.field.keep_orphans:
             value.delete(instance_update=False)
 
-    def cleanup_stash(self):
-        self.delete_value(self._stashed_value)
-        self._stashed_value = VALUE_NOT_SET
+    def cleanup_stash(self, instance):
+        self.delete_value(pop_stashed_value(instance, self.field.name))
         for d in self.dependencies:
-            if d.has_stashed_value:
-                d.cleanup_stash()
+            if d.has_stashed_value(instance):
+                d.cleanup_stash(instance)
 
     def restore_stash(self, instance):
-        if self.has_stashed_value:
+        if self.has_stashed_value(instance):
             self.delete_value(self.field.value_from_object(instance))
-            instance.__dict__[self.field.name] = self._stashed_value
-            self._stashed_value = VALUE_NOT_SET
+            instance.__dict__[self.field.name] = pop_stashed_value(instance, self.field.name)
         for d in self.dependencies:
-            if d.has_stashed_value:
+            if d.has_stashed_value(instance):
                 d.restore_stash(instance)
 
     def _process(self, dependency, instance, progress_setter=None):
         # process single dependency
         value = self.field.value_from_object(instance)
         dependency.process(instance, value, progress_setter=progress_setter)
+        if DEPENDENCY_FINGERPRINTS and dependency.has_processor():
+            # recorded once the value is saved
+            instance.__dict__.setdefault('_smartfields_fingerprints', {}).setdefault(
+                self.field.name, {})[dependency.name] = dependency.get_config_fingerprint()
 
-    def process(self, instance, force=False):
+    def process(self, instance, force=False, dependencies=None):
         """Processing is triggered by field's pre_save method. It will be
         executed if field's value has been changed (known through descriptor and
         stashing logic) or if model instance has never been saved before,
         i.e. no pk set, because there is a chance that field was initialized
         through model's `__init__`, hence default value was stashed with
-        pre_init handler.
+        pre_init handler. Processing can be limited to some of the
+        ``dependencies``, although asynchronous ones are always processed together.
 
         """
-        if self.should_process and (force or self.has_stashed_value):
+        if self.should_process and not force and self.has_stashed_value(instance) and \
+           self.field.fingerprint and self.is_unchanged(instance):
+            self.discard_unchanged(instance)
+        elif self.should_process and (force or self.has_stashed_value(instance)):
+            sync_dependencies, has_async = self.sync_dependencies, self.has_async
+            if dependencies is not None:
+                selected = set(id(d) for d in dependencies)
+                sync_dependencies = tuple(d for d in sync_dependencies if id(d) in selected)
+                has_async = any(d.async_ for d in dependencies)
             self.set_status(instance, {'state': 'busy'})
-            for d in filter(lambda d: d.has_processor(), self.dependencies):
-                d.stash_previous_value(instance, d.get_value(instance))
+            for d in self.processor_dependencies:
+                if (has_async and d.async_) or d in sync_dependencies:
+                    d.stash_previous_value(instance, d.get_value(instance))
             try:
-                if self.has_async:
-                    for d in filter(lambda d: not d.async_ and d.should_process(),
-                                    self.dependencies):
-                        self._process(d, instance)
-                    async_handler = AsyncHandler(self, instance)
-                    async_handler.start()
+                with processing_context(instance) as context:
+                    if dependencies is not None:
+                        # groups only produce values for the selected dependencies
+                        context[('selected', id(self))] = selected
+                    try:
+                        for d in sync_dependencies:
+                            self._process(d, instance)
+                    finally:
+                        context.pop(('selected', id(self)), None)
+                if has_async:
+                    self.dispatch_async(instance)
                 else:
-                    for d in filter(lambda d: d.should_process(), self.dependencies):
-                        self._process(d, instance)
                     self.finished_processing(instance)
             except BaseException as e:
                 self.failed_processing(instance, e)
                 if not isinstance(e, ProcessingError):
                     raise
-        elif self.has_stashed_value:
-            self.cleanup_stash()
+        elif self.has_stashed_value(instance):
+            self.cleanup_stash(instance)
+
+    def save_fingerprints(self, instance):
+        """Records fingerprints of dependencies, that were processed since the last time
+        an instance was saved."""
+        fingerprints = instance.__dict__.get('_smartfields_fingerprints', {})
+        if instance.pk is not None and self.field.name in fingerprints:
+            DependencyFingerprint.record(
+                instance, self.field.name, fingerprints.pop(self.field.name))
+
+    def get_file_fingerprint(self, value):
+        """Computes a content hash of a file, which is read in chunks."""
+        if not value:
+            return ""
+        if not value._committed:
+            return get_content_hash(value.file)
+        f = value.storage.open(value.name, 'rb')
+        try:
+            return get_content_hash(f)
+        finally:
+            f.close()
+
+    def is_unchanged(self, instance):
+        """Checks if a new value is the same as the previous one, by comparing contents of
+        files, or values themselves otherwise. A hash of the current file is kept in the
+        ``<name>_fingerprint`` field, whenever the model has one, so the previous file
+        doesn't need to be read. Values of new instances are always processed.
+
+        """
+        value = self.field.value_from_object(instance)
+        previous_value = get_stashed_value(instance, self.field.name)
+        if not isinstance(self.field, files.FileField):
+            return instance.pk is not None and value == previous_value
+        fingerprint = self.get_file_fingerprint(value)
+        previous_fingerprint = None
+        if self.fingerprint_field is not None:
+            previous_fingerprint = self.fingerprint_field.value_from_object(instance)
+            setattr(instance, self.fingerprint_field.attname, fingerprint)
+        if instance.pk is None or not value or not previous_value:
+            return False
+        if not previous_fingerprint:
+            previous_fingerprint = self.get_file_fingerprint(previous_value)
+        if fingerprint != previous_fingerprint:
+            return False
+        if self.fingerprint_field is not None:
+            setattr(instance, self.fingerprint_field.attname, previous_fingerprint)
+        return True
+
+    def discard_unchanged(self, instance):
+        """Puts the previous value back in place of the identical new one, so values set
+        by dependencies, such as renditions of a file, are kept as is.
+
+        """
+        value = self.field.value_from_object(instance)
+        previous_value = pop_stashed_value(instance, self.field.name)
+        if isinstance(self.field, files.FileField) and value != previous_value:
+            # the same file was already written under a different name
+            self.delete_value(value)
+        instance.__dict__[self.field.name] = previous_value
+
+    def resolve_conflict(self, instance):
+        """Regenerates values of optimistic dependencies, after saving an instance failed
+        with an ``IntegrityError``, this time checking them for collisions. Returns
+        ``True`` if any of the values has changed, i.e. saving can be retried.
+
+        """
+        changed = False
+        with processing_context(instance) as context:
+            context['unique_conflict'] = True
+            try:
+                for d in self.optimistic_dependencies:
+                    value = d.get_value(instance)
+                    self._process(d, instance)
+                    changed = changed or d.get_value(instance) != value
+            finally:
+                context.pop('unique_conflict', None)
+        return changed
+
+    def dispatch_async(self, instance):
+        """Hands asynchronous dependencies over to the backend."""
+        self.set_status(instance, {'state': 'queued'})
+        get_backend().dispatch(self, instance)
+
+    def process_async(self, instance, **kwargs):
+        """Processes all asynchronous dependencies, it is invoked by a backend."""
+        AsyncHandler(self, instance, **kwargs).run()
 
     def pre_process(self, instance, value):
-        for d in filter(lambda d: d.has_pre_processor(), self.dependencies):
+        for d in self.pre_processor_dependencies:
             new_value = d.pre_process(instance, value)
             if new_value is not VALUE_NOT_SET:
                 value = new_value
@@ -211,7 +494,47 @@ class FieldManager(object):
             'messages': [error]
         })
 
+    def get_async_graph(self):
+        """Returns a graph of asynchronous dependencies in a form of a list, where each
+        element is a set of indices of dependencies that have to be processed before
+        the dependency with the same index.
+
+        """
+        dependencies = self.async_dependencies
+        graph = []
+        for idx, d in enumerate(dependencies):
+            graph.append(set(
+                prev_idx for prev_idx, prev in enumerate(dependencies)
+                if prev is not d and (d.is_after(prev) or (
+                    prev_idx < idx and prev.name == d.name))))
+        return graph
+
     def contribute_to_model(self, model, name):
         model._smartfields_managers[name] = self
         for d in self.dependencies:
             d.contribute_to_model(model)
+            for after in d._after:
+                assert any(other.is_named(after) for other in self.dependencies), \
+                    "Dependency '%s' is set to be processed after a non-existent " \
+                    "dependency: '%s'" % (d.name, after)
+        self.set_groups()
+        if self.has_async:
+            self.async_graph = self.get_async_graph()
+            # make sure there are no cycles
+            get_topological_order(self.async_graph)
+
+    def compile(self):
+        """Invoked once the model is fully prepared, so dependees can be resolved."""
+        for d in self.dependencies:
+            # conflicts are only resolved by regenerating values of synchronous
+            # processors, anywhere else unchecked values would end up in the database.
+            assert not getattr(d._pre_processor, 'optimistic', False) and \
+                not (d.async_ and getattr(d._processor, 'optimistic', False)), \
+                "'optimistic' is only supported by a processor of a synchronous " \
+                "dependency of field: %s" % self.field.name
+            d.compile()
+        if self.field.fingerprint and isinstance(self.field, files.FileField):
+            name = "%s_fingerprint" % self.field.name
+            for field in self.field.model._meta.fields:
+                if field.name == name:
+                    self.fingerprint_field = field
@@ -0,0 +1,30 @@
+# Generated by Django 3.1 on 2026-10-18 04:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('smartfields', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DependencyFingerprint',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('app_label', models.CharField(max_length=100)),
+                ('model_name', models.CharField(max_length=100)),
+                ('object_pk', models.CharField(max_length=255)),
+                ('field_name', models.CharField(max_length=255)),
+                ('dependency', models.CharField(max_length=255)),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='dependencyfingerprint',
+            index=models.Index(fields=['app_label', 'model_name', 'field_name', 'object_pk'], name='smartfields_fingerprint_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.1 on 2026-10-18 04:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('smartfields', '0002_dependencyfingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='processingtask',
+            name='stash',
+            field=models.TextField(blank=True),
+        ),
+    ]
@@ -1,49 +1,227 @@
+import threading, warnings
+
+from django.db import models, router, transaction, IntegrityError
+from django.db.models.signals import class_prepared
+
+from smartfields.settings import DEPENDENCY_FINGERPRINTS, UNIQUE_MAX_RETRIES
+from smartfields.utils import get_model_name
+
+_loading = threading.local()
+
+
+def get_smartfields_managers(model):
+    managers = []
+    for field in model._meta.fields:
+        if field.name in model._smartfields_managers:
+            managers.append(model._smartfields_managers[field.name])
+    return tuple(managers)
+
+
+def get_stale_dependencies(model, pks, field_names=None):
+    """Finds dependencies of instances with primary keys ``pks``, which produced their
+    current values with a configuration different from the one in the model definition,
+    or which were not recorded at all. Returns a dictionary that maps primary keys of
+    such instances to dictionaries of field names and lists of stale dependencies.
+
+    """
+    if not DEPENDENCY_FINGERPRINTS:
+        warnings.warn("SMARTFIELDS_DEPENDENCY_FINGERPRINTS setting is off, so nothing "
+                      "is recorded and all dependencies are considered stale.",
+                      RuntimeWarning, stacklevel=2)
+    managers = [manager for manager in get_smartfields_managers(model)
+                if field_names is None or manager.field.name in field_names]
+    keys = dict((str(pk), pk) for pk in pks)
+    recorded = {}
+    records = DependencyFingerprint.objects.filter(
+        app_label=model._meta.app_label, model_name=get_model_name(model),
+        field_name__in=[manager.field.name for manager in managers],
+        object_pk__in=list(keys)).values_list(
+            'object_pk', 'field_name', 'dependency', 'fingerprint')
+    for object_pk, field_name, dependency, fingerprint in records:
+        recorded[(object_pk, field_name, dependency)] = fingerprint
+    stale = {}
+    for key, pk in keys.items():
+        for manager in managers:
+            dependencies = [
+                d for d in manager.processor_dependencies
+                if recorded.get((key, manager.field.name, d.name)) != d.get_config_fingerprint()]
+            if dependencies:
+                stale.setdefault(pk, {})[manager.field.name] = dependencies
+    return stale
+
+
+def prepare_smartfields(sender, **kwargs):
+    """Compiles smartfields of a model, once it is fully prepared, so nothing needs to
+    be looked up during instance initialization and saving.
+
+    """
+    if not issubclass(sender, SmartfieldsModelMixin):
+        return
+    for field in sender._meta.fields:
+        manager = getattr(field, 'manager', None)
+        if manager is not None and field.model is sender:
+            manager.compile()
+    sender._smartfields_managers_list = get_smartfields_managers(sender)
+
+class_prepared.connect(prepare_smartfields)
+
 
 class SmartfieldsModelMixin(object):
 
     @property
     def smartfields_managers(self):
-        if hasattr(self, '_smartfields_managers_list'):
-            return getattr(self, '_smartfields_managers_list')
-        managers = []
-        for field in self._meta.fields:
-            if field.name in self._smartfields_managers:
-                managers.append(self._smartfields_managers[field.name])
-        self._smartfields_managers_list = managers
-        return self._smartfields_managers_list
+        managers = self.__class__.__dict__.get('_smartfields_managers_list')
+        if managers is None:
+            managers = get_smartfields_managers(self.__class__)
+        return managers
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        _loading.from_db = True
+        try:
+            return super(SmartfieldsModelMixin, cls).from_db(db, field_names, values)
+        finally:
+            _loading.from_db = False
 
     def __init__(self, *args, **kwargs):
+        if getattr(_loading, 'from_db', False):
+            # Instance is being loaded from the database, values were already
+            # processed before they were saved, so there is no need to process them
+            # again. Reset the flag right away, so any nested initialization is not
+            # affected.
+            _loading.from_db = False
+            self.__dict__['_smartfields_loading'] = True
+            super(SmartfieldsModelMixin, self).__init__(*args, **kwargs)
+            del self.__dict__['_smartfields_loading']
+            self.smartfields_handle('from_db')
+            return
         self.smartfields_handle('pre_init', *args, **kwargs)
         super(SmartfieldsModelMixin, self).__init__(*args, **kwargs)
         self.smartfields_handle('post_init', *args, **kwargs)
 
     def save(self, *args, **kwargs):
+        managers = self.smartfields_managers
+        deferred = []
+        if kwargs.get('update_fields') is not None:
+            managers, update_fields = self.smartfields_get_update_managers(
+                kwargs['update_fields'])
+            deferred.extend(self._meta.get_field(name) for name in update_fields
+                            if name not in kwargs['update_fields'])
+            kwargs['update_fields'] = update_fields
+        for manager in managers:
+            if manager.should_process and manager.has_stashed_value(self):
+                deferred.extend(field for field in manager.get_deferred_dependees(self)
+                                if field not in deferred)
+        deferred = [field for field in deferred if field.attname not in self.__dict__]
+        if deferred:
+            # fields that will be set during processing have to be loaded, otherwise
+            # they will not be saved
+            self.smartfields_load_deferred(deferred)
         fresh_keys = None
         if self.pk is None:
             fresh_keys = []
-            for manager in self.smartfields_managers:
-                if manager.should_process and manager.has_stashed_value:
+            for manager in managers:
+                if manager.should_process and manager.has_stashed_value(self):
                     fresh_keys.append((manager.get_status_key(self), manager))
-        self.smartfields_handle('pre_save', *args, **kwargs)
-        super(SmartfieldsModelMixin, self).save(*args, **kwargs)
+        for manager in managers:
+            manager.handle(self, 'pre_save', *args, **kwargs)
+        optimistic = [manager for manager in managers if manager.optimistic_dependencies]
+        if optimistic:
+            self.smartfields_save_optimistic(optimistic, *args, **kwargs)
+        else:
+            super(SmartfieldsModelMixin, self).save(*args, **kwargs)
         if fresh_keys is not None:
             for key, manager in fresh_keys:
                 cur_status = manager._get_status(self, status_key=key)[1]
                 if cur_status is not None:
                     manager.set_status(self, cur_status)
-        self.smartfields_handle('post_save', *args, **kwargs)
+        for manager in managers:
+            manager.handle(self, 'post_save', *args, **kwargs)
     save.alters_data = True
 
+    def smartfields_get_update_managers(self, update_fields):
+        """Returns managers, which are affected by saving only ``update_fields``, together
+        with a list of fields to update, that is extended with fields, which will be set
+        while processing them, including the ones set by their own dependencies.
+
+        """
+        opts = self._meta
+        managers = self._smartfields_managers
+        names = [opts.get_field(name).name for name in update_fields]
+        update_fields = list(update_fields)
+        pending = [(managers[name], False) for name in names if name in managers]
+        while pending:
+            manager, is_dependee = pending.pop(0)
+            # a value, that hasn't been changed, will not be processed, unlike the one,
+            # which could be set by processing of another field
+            if not manager.should_process or \
+               not (is_dependee or manager.has_stashed_value(self)):
+                continue
+            for field in manager.get_dependees():
+                if field.concrete and field.name not in names:
+                    names.append(field.name)
+                    update_fields.append(field.name)
+                    if field.name in managers:
+                        pending.append((managers[field.name], True))
+        return tuple(manager for manager in self.smartfields_managers
+                     if manager.field.name in names or
+                     any(field.name in names for field in manager.get_dependees())
+                     ), update_fields
+
+    def smartfields_save_optimistic(self, managers, *args, **kwargs):
+        """Saves an instance within a savepoint, so values of optimistic dependencies can
+        be regenerated and saving retried, whenever it fails with an ``IntegrityError``.
+
+        """
+        using = kwargs.get('using') or router.db_for_write(self.__class__, instance=self)
+        retries = 0
+        while True:
+            try:
+                with transaction.atomic(using=using):
+                    return super(SmartfieldsModelMixin, self).save(*args, **kwargs)
+            except IntegrityError:
+                retries+= 1
+                # error could be due to something else, retrying wouldn't help then
+                if retries > UNIQUE_MAX_RETRIES or \
+                   not any([manager.resolve_conflict(self) for manager in managers]):
+                    raise
+
     def delete(self, *args, **kwargs):
+        deferred = [manager.field for manager in self.smartfields_managers
+                    if manager.cleanup_on_delete and manager.is_deferred(self)]
+        if deferred:
+            # values are needed for cleanup, which happens after the row is gone
+            self.smartfields_load_deferred(deferred)
         self.smartfields_handle('pre_delete', *args, **kwargs)
+        pk = self.pk
         super(SmartfieldsModelMixin, self).delete(*args, **kwargs)
-        self.smartfields_handle('post_delete', *args, **kwargs)
+        # primary key is reset by now, but records kept for the instance need it
+        self.__dict__['_smartfields_deleted_pk'] = pk
+        try:
+            self.smartfields_handle('post_delete', *args, **kwargs)
+        finally:
+            del self.__dict__['_smartfields_deleted_pk']
     delete.alters_data = True
 
     def smartfields_handle(self, event, *args, **kwargs):
         for manager in self.smartfields_managers:
             manager.handle(self, event, *args, **kwargs)
 
+    def smartfields_load_deferred(self, fields):
+        """Loads deferred values of ``fields`` with a single query, without triggering
+        any processing, and initializes their dependencies.
+
+        """
+        self.__dict__['_smartfields_loading'] = True
+        try:
+            self.refresh_from_db(fields=[field.attname for field in fields])
+        finally:
+            del self.__dict__['_smartfields_loading']
+        for field in fields:
+            manager = getattr(field, 'manager', None)
+            if manager is not None:
+                manager.handle(self, 'from_db')
+
     def smartfields_process(self, field_names=None):
         if field_names is None:
             for manager in self.smartfields_managers:
@@ -53,9 +231,110 @@ class SmartfieldsModelMixin(object):
                 self._smartfields_managers[field_name].process(self, force=True)
     smartfields_process.alters_data = True
 
+    def smartfields_get_stale(self, field_names=None):
+        """Returns a dictionary of field names and lists of their dependencies, which
+        produced current values with an outdated configuration."""
+        return get_stale_dependencies(self.__class__, [self.pk], field_names).get(self.pk, {})
+
+    def smartfields_process_stale(self, field_names=None, stale=None):
+        """Reprocesses dependencies returned by :meth:`smartfields_get_stale`, unless
+        ``stale`` ones are already known. Instance still has to be saved afterwards."""
+        if stale is None:
+            stale = self.smartfields_get_stale(field_names)
+        for field_name, dependencies in stale.items():
+            self._smartfields_managers[field_name].process(
+                self, force=True, dependencies=dependencies)
+        return stale
+    smartfields_process_stale.alters_data = True
+
     def smartfields_get_field_status(self, field_name):
         """A way to find out a status of a filed."""
         manager = self._smartfields_managers.get(field_name, None)
         if manager is not None:
             return manager.get_status(self)
-        return {'state': 'ready'}
\ No newline at end of file
+        return {'state': 'ready'}
+
+
+class ProcessingTask(models.Model):
+    """A queued up asynchronous processing of a field, used by
+    :class:`~smartfields.backends.database.DatabaseBackend`."""
+    PENDING = 'pending'
+    RUNNING = 'running'
+    FAILED = 'failed'
+    STATES = (
+        (PENDING, "Pending"),
+        (RUNNING, "Running"),
+        (FAILED, "Failed"),
+    )
+
+    app_label = models.CharField(max_length=100)
+    model_name = models.CharField(max_length=100)
+    object_pk = models.CharField(max_length=255)
+    field_name = models.CharField(max_length=255)
+    state = models.CharField(max_length=16, choices=STATES, default=PENDING, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    created = models.DateTimeField(auto_now_add=True)
+    started = models.DateTimeField(null=True, blank=True)
+    error = models.TextField(blank=True)
+    # previous values, that are cleaned up or restored once processing is done
+    stash = models.TextField(blank=True)
+
+    class Meta:
+        app_label = 'smartfields'
+
+    def __str__(self):
+        return "%s.%s-%s-%s" % (
+            self.app_label, self.model_name, self.object_pk, self.field_name)
+
+
+class DependencyFingerprint(models.Model):
+    """A fingerprint of a configuration of a dependency, see
+    :meth:`~smartfields.dependencies.Dependency.get_config_fingerprint`, that produced
+    the current value for an instance. Recorded whenever
+    ``SMARTFIELDS_DEPENDENCY_FINGERPRINTS`` setting is on."""
+    app_label = models.CharField(max_length=100)
+    model_name = models.CharField(max_length=100)
+    object_pk = models.CharField(max_length=255)
+    field_name = models.CharField(max_length=255)
+    dependency = models.CharField(max_length=255)
+    fingerprint = models.CharField(max_length=64)
+    updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        app_label = 'smartfields'
+        indexes = [
+            models.Index(fields=['app_label', 'model_name', 'field_name', 'object_pk'],
+                         name='smartfields_fingerprint_idx'),
+        ]
+
+    def __str__(self):
+        return "%s.%s-%s-%s.%s" % (
+            self.app_label, self.model_name, self.object_pk, self.field_name,
+            self.dependency)
+
+    @classmethod
+    def get_lookup(cls, instance, field_name, pk=None):
+        return {
+            'app_label': instance._meta.app_label,
+            'model_name': get_model_name(instance),
+            'object_pk': str(instance.pk if pk is None else pk),
+            'field_name': field_name,
+        }
+
+    @classmethod
+    def record(cls, instance, field_name, fingerprints):
+        """Replaces fingerprints of dependencies of a field, ``fingerprints`` is a
+        dictionary of their names and fingerprints."""
+        lookup = cls.get_lookup(instance, field_name)
+        with transaction.atomic(using=router.db_for_write(cls)):
+            cls.objects.filter(dependency__in=list(fingerprints), **lookup).delete()
+            cls.objects.bulk_create([
+                cls(dependency=dependency, fingerprint=fingerprint, **lookup)
+                for dependency, fingerprint in fingerprints.items()])
+
+    @classmethod
+    def forget(cls, instance, field_name, pk):
+        """Removes fingerprints of all dependencies of a field, once an instance with
+        primary key ``pk`` is deleted, so they are not picked up by another one with the
+        same primary key."""
+        cls.objects.filter(**cls.get_lookup(instance, field_name, pk=pk)).delete()
@@ -1,5 +1,9 @@
-import subprocess, time
+import os, io, codecs, copy, locale, subprocess, time
 from six.moves import queue
+try:
+    import selectors
+except ImportError:  # python<3.4
+    selectors = None
 
 from smartfields.utils import NamedTemporaryFile, AsynchronousFileReader, \
     ProcessingError, deconstructible, get_model_name
@@ -12,6 +16,11 @@ __all__ = [
 class BaseProcessor(object):
     task = 'processing'
     task_name = 'Processing'
+    # whether results of processing can be stored in the file cache
+    cacheable = False
+    # name of a resource limited by `SMARTFIELDS_RESOURCE_LIMITS` setting, which
+    # processor holds a slot of while processing
+    resource = None
 
     def __init__(self, **kwargs):
         self.default_params = kwargs
@@ -34,17 +43,41 @@ class BaseProcessor(object):
         params.update(kwargs)
         return params
 
-    def set_progress(self, progress):
-        # see if dependency has set a progress setter, if so use it.
+    def get_group_key(self):
+        """Processors of dependencies of the same field returning the same key, other
+        than ``None``, are invoked once for all of them through ``process_many``."""
+        return None
+
+    def get_version(self):
+        """Version of a library or a program doing the actual processing. It is a part
+        of a dependency fingerprint, so values produced by a different version are
+        considered stale."""
+        return None
+
+    def with_progress_setter(self, progress_setter):
+        """Returns a copy of the processor, which reports its progress through
+        ``progress_setter``. Processors are shared by all instances of a model, so they
+        are never modified themselves, which would mix up progress of instances
+        processed concurrently."""
+        if progress_setter is None:
+            return self
+        processor = copy.copy(self)
+        processor.progress_setter = progress_setter
+        return processor
+
+    def set_progress(self, progress, **info):
+        # see if dependency has supplied a progress setter, if so use it. Any extra
+        # `info` will be reported together with the progress.
         progress_setter = getattr(self, 'progress_setter', None)
         if callable(progress_setter):
-            progress_setter(self, progress)
+            progress_setter(self, progress, **info)
 
     def process(self, value, **kwargs):
         return value
 
 
 class BaseFileProcessor(BaseProcessor):
+    cacheable = True
 
     def get_ext(self, format=None, **kwargs):
         """Returns new file extension based on a processor's `format` parameter.
@@ -58,6 +91,7 @@ class BaseFileProcessor(BaseProcessor):
 
 
 class RenameFileProcessor(BaseFileProcessor):
+    cacheable = False
 
     def process(self, value, stashed_value=None, **kwargs):
         field_file = stashed_value
@@ -69,6 +103,7 @@ class RenameFileProcessor(BaseFileProcessor):
 
 class ExternalFileProcessor(BaseFileProcessor):
 
+    resource = 'external'
     cmd_template = None
     # if it is a callable it will be invoked for each line from stdout
     stdout_handler = None
@@ -100,21 +135,72 @@ class ExternalFileProcessor(BaseFileProcessor):
         return NamedTemporaryFile(mode='rb', suffix='_%s_%s%s' % (
             get_model_name(instance), field.name, self.get_ext()), delete=False)
 
-    def process(self, in_file, **kwargs):
-        out_file = self.get_output_file(in_file, **kwargs)
-        cmd = self.cmd_template.format(
+    def get_command(self, in_file, out_file, **kwargs):
+        return self.cmd_template.format(
             input=self.get_input_path(in_file), output=self.get_output_path(out_file),
             **kwargs
         ).split()
-        stdout_pipe, stdout_queue, stdout_reader = None, None, None
-        stderr_pipe, stderr_queue, stderr_reader = None, None, None
+
+    def process(self, in_file, **kwargs):
+        out_file = self.get_output_file(in_file, **kwargs)
+        self.execute(self.get_command(in_file, out_file, **kwargs))
+        return out_file
+
+    def execute(self, cmd, stdout_args=()):
+        """Runs the command, while feeding its output line by line to handlers. Output
+        is read as soon as it is available, without polling or extra threads, with
+        an exception of platforms that can't select on pipes. ``stdout_args`` are
+        passed to the stdout handler together with the first line.
+
+        """
+        stdout_pipe, stderr_pipe = None, None
         if callable(self.stdout_handler):
             stdout_pipe = subprocess.PIPE
-            stdout_queue = queue.Queue()
         if self.stderr_handler is True:
             stderr_pipe = subprocess.STDOUT
         elif callable(self.stderr_handler):
             stderr_pipe = subprocess.PIPE
+        if selectors is None or os.name == 'nt':
+            return self._execute_threaded(cmd, stdout_pipe, stderr_pipe, stdout_args)
+        proc = subprocess.Popen(cmd, stdout=stdout_pipe, stderr=stderr_pipe)
+        readers = []
+        if stdout_pipe is not None:
+            readers.append((proc.stdout, LineReader(self.stdout_handler, stdout_args)))
+        if stderr_pipe is subprocess.PIPE:
+            readers.append((proc.stderr, LineReader(self.stderr_handler)))
+        if not readers:
+            proc.wait()
+        else:
+            selector = selectors.DefaultSelector()
+            try:
+                for pipe, reader in readers:
+                    selector.register(pipe, selectors.EVENT_READ, reader)
+                while selector.get_map():
+                    for key, _ in selector.select():
+                        data = os.read(key.fd, 32768)
+                        if not data:
+                            selector.unregister(key.fileobj)
+                        key.data.feed(data)
+            except ProcessingError:
+                if proc.poll() is None:
+                    proc.terminate()
+                raise
+            finally:
+                selector.close()
+                # wait for process to finish, so we can check the return value
+                if proc.poll() is None:
+                    proc.wait()
+                for pipe, _ in readers:
+                    pipe.close()
+        if proc.returncode < 0:
+            raise ProcessingError("There was a problem processing this file.")
+
+    def _execute_threaded(self, cmd, stdout_pipe, stderr_pipe, stdout_args=()):
+        stdout_queue, stdout_reader = None, None
+        stderr_queue, stderr_reader = None, None
+        if stdout_pipe is not None:
+            stdout_queue = queue.Queue()
+        if stderr_pipe is subprocess.PIPE:
             stderr_queue = queue.Queue()
         proc = subprocess.Popen(
             cmd, stdout=stdout_pipe, stderr=stderr_pipe, universal_newlines=True)
@@ -127,7 +213,7 @@ class ExternalFileProcessor(BaseFileProcessor):
         if stdout_reader is None and stderr_reader is None:
             proc.wait()
         else:
-            stdout_args, stderr_args = () , ()
+            stderr_args = ()
             try:
                 while not (stdout_reader is None or stdout_reader.eof()) or \
                       not (stderr_reader is None or stderr_reader.eof()):
@@ -156,6 +242,34 @@ class ExternalFileProcessor(BaseFileProcessor):
                     proc.stderr.close()
         if proc.returncode < 0:
             raise ProcessingError("There was a problem processing this file.")
-        return out_file
+
+
+class LineReader(object):
+    """Decodes output of a process as it arrives and passes it to a ``handler`` line
+    by line, in the same way it would be read by ``readline`` in universal newlines
+    mode. Whatever is returned by the handler will be passed to it together with the
+    next line.
+
+    """
+
+    def __init__(self, handler, args=()):
+        self.handler = handler
+        self.args = args
+        self.buffer = ''
+        self.decoder = io.IncrementalNewlineDecoder(codecs.getincrementaldecoder(
+            locale.getpreferredencoding(False))(errors='replace'), translate=True)
+
+    def feed(self, data):
+        """Feeds a chunk of output, empty one signifies the end of it."""
+        self.buffer+= self.decoder.decode(data, final=not data)
+        lines = self.buffer.split('\n')
+        self.buffer = lines.pop()
+        if not data and self.buffer:
+            lines.append(self.buffer)
+            self.buffer = ''
+        else:
+            lines = [line + '\n' for line in lines]
+        for line in lines:
+            self.args = self.handler(line, *self.args) or ()
 
 
@@ -1,11 +1,12 @@
-import warnings
+import os, threading, warnings
 from django.conf import settings
-from django.core.files.base import ContentFile
+from django.core.files.base import ContentFile, File
+from django.db.models.fields import files
 import six
 
 from smartfields.fields import ImageFieldFile
 from smartfields.processors.base import BaseFileProcessor
-from smartfields.utils import ProcessingError
+from smartfields.utils import ProcessingError, StreamFile, get_processing_context
 from smartfields.processors.mixin import CloudExternalFileProcessorMixin
 
 try:
@@ -14,11 +15,13 @@ except ImportError:
     Image = None
 try:
     from wand.image import Image as WandImage
+    from wand.version import VERSION as WAND_VERSION
 except ImportError:
-    WandImage = None
+    WandImage = WAND_VERSION = None
 
 __all__ = [
-    'ImageProcessor', 'ImageFormat', 'supported_formats', 'WandImageProcessor', 'CloudImageProcessor'
+    'ImageProcessor', 'ImageFormat', 'supported_formats', 'WandImageProcessor', 'CloudImageProcessor',
+    'SharedImage'
 ]
 
 PILLOW_MODES = [
@@ -162,15 +165,71 @@ supported_formats = ImageFormats(getattr(settings, 'SMARTFIELDS_IMAGE_FORMATS',
 ]))
 
 
+class SharedImage(object):
+    """Image, which is decoded only once and shared by processors of all dependencies
+    on the same source, while a field is being processed. Every produced rendition is
+    kept as well, so a smaller one can be resized from the smallest rendition that is
+    still at least ``reuse_factor`` times larger, rather than from the source. If all
+    of the ``scales``, that renditions are going to be produced with, allow fast
+    downscaling, the source is decoded at a reduced size, which is still large enough
+    for each of them.
+
+    """
+    reuse_factor = 2
+
+    def __init__(self, value, scales=None):
+        # holding on to the value also makes sure its `id` is not reused
+        self.value = value
+        self.scales = scales
+        self.image = None
+        # size of the source and a box within a decoded image that corresponds to it
+        self.size = self.box = None
+        self.renditions = []
+        self._lock = threading.Lock()
+
+    def get_base(self, size):
+        base = self.image
+        for rendition in self.renditions:
+            if rendition.size[0] >= size[0]*self.reuse_factor and \
+               rendition.size[1] >= size[1]*self.reuse_factor and \
+               rendition.size[0] < base.size[0]:
+                base = rendition
+        return base
+
+    def get_rendition(self, processor, scale=None, **kwargs):
+        with self._lock:
+            if self.image is None:
+                self.image, self.size, self.box = processor.decode(
+                    self.value, scales=self.scales, **kwargs)
+            if scale is None:
+                return self.image
+            new_size = processor.get_dimensions(*self.size, **scale)
+            if new_size == self.size and self.box is None:
+                return self.image
+            base = self.get_base(new_size)
+        rendition = processor.resize_to(
+            base, new_size, reducing_gap=scale.get('reducing_gap', None),
+            box=self.box if base is self.image else None)
+        with self._lock:
+            self.renditions.append(rendition)
+        return rendition
+
+
 class ImageProcessor(BaseFileProcessor):
     field_file_class = ImageFieldFile
     supported_formats = supported_formats
+    # decode an image only once for all dependencies on the same source
+    share_image = True
+    resource = 'image'
 
     @property
     def resample(self):
         # resampling was renamed from Image.ANTIALIAS to Image.LANCZOS
         return getattr(Image, 'LANCZOS', getattr(Image, 'ANTIALIAS')) 
 
+    def get_version(self):
+        return getattr(Image, '__version__', None)
+
     def get_params(self, **kwargs):
         params = super(ImageProcessor, self).get_params(**kwargs)
         if 'format' in params:
@@ -199,7 +258,10 @@ class ImageProcessor(BaseFileProcessor):
         except KeyError: pass
 
     def _check_scale_params(self, width=None, height=None, min_width=None, min_height=None, 
-                            max_width=None, max_height=None, preserve=True):
+                            max_width=None, max_height=None, preserve=True,
+                            reducing_gap=None):
+        assert reducing_gap is None or reducing_gap >= 1, \
+            "reducing_gap should be greater or equal to 1"
         assert width is None or (min_width is None and max_width is None), \
             "min_width or max_width don't make sence if width cannot be changed"
         assert height is None or (min_height is None and max_height is None), \
@@ -220,9 +282,10 @@ class ImageProcessor(BaseFileProcessor):
             
     def get_dimensions(self, old_width, old_height, width=None, height=None, 
                        min_width=None, min_height=None, 
-                       max_width=None, max_height=None, preserve=True):
+                       max_width=None, max_height=None, preserve=True, reducing_gap=None):
         self._check_scale_params(
-            width, height, min_width, min_height, max_width, max_height, preserve)
+            width, height, min_width, min_height, max_width, max_height, preserve,
+            reducing_gap)
         ratio = float(old_width)/old_height
         new_width, new_height = old_width, old_height
         if width is not None:
@@ -251,11 +314,31 @@ class ImageProcessor(BaseFileProcessor):
                 new_width = _round(new_height*ratio)
         return new_width, new_height
 
+    def resize_to(self, image, size, reducing_gap=None, box=None):
+        kwargs = {}
+        if reducing_gap is not None and hasattr(image, 'reduce'):
+            # Fast downscaling, same as in `Image.thumbnail`: JPEGs are decoded at a
+            # reduced size right away (unless image is already loaded, in which case
+            # ``box`` is set, if it was reduced while decoding, see `decode`), and then
+            # reduced further by an integer factor, as long as the image stays
+            # `reducing_gap` times larger than the new size, so only the rest is
+            # resampled.
+            if box is None:
+                result = image.draft(
+                    None, (int(size[0]*reducing_gap), int(size[1]*reducing_gap)))
+                if result is not None:
+                    box = result[1]
+            kwargs['reducing_gap'] = reducing_gap
+        if box is not None:
+            kwargs['box'] = box
+        return image.resize(size, resample=self.resample, **kwargs)
+
     def resize(self, image, scale=None, **kwargs):
         if scale is not None:
             new_size = self.get_dimensions(*image.size, **scale)
             if image.size != new_size:
-                return image.resize(new_size, resample=self.resample)
+                return self.resize_to(
+                    image, new_size, reducing_gap=scale.get('reducing_gap', None))
         return image
 
     def convert(self, image, format=None, **kwargs):
@@ -284,31 +367,152 @@ class ImageProcessor(BaseFileProcessor):
             image = Image.open(stream)
         return image
 
-    def process(self, value, scale=None, format=None, **kwargs):
-        cur_pos = value.tell()
-        value.seek(0)
+    def get_path(self, value):
+        """Returns a path to a file on disk with the image, if there is one."""
+        for f in (value, getattr(value, 'file', None)):
+            if hasattr(f, 'temporary_file_path'):
+                return f.temporary_file_path()
+        if isinstance(value, files.FieldFile) and value._committed:
+            try:
+                return value.path
+            except (NotImplementedError, ValueError):
+                pass
+
+    def open_stream(self, value):
+        """Returns a binary stream that image can be read from and a flag, whether it
+        was opened by the processor and has to be closed afterwards. Image is read from
+        a file on disk or directly from a seekable file, so the content doesn't need to
+        be copied in memory. Only as a last resort it is buffered.
+
+        """
+        path = self.get_path(value)
+        if path is not None and os.path.isfile(path):
+            return open(path, 'rb'), True
+        stream = value
+        # unwrap django's files down to an actual file handle or stream
+        while isinstance(stream, File) and stream.file is not None:
+            stream = stream.file
+        try:
+            seekable = stream.seekable()
+        except AttributeError:
+            seekable = hasattr(stream, 'seek')
+        if seekable and 'b' in getattr(stream, 'mode', 'b'):
+            return stream, False
+        try:
+            cur_pos = value.tell()
+            value.seek(0)
+        except (AttributeError, IOError, OSError, ValueError):
+            cur_pos = None
         stream = six.BytesIO(value.read())
-        stream_out = None
-        value.seek(cur_pos)
+        if cur_pos is not None:
+            value.seek(cur_pos)
+        return stream, True
+
+    def get_shared_scales(self, field):
+        """Returns scales of all images produced by dependencies of the ``field``, so
+        shared image can be decoded at a size that suits all of them, or ``None`` if
+        they are not known."""
+        manager = getattr(field, 'manager', None)
+        if manager is None:
+            return None
+        scales = []
+        for d in manager.dependencies:
+            if isinstance(d._processor, ImageProcessor) and d._processor.share_image:
+                scales.append(d._processor.get_params(**d._processor_params).get('scale'))
+        return scales
+
+    def get_shared_image(self, value, instance=None, field=None, **kwargs):
+        """Returns a :class:`SharedImage` for the ``value``, whenever processing
+        happens as part of processing of a field."""
+        context = get_processing_context(instance)
+        if context is None or not self.share_image:
+            return None
+        key = ('shared_image', id(value))
+        shared_image = context.get(key)
+        if shared_image is None:
+            shared_image = context.setdefault(
+                key, SharedImage(value, scales=self.get_shared_scales(field)))
+        return shared_image
+
+    def get_draft_size(self, size, scales):
+        """Returns the smallest size an image of ``size`` can be decoded at, so it is
+        still ``reducing_gap`` times larger than each of ``scales``, or ``None``, unless
+        all of them allow fast downscaling."""
+        if not scales or any(scale is None or scale.get('reducing_gap') is None
+                             for scale in scales):
+            return None
+        width = height = 0
+        for scale in scales:
+            new_width, new_height = self.get_dimensions(*size, **scale)
+            width = max(width, int(new_width*scale['reducing_gap']))
+            height = max(height, int(new_height*scale['reducing_gap']))
+        return width, height
+
+    def decode(self, value, scales=None, **kwargs):
+        """Opens an image and fully loads it into memory. JPEGs are decoded at a reduced
+        size, whenever all of ``scales`` it will be resized to allow fast downscaling.
+        Returns the image, size of the source and a box within the image that
+        corresponds to the source, if it was reduced.
+
+        """
+        stream, is_opened = self.open_stream(value)
+        cur_pos = None if is_opened else stream.tell()
         try:
-            image = self.get_image(stream, scale=scale, format=format, **kwargs)
-            image = self.resize(image, scale=scale, format=format, **kwargs)
-            stream_out = self.convert(image, scale=scale, format=format, **kwargs)
-            if stream_out is not None:
-                content = stream_out.getvalue()
+            stream.seek(0)
+            image = self.get_image(stream, **kwargs)
+            size, box = image.size, None
+            draft_size = self.get_draft_size(size, scales)
+            if draft_size is not None:
+                # has to be done before the image is loaded
+                result = image.draft(None, draft_size)
+                if result is not None:
+                    box = result[1]
+            image.load()
+            return image, size, box
+        finally:
+            if is_opened:
+                stream.close()
             else:
-                content = stream.getvalue()
+                stream.seek(cur_pos)
+
+    def process(self, value, scale=None, format=None, **kwargs):
+        shared_image = self.get_shared_image(value, **kwargs)
+        stream, is_opened, cur_pos = None, False, None
+        try:
+            if shared_image is None:
+                stream, is_opened = self.open_stream(value)
+                cur_pos = None if is_opened else stream.tell()
+                stream.seek(0)
+                image = self.get_image(stream, scale=scale, format=format, **kwargs)
+                image = self.resize(image, scale=scale, format=format, **kwargs)
+            else:
+                image = shared_image.get_rendition(self, scale=scale, format=format, **kwargs)
+            stream_out = self.convert(image, scale=scale, format=format, **kwargs)
+            if stream_out is None:
+                if stream is None:
+                    stream, is_opened = self.open_stream(value)
+                    cur_pos = None if is_opened else stream.tell()
+                stream.seek(0)
+                return ContentFile(stream.read())
+            stream_out.seek(0)
+            return StreamFile(stream_out)
         except (IOError, OSError, Image.DecompressionBombWarning) as e:
             raise ProcessingError(
                 "There was a problem with image conversion: %s" % e)
         finally:
-            if stream_out is not None:
-                stream_out.close()
-            stream.close()
-        return ContentFile(content)
+            if stream is not None:
+                if is_opened:
+                    stream.close()
+                else:
+                    stream.seek(cur_pos)
 
 
 class WandImageProcessor(ImageProcessor):
+    # wand images are modified in place
+    share_image = False
+
+    def get_version(self):
+        return WAND_VERSION
 
     def resize(self, image, scale=None, **kwargs):
         if scale is not None:
@@ -1,18 +1,31 @@
 import time, random
+import six
 from django.contrib.sites.models import Site
+from django.db.models import Q
 from django.utils.functional import SimpleLazyObject
 from django.utils.text import slugify
 from django.utils.encoding import force_text
 
 from smartfields.processors.base import BaseProcessor
-from smartfields.utils import apps
+from smartfields.utils import apps, get_processing_context
+
+from six.moves.html_parser import HTMLParser
+try:
+    from html import unescape
+except ImportError:  # python<3.4
+    unescape = HTMLParser().unescape
 
 try:
     from bs4 import BeautifulSoup, Comment
-    import lxml # pylint: disable=unused-import
-    DEFAULT_PARSER = "lxml"
+    try:
+        import lxml # pylint: disable=unused-import
+        DEFAULT_PARSER = "lxml"
+    except ImportError:
+        DEFAULT_PARSER = "html.parser"
+    DEFAULT_ENGINE = 'soup'
 except ImportError:
     DEFAULT_PARSER = "html.parser"
+    DEFAULT_ENGINE = 'stream'
 
 __all__ = [
     'CropProcessor', 'UniqueProcessor', 'SlugProcessor', 'HTMLProcessor', 'HTMLTagProcessor'
@@ -38,47 +51,182 @@ class CropProcessor(BaseProcessor):
 
 
 class UniqueProcessor(CropProcessor):
+    """Makes sure value is unique by appending a number to it, whenever it is taken
+    already. All values that could be in the way are fetched with a single query, so
+    a free number is picked in memory. ``strategy`` is either ``'random'``, which picks
+    any free number, or ``'counter'``, which picks the smallest free one, starting
+    at ``counter_start``. With ``optimistic=True`` value is not checked at all, instead
+    it is regenerated and saving is retried, in case it fails with an
+    ``IntegrityError``, which makes saving values that are unique in the first place
+    free of extra queries.
+
+    """
     separator = ''
     max_attempts = 100
+    strategy = 'random'
+    strategies = ('random', 'counter')
+    counter_start = 2
+    # whenever random picks fail, a free number is looked for among all of them, as
+    # long as there are no more than that
+    max_enumerated = 10000
 
-    def get_random(self, padding):
+    def __init__(self, strategy=None, optimistic=False, **kwargs):
+        self.strategy = strategy or self.strategy
+        self.optimistic = optimistic
+        assert self.strategy in self.strategies, \
+            "strategy should be one of: %s" % ", ".join(self.strategies)
+        super(UniqueProcessor, self).__init__(**kwargs)
+
+    def get_upper(self, padding):
         if padding is None:
-            upper = int(time.time())
-        else:
-            upper = 10**(padding - len(self.separator)) - 1
-        return random.randint(0, upper)
+            return int(time.time())
+        return 10**(padding - len(self.separator)) - 1
+
+    def get_random(self, padding):
+        return random.randint(0, self.get_upper(padding))
 
     def get_padding(self, max_length):
         if max_length is not None:
             # use at least 10% of max_length at most 5 chars for random number
             return min(5, int(max_length/10) or 1) + len(self.separator)
 
-    def process(self, value, instance, field, dependee=None, iexact=False, **kwargs):
+    def is_conflict(self, instance):
+        """Checks if value is being regenerated, because saving failed with it."""
+        context = get_processing_context(instance)
+        return bool(context and context.get('unique_conflict'))
+
+    def get_batch(self, instance):
+        """Returns a :class:`UniqueBatch`, whenever instance is processed as a part of
+        a batch."""
+        context = get_processing_context(instance)
+        if context:
+            return context.get('unique_batch')
+
+    def get_lookup(self, dependee, value, prefix, iexact=False):
+        """Lookup for values, that are equal to ``value`` or start with a ``prefix``."""
+        name = dependee.name
+        if iexact:
+            return (Q(**{"%s__iexact" % name: value}) |
+                    Q(**{"%s__istartswith" % name: prefix}))
+        return Q(**{name: value}) | Q(**{"%s__startswith" % name: prefix})
+
+    def query_taken(self, model, dependee, lookup, iexact=False, exclude=()):
+        existing = model._default_manager.filter(lookup)
+        if exclude:
+            existing = existing.exclude(pk__in=exclude)
+        taken = existing.values_list(dependee.name, flat=True)
+        if iexact:
+            return set(v.lower() for v in taken)
+        return set(taken)
+
+    def get_taken(self, instance, dependee, value, prefix, iexact=False):
+        """Retrieves all values, that are equal to ``value`` or start with a ``prefix``,
+        which are already taken by other instances."""
+        return self.query_taken(
+            instance.__class__, dependee, self.get_lookup(dependee, value, prefix, iexact),
+            iexact=iexact, exclude=() if instance.pk is None else (instance.pk,))
+
+    def get_number(self, value, taken, padding, strategy, iexact=False):
+        """Picks a number, which makes the ``value`` unique, ``None`` if there is none."""
+        prefix = value + self.separator
+        prefix = prefix.lower() if iexact else prefix
+        start = len(prefix)
+        numbers = set(int(v[start:]) for v in taken
+                      if v.startswith(prefix) and v[start:].isdigit())
+        upper = self.get_upper(padding)
+        if strategy == 'counter':
+            number = self.counter_start
+            while number in numbers:
+                number+= 1
+            return number if number <= upper else None
+        for _ in range(self.max_attempts):
+            number = self.get_random(padding)
+            if number not in numbers:
+                return number
+        if upper < self.max_enumerated:
+            free = set(range(upper + 1)) - numbers
+            if free:
+                return random.choice(list(free))
+
+    def process(self, value, instance, field, dependee=None, iexact=False,
+                strategy=None, **kwargs):
         # make sure value can at least fit in
         value = super(UniqueProcessor, self).process(
             value, instance=instance, field=field, dependee=dependee, **kwargs)
         if dependee is None or not dependee._unique:
             return value
-        manager = instance.__class__._default_manager
         unique_value = value or ""
-        filter_key = "%s__iexact" % field.name if iexact else field.name
-        existing = manager.filter(**{filter_key: unique_value})
-        if instance.pk is not None:
-            existing = existing.exclude(pk=instance.pk)
+        batch = self.get_batch(instance)
+        if self.optimistic and batch is None and not self.is_conflict(instance):
+            return unique_value
         padding = self.get_padding(dependee.max_length)
-        if padding is not None and existing.exists():
-            # if value exists already, crop it more so we can add some random numbers
-            value = super(UniqueProcessor, self).process(
-                value, instance=instance, field=field, dependee=dependee, 
+        # if value exists already, it has to be cropped more, so a number can be added
+        cropped_value = unique_value if padding is None else \
+            super(UniqueProcessor, self).process(
+                unique_value, instance=instance, field=field, dependee=dependee,
                 padding=padding, **kwargs)
-        attempt = 0 # just so we can guarantee it doesn't get stuck in infinite loop
-        while existing.exists() and attempt < self.max_attempts:
-            unique_value = "%s%s%s" % (value, self.separator, self.get_random(padding))
-            existing = manager.filter(**{filter_key: unique_value})
-            if instance.pk is not None:
-                existing = existing.exclude(pk=instance.pk)
-            attempt+= 1
-        return unique_value
+        strategy = strategy or self.strategy
+        if batch is not None:
+            # value will be picked, once collisions are known for the whole batch
+            batch.add(self, instance, dependee, unique_value, cropped_value, padding,
+                      strategy, iexact)
+            return unique_value
+        taken = self.get_taken(instance, dependee, unique_value,
+                               cropped_value + self.separator, iexact=iexact)
+        return self.pick(unique_value, cropped_value, taken, padding, strategy, iexact)
+
+    def pick(self, value, cropped_value, taken, padding, strategy, iexact=False):
+        """Returns ``value`` if it is not ``taken``, otherwise a ``cropped_value`` with a
+        number appended."""
+        if (value.lower() if iexact else value) not in taken:
+            return value
+        number = self.get_number(cropped_value, taken, padding, strategy, iexact=iexact)
+        if number is None:
+            # all numbers are taken, saving will fail with an IntegrityError
+            number = self.get_random(padding)
+        return "%s%s%s" % (cropped_value, self.separator, number)
+
+
+class UniqueBatch(object):
+    """Collects values produced by :class:`UniqueProcessor`, while a batch of instances
+    is being processed, so collisions can be looked up for all of them at once, with a
+    query per field for every ``chunk_size`` instances. Values are picked in order, so
+    they don't collide with each other either.
+
+    """
+    chunk_size = 100
+
+    def __init__(self):
+        self.items = []
+
+    def add(self, processor, instance, dependee, value, cropped_value, padding, strategy,
+            iexact=False):
+        self.items.append((processor, instance, dependee, value, cropped_value, padding,
+                           strategy, iexact))
+
+    def resolve(self):
+        """Picks unique values and sets them on instances."""
+        groups = {}
+        for item in self.items:
+            processor, instance, dependee, iexact = item[0], item[1], item[2], item[7]
+            groups.setdefault(
+                (instance.__class__, dependee, iexact), (processor, []))[1].append(item)
+        for (model, dependee, iexact), (processor, items) in six.iteritems(groups):
+            exclude = [item[1].pk for item in items if item[1].pk is not None]
+            taken = set()
+            for idx in range(0, len(items), self.chunk_size):
+                lookup = Q()
+                for item in items[idx:idx + self.chunk_size]:
+                    lookup|= processor.get_lookup(
+                        dependee, item[3], item[4] + processor.separator, iexact)
+                taken.update(processor.query_taken(
+                    model, dependee, lookup, iexact=iexact, exclude=exclude))
+            for processor, instance, _, value, cropped_value, padding, strategy, _ in items:
+                value = processor.pick(
+                    value, cropped_value, taken, padding, strategy, iexact=iexact)
+                taken.add(value.lower() if iexact else value)
+                instance.__dict__[dependee.attname] = value
+        self.items = []
 
 
 class SlugProcessor(UniqueProcessor):
@@ -90,10 +238,152 @@ class SlugProcessor(UniqueProcessor):
         return super(SlugProcessor, self).process(value, **kwargs)
 
 
+class StreamTag(object):
+    """A tag passed to :meth:`HTMLProcessor.process_tag` by the ``'stream'`` engine.
+    Just like with BeautifulSoup, it can be kept by setting ``hidden = False`` or removed
+    together with its contents by ``extract()`` or ``decompose()``, but it has no
+    access to its contents, since they haven't been parsed yet.
+
+    """
+    hidden = False
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = dict((key, '' if value is None else value) for key, value in attrs)
+        self.removed = False
+
+    def __getitem__(self, key):
+        return self.attrs[key]
+
+    def get(self, key, default=None):
+        return self.attrs.get(key, default)
+
+    def extract(self):
+        self.removed = True
+        return self
+
+    def decompose(self):
+        self.removed = True
+
+
+class StopParsing(Exception):
+    pass
+
+
+def _escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+class HTMLStreamer(HTMLParser):
+    """Renders HTML as it is being tokenized, without building a tree, while calling
+    ``process_tag`` for every tag. Comments and declarations are dropped. Parsing is
+    stopped as soon as ``limit`` characters were produced.
+
+    """
+    void_elements = frozenset([
+        'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+        'param', 'source', 'track', 'wbr'])
+    cdata_elements = frozenset(['script', 'style'])
+
+    def __init__(self, process_tag, limit=None):
+        try:
+            HTMLParser.__init__(self, convert_charrefs=True)
+        except TypeError:  # python<3.4, references are converted by the handlers below
+            HTMLParser.__init__(self)
+        self.process_tag = process_tag
+        self.limit = limit
+        self.output = []
+        self.length = 0
+        self.stack = []
+        self.removed = 0
+
+    def write(self, text):
+        if text and not self.removed:
+            self.output.append(text)
+            self.length+= len(text)
+            if self.limit is not None and self.length >= self.limit:
+                raise StopParsing()
+
+    def render_start(self, tag, closed=False):
+        attrs = "".join(
+            ' %s="%s"' % (key, _escape(value).replace('"', '&quot;'))
+            for key, value in tag.attrs.items())
+        return "<%s%s%s>" % (tag.name, attrs, "/" if closed else "")
+
+    def handle_starttag(self, name, attrs, closed=False):
+        if self.removed:
+            if not closed and name not in self.void_elements:
+                self.stack.append((name, None))
+            return
+        tag = StreamTag(name, attrs)
+        self.process_tag(tag)
+        if tag.removed:
+            if not closed and name not in self.void_elements:
+                self.removed+= 1
+                self.stack.append((name, tag))
+            return
+        if not tag.hidden:
+            self.write(self.render_start(tag, closed=closed))
+        if not closed and name not in self.void_elements:
+            self.stack.append((name, tag))
+
+    def handle_startendtag(self, name, attrs):
+        self.handle_starttag(name, attrs, closed=True)
+
+    def handle_endtag(self, name):
+        if name is not None and not any(open_name == name for open_name, _ in self.stack):
+            return
+        # closes all of the tags, that were left open within the one being closed, or
+        # all of them at the end of a document, whenever ``name`` is ``None``
+        while self.stack:
+            open_name, tag = self.stack.pop()
+            if tag is not None and tag.removed:
+                self.removed-= 1
+            elif tag is not None and not tag.hidden:
+                self.write("</%s>" % open_name)
+            if open_name == name:
+                break
+
+    def handle_data(self, data):
+        if self.stack and self.stack[-1][0] in self.cdata_elements:
+            self.write(data)
+        else:
+            self.write(_escape(data))
+
+    def handle_entityref(self, name):
+        self.handle_data(unescape("&%s;" % name))
+
+    def handle_charref(self, name):
+        self.handle_data(unescape("&#%s;" % name))
+
+    def render(self, value):
+        try:
+            self.feed(value)
+            self.close()
+            self.handle_endtag(None)
+        except StopParsing:
+            pass
+        return "".join(self.output)
+
+
 class HTMLProcessor(CropProcessor):
-    """Basic HTML processor that stripps out all the tags."""
+    """Basic HTML processor that stripps out all the tags. There are two engines
+    available: ``'soup'`` builds a BeautifulSoup tree, while ``'stream'`` renders
+    HTML as it is tokenized by ``html.parser``, which is a lot faster and uses less
+    memory on large documents, and stops as soon as enough text for a dependee with a
+    ``max_length`` was produced. Either way every tag is passed to :meth:`process_tag`.
+
+    """
     parser = DEFAULT_PARSER
-    
+    engine = DEFAULT_ENGINE
+    engines = ('soup', 'stream')
+
+    def __init__(self, engine=None, **kwargs):
+        self.engine = engine or self.engine
+        assert self.engine in self.engines, \
+            "engine should be one of: %s" % ", ".join(self.engines)
+        super(HTMLProcessor, self).__init__(**kwargs)
+
     def remove_comments(self, soup):
         for comment in soup.findAll(text=lambda text: isinstance(text, Comment)):
             comment.extract()
@@ -101,36 +391,74 @@ class HTMLProcessor(CropProcessor):
     def process_tag(self, tag):
         tag.hidden = True
 
-    def process(self, value, **kwargs):
+    def render_soup(self, value):
         soup = BeautifulSoup(value, self.parser)
         self.remove_comments(soup)
         for tag in soup.findAll(True):
             self.process_tag(tag)
-        value = soup.renderContents().decode('utf8')
-        return super(HTMLProcessor, self).process(value, **kwargs)
+        return soup.renderContents().decode('utf8')
+
+    def render_stream(self, value, limit=None):
+        return HTMLStreamer(self.process_tag, limit=limit).render(value)
+
+    def process(self, value, dependee=None, padding=None, **kwargs):
+        if self.engine == 'stream':
+            limit = None
+            if dependee is not None and dependee.max_length is not None:
+                limit = dependee.max_length - (padding or self.padding)
+            value = self.render_stream(value, limit=limit)
+        else:
+            value = self.render_soup(value)
+        return super(HTMLProcessor, self).process(
+            value, dependee=dependee, padding=padding, **kwargs)
 
 
 class HTMLTagProcessor(BaseProcessor):
+    """Renders an HTML tag from a ``template`` with ``str.format``, which gets ``value``,
+    ``instance``, ``field`` and ``base_url`` in its context. Unless ``base_url`` is
+    specified, it is resolved from the current ``Site`` once and cached for the lifetime
+    of the process. Whenever a dependee is a model field, the tag is rendered right
+    away, so it is stored in the database and rendered only when a value changes.
+    Otherwise it is rendered lazily, upon first access, since ``template`` may refer to
+    values that are produced asynchronously, unless ``lazy=False``.
+
+    """
     template = None
     base_url = None
+    lazy = True
+    _site_base_url = None
 
-    def __init__(self, template=None, base_url=None, **kwargs):
+    def __init__(self, template=None, base_url=None, lazy=None, **kwargs):
         self.template = template or self.template
         assert self.template is not None, "template is required"
         self.base_url = base_url or self.base_url
+        if lazy is not None:
+            self.lazy = lazy
         super(HTMLTagProcessor, self).__init__(**kwargs)
-        
-    def process(self, value, instance, field, **kwargs):
-        def renderer():
-            context = {
-                'value': value,
-                'instance': instance,
-                'field': field,
-            }
-            if self.base_url is not None:
-                context['base_url'] = self.base_url
-            elif apps.is_installed('django.contrib.sites'):
-                context['base_url'] = "//%s" % Site.objects.get_current().domain
-            context.update(kwargs)
-            return self.template.format(**context)
-        return SimpleLazyObject(renderer)
+
+    def get_base_url(self):
+        if self.base_url is not None:
+            return self.base_url
+        if self._site_base_url is None and apps.is_installed('django.contrib.sites'):
+            self._site_base_url = "//%s" % Site.objects.get_current().domain
+        return self._site_base_url
+
+    def render(self, value, instance, field, **kwargs):
+        context = {
+            'value': value,
+            'instance': instance,
+            'field': field,
+        }
+        base_url = self.get_base_url()
+        if base_url is not None:
+            context['base_url'] = base_url
+        context.update(kwargs)
+        return self.template.format(**context)
+
+    def process(self, value, instance, field, dependee=None, **kwargs):
+        if dependee is not None or not self.lazy:
+            if not value:
+                return ""
+            return self.render(value, instance, field, dependee=dependee, **kwargs)
+        return SimpleLazyObject(
+            lambda: self.render(value, instance, field, dependee=dependee, **kwargs))
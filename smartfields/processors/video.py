@@ -1,7 +1,11 @@
-import re
+import os, re, shutil, subprocess, tempfile, threading
 import six
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
+from django.utils.encoding import force_text
 
 from smartfields.processors.base import ExternalFileProcessor
+from smartfields.resources import get_resource_limiter
 from smartfields.utils import ProcessingError
 from smartfields.processors.mixin import CloudExternalFileProcessorMixin
 
@@ -9,15 +13,240 @@ __all__ = [
     'FFMPEGProcessor', 'CloudFFMEGPRocessor'
 ]
 
+# versions of executables, see `FFMPEGProcessor.get_version`
+_versions = {}
+
 class FFMPEGProcessor(ExternalFileProcessor):
+    resource = 'ffmpeg'
     duration_re = re.compile(r'Duration: (?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>\d+)')
     progress_re = re.compile(r'time=(?P<hours>\d+):(?P<minutes>\d+):(?P<seconds>\d+)')
     error_re = re.compile(r'Invalid data found when processing input')
-    cmd_template = "ffmpeg -i {input} -y -codec:v {vcodec} -b:v {vbitrate} " \
-                   "-maxrate {maxrate} -bufsize {bufsize} -vf " \
-                   "scale={width}:{height} -threads {threads} -c:a {acodec} {output}"
-    
-    def stdout_handler(self, line, duration=None):
+    input_template = "ffmpeg -i {input} -y"
+    output_template = "-codec:v {vcodec} -b:v {vbitrate} -maxrate {maxrate} " \
+                      "-bufsize {bufsize} -vf scale={width}:{height} " \
+                      "-threads {threads} -c:a {acodec} {output}"
+    cmd_template = "%s %s" % (input_template, output_template)
+    # arguments inserted right after the executable, when `progress_pipe` is enabled
+    progress_args = ['-progress', 'pipe:1', '-nostats', '-loglevel', 'error']
+    probe_template = "ffprobe -v error -show_entries format=duration " \
+                     "-of default=noprint_wrappers=1:nokey=1 {input}"
+    # values reported by ffmpeg with `-progress`, which are passed on together with
+    # the progress, with functions that convert them.
+    telemetry = {'frame': int, 'fps': float, 'bitrate': str, 'total_size': int, 'speed': str}
+    # stream copy can only split a video at keyframes, matroska can hold any codec
+    split_template = "ffmpeg -i {input} -y -map 0 -c copy -f segment " \
+                     "-segment_time {segment_time} -reset_timestamps 1 {output}"
+    concat_template = "ffmpeg -f concat -safe 0 -i {input} -y -c copy {output}"
+    segment_ext = '.mkv'
+
+    def __init__(self, cmd_template=None, multi_output=False, progress_pipe=False,
+                 segment_time=None, segment_workers=None, **kwargs):
+        """``multi_output=True`` lets all such processors of the same field transcode the
+        input with a single ffmpeg process, producing all outputs in one pass.
+        ``progress_pipe=True`` makes ffmpeg report its progress in a machine readable
+        form, relative to a duration of the input found out with ffprobe.
+        ``segment_time`` splits the input into segments of about that many seconds,
+        which are transcoded by up to ``segment_workers`` ffmpeg processes at a time
+        (number of CPUs by default) and then joined together, it implies
+        ``progress_pipe``. Every ffmpeg process past the first one needs a slot of its
+        own, whenever 'ffmpeg' resource is limited by ``SMARTFIELDS_RESOURCE_LIMITS``."""
+        super(FFMPEGProcessor, self).__init__(cmd_template=cmd_template, **kwargs)
+        assert not (multi_output and segment_time), \
+            "Segmented transcoding cannot produce multiple outputs."
+        self.multi_output = multi_output
+        self.segment_time = segment_time
+        self.segment_workers = segment_workers
+        self.progress_pipe = progress_pipe = progress_pipe or bool(segment_time)
+        if progress_pipe:
+            self.stderr_handler = self.error_handler
+        assert not multi_output or \
+            self.cmd_template == "%s %s" % (self.input_template, self.output_template), \
+            "Multiple outputs can only be produced with 'input_template' and " \
+            "'output_template' instead of a custom 'cmd_template'."
+
+    def __eq__(self, other):
+        return super(FFMPEGProcessor, self).__eq__(other) and \
+            self.multi_output == other.multi_output and \
+            self.progress_pipe == other.progress_pipe and \
+            self.segment_time == other.segment_time
+
+    def get_group_key(self):
+        if self.multi_output:
+            return (type(self), self.input_template)
+
+    def get_version(self):
+        """First line of ``ffmpeg -version`` output, which is looked up once per
+        process."""
+        executable = self.input_template.split()[0]
+        if executable not in _versions:
+            try:
+                output = subprocess.check_output(
+                    [executable, '-version'], stderr=subprocess.STDOUT)
+                _versions[executable] = force_text(output).split('\n')[0].strip()
+            except (OSError, subprocess.CalledProcessError):
+                _versions[executable] = None
+        return _versions[executable]
+
+    def process_many(self, in_file, jobs, instance=None, field=None, **kwargs):
+        """Transcodes ``in_file`` into multiple outputs at once, so it is decoded only
+        once. ``jobs`` is a list of ``(processor, params)`` tuples, one for each
+        output, and a list of output files is returned in the same order.
+
+        """
+        out_files, outputs = [], []
+        for processor, params in jobs:
+            out_file = processor.get_output_file(in_file, instance=instance, field=field)
+            out_files.append(out_file)
+            outputs.append(processor.output_template.format(
+                output=processor.get_output_path(out_file), **params))
+        cmd = self.input_template.format(input=self.get_input_path(in_file)).split()
+        for output in outputs:
+            cmd.extend(output.split())
+        self.transcode(in_file, cmd)
+        return out_files
+
+    def process(self, in_file, **kwargs):
+        out_file = self.get_output_file(in_file, **kwargs)
+        if self.segment_time:
+            self.transcode_segments(in_file, out_file, **kwargs)
+        else:
+            self.transcode(in_file, self.get_command(in_file, out_file, **kwargs))
+        return out_file
+
+    def run(self, cmd):
+        """Runs a command, which doesn't report any progress, to completion."""
+        with open(os.devnull, 'wb') as devnull:
+            if subprocess.call(cmd, stdout=devnull, stderr=devnull) != 0:
+                raise ProcessingError("There was a problem processing this file.")
+
+    def split(self, in_file, tmp_dir):
+        """Splits the input at keyframes, returns paths to segments in order."""
+        self.run(self.split_template.format(
+            input=self.get_input_path(in_file), segment_time=self.segment_time,
+            output=os.path.join(tmp_dir, 'segment_%05d' + self.segment_ext)).split())
+        return sorted(os.path.join(tmp_dir, name) for name in os.listdir(tmp_dir)
+                      if name.startswith('segment_'))
+
+    def concat(self, paths, out_file, tmp_dir):
+        """Joins transcoded segments together, without transcoding them again."""
+        list_path = os.path.join(tmp_dir, 'segments.txt')
+        with open(list_path, 'w') as list_file:
+            for path in paths:
+                list_file.write("file '%s'\n" % path.replace("'", "'\\''"))
+        self.run(self.concat_template.format(
+            input=list_path, output=self.get_output_path(out_file)).split())
+
+    def transcode_segments(self, in_file, out_file, **kwargs):
+        """Transcodes segments of the input in parallel and joins the results."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            segments = self.split(in_file, tmp_dir)
+            if not segments:
+                raise ProcessingError("Invalid video file or unknown video format.")
+            outputs = [os.path.join(tmp_dir, 'output_%05d%s' % (idx, self.get_ext()))
+                       for idx in range(len(segments))]
+            progress, lock = [0.0]*len(segments), threading.Lock()
+            def get_reporter(idx):
+                def report(segment_progress, **info):
+                    with lock:
+                        progress[idx] = segment_progress
+                        self.set_progress(min(sum(progress)/len(progress), 0.99), **info)
+                return report
+            def transcode_segment(idx):
+                cmd = self.cmd_template.format(
+                    input=segments[idx], output=outputs[idx], **kwargs).split()
+                report = get_reporter(idx)
+                # keyframes are not exactly `segment_time` apart, so it is an estimate
+                self.execute(cmd[:1] + self.progress_args + cmd[1:],
+                             stdout_args=(float(self.segment_time), None, report))
+                report(1)
+            pending = list(range(len(segments)))
+            limiter = get_resource_limiter(self.resource)
+            def worker(extra):
+                # first worker runs in a slot held by the dependency, while extra ones
+                # take a slot per segment, but only if one is free, so the video can't
+                # take up more than its share of slots, nor wait for them forever.
+                while True:
+                    slot = None
+                    if extra and limiter is not None:
+                        slot = limiter.acquire(block=False)
+                        if slot is None:
+                            return
+                    try:
+                        with lock:
+                            if not pending:
+                                return
+                            idx = pending.pop(0)
+                        transcode_segment(idx)
+                    except Exception:
+                        with lock:
+                            del pending[:]
+                        raise
+                    finally:
+                        if slot is not None:
+                            limiter.release(slot)
+            workers = min(self.segment_workers or cpu_count(), len(segments))
+            pool = ThreadPool(workers)
+            try:
+                pool.map(worker, [idx > 0 for idx in range(workers)])
+            finally:
+                pool.close()
+                pool.join()
+            self.concat(outputs, out_file, tmp_dir)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def transcode(self, in_file, cmd):
+        if not self.progress_pipe:
+            return self.execute(cmd)
+        duration = self.get_duration(in_file)
+        self.execute(cmd[:1] + self.progress_args + cmd[1:], stdout_args=(duration,))
+
+    def get_duration(self, in_file):
+        """Returns duration of a video in seconds as reported by ffprobe, or ``None`` if
+        it is unknown."""
+        cmd = self.probe_template.format(input=self.get_input_path(in_file)).split()
+        try:
+            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError:
+            raise ProcessingError("Invalid video file or unknown video format.")
+        except OSError:
+            return None
+        try:
+            return float(output.strip()) or None
+        except ValueError:
+            return None
+
+    def progress_handler(self, line, duration=None, info=None, report=None):
+        # ffmpeg writes blocks of `key=value` lines, each finished with a `progress` key.
+        # Progress goes to `report` instead of `set_progress`, whenever it is supplied.
+        key, _, value = line.strip().partition('=')
+        info = {} if info is None else info
+        if key == 'progress':
+            if duration:
+                out_time = info.pop('out_time', 0)
+                (report or self.set_progress)(min(out_time/duration, 0.99), **info)
+            info = {}
+        elif key in ('out_time_us', 'out_time_ms'):
+            # despite the name, both of them are in microseconds
+            try:
+                info['out_time'] = int(value)/1000000.0
+            except ValueError: pass
+        elif key in self.telemetry:
+            try:
+                info[key] = self.telemetry[key](value.strip())
+            except ValueError: pass
+        return (duration, info, report)
+
+    def error_handler(self, line):
+        if self.error_re.search(line):
+            raise ProcessingError("Invalid video file or unknown video format.")
+
+    def stdout_handler(self, line, duration=None, *args):
+        # dispatched here rather than bound in `__init__`, so copies of the processor
+        # made by `with_progress_setter` report progress through their own setter.
+        if self.progress_pipe:
+            return self.progress_handler(line, duration, *args)
         if duration is None:
             duration_time = self.duration_re.search(line)
             if duration_time:
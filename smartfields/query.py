@@ -0,0 +1,147 @@
+import sys, threading
+import six
+
+from django.db import connections, models, transaction
+from django.db.models.expressions import Combinable
+from django.db.models.fields import files
+
+from smartfields.models import get_smartfields_managers
+from smartfields.processors.text import UniqueBatch
+from smartfields.utils import processing_context
+
+__all__ = [
+    'SmartfieldsQuerySet', 'SmartfieldsManager'
+]
+
+# django<2.2 has no `QuerySet.bulk_update`
+_has_bulk_update = hasattr(models.QuerySet, 'bulk_update')
+
+
+class SmartfieldsQuerySet(models.QuerySet):
+    """QuerySet, which processes smartfields of instances written to the database in
+    bulk, rather than skipping it. Collisions of unique values are looked up for the
+    whole batch at once and instances can be processed by a pool of ``workers``
+    threads, which is mostly beneficial for file processing.
+
+    """
+    # number of instances loaded and written at once by `update`
+    update_chunk_size = 1000
+
+    def smartfields_process(self, objs, fields=None, workers=None):
+        """Processes ``fields`` (all by default) of a batch of instances."""
+        managers = [manager for manager in get_smartfields_managers(self.model)
+                    if fields is None or manager.field in fields]
+        batch = UniqueBatch()
+        def process(instance):
+            with processing_context(instance) as context:
+                context['unique_batch'] = batch
+                for manager in managers:
+                    manager.process(instance)
+        if workers and workers > 1 and len(objs) > 1:
+            pending, lock, exc_info = iter(objs), threading.Lock(), []
+            def worker():
+                try:
+                    while not exc_info:
+                        with lock:
+                            instance = next(pending, None)
+                        if instance is None:
+                            return
+                        process(instance)
+                except BaseException:
+                    exc_info.append(sys.exc_info())
+                finally:
+                    # connections are per thread, they'd be left open otherwise
+                    connections.close_all()
+            threads = [threading.Thread(target=worker)
+                       for _ in range(min(workers, len(objs)))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            if exc_info:
+                six.reraise(*exc_info[0])
+        else:
+            for instance in objs:
+                process(instance)
+        batch.resolve()
+
+    def bulk_create(self, objs, *args, **kwargs):
+        workers = kwargs.pop('workers', None)
+        objs = list(objs)
+        self.smartfields_process(objs, workers=workers)
+        objs = super(SmartfieldsQuerySet, self).bulk_create(objs, *args, **kwargs)
+        for instance in objs:
+            # asynchronous processing can only be done for instances, which got their
+            # primary keys back from the database.
+            if instance.pk is not None:
+                instance.smartfields_handle('post_save')
+        return objs
+
+    def bulk_update(self, objs, fields, *args, **kwargs):
+        workers = kwargs.pop('workers', None)
+        objs = list(objs)
+        opts = self.model._meta
+        fields = [opts.get_field(name) for name in fields]
+        self.smartfields_process(objs, fields=fields, workers=workers)
+        # values set by dependencies need to be written as well
+        for manager in get_smartfields_managers(self.model):
+            if manager.field in fields:
+                for dependee in manager.get_dependees():
+                    if dependee.concrete and dependee not in fields:
+                        fields.append(dependee)
+        for instance in objs:
+            for field in fields:
+                if isinstance(field, files.FileField):
+                    # commits files, just like saving an instance does
+                    field.pre_save(instance, False)
+        rows = self._bulk_update(objs, fields, *args, **kwargs)
+        for manager in get_smartfields_managers(self.model):
+            if manager.field in fields:
+                for instance in objs:
+                    manager.handle(instance, 'post_save')
+        return rows
+
+    def _bulk_update(self, objs, fields, batch_size=None):
+        if _has_bulk_update:
+            return super(SmartfieldsQuerySet, self).bulk_update(
+                objs, [field.name for field in fields], batch_size=batch_size)
+        # instances are written one at a time, without any processing
+        queryset, rows = models.QuerySet(self.model, using=self.db), 0
+        with transaction.atomic(using=self.db, savepoint=False):
+            for instance in objs:
+                rows+= queryset.filter(pk=instance.pk).update(**dict(
+                    (field.attname, getattr(instance, field.attname)) for field in fields))
+        return rows
+
+    def update(self, **kwargs):
+        """Values of fields with dependencies are processed for each instance and written
+        with :meth:`bulk_update`, unless they are expressions, which are written as is.
+        Instances are loaded in chunks of ``update_chunk_size`` ordered by primary key,
+        so they don't have to fit into memory all at once, within a single transaction.
+
+        """
+        opts = self.model._meta
+        managers = getattr(self.model, '_smartfields_managers', {})
+        if not any(name in managers and not isinstance(value, Combinable) and
+                   opts.get_field(name).concrete
+                   for name, value in kwargs.items()):
+            return super(SmartfieldsQuerySet, self).update(**kwargs)
+        queryset, rows, last_pk = self.order_by('pk'), 0, None
+        # all chunks are written or none, just like with a single UPDATE statement
+        with transaction.atomic(using=self.db):
+            while True:
+                chunk = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+                objs = list(chunk[:self.update_chunk_size])
+                if not objs:
+                    return rows
+                for instance in objs:
+                    for name, value in kwargs.items():
+                        setattr(instance, name, value)
+                self.bulk_update(objs, list(kwargs))
+                rows+= len(objs)
+                last_pk = objs[-1].pk
+    update.alters_data = True
+
+
+class SmartfieldsManager(models.Manager.from_queryset(SmartfieldsQuerySet)):
+    pass
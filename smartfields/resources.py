@@ -0,0 +1,110 @@
+import os, errno, tempfile, threading, time
+from contextlib import contextmanager
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+from smartfields.settings import RESOURCE_LIMITS, RESOURCE_LOCK_DIR
+
+__all__ = [
+    'ResourceLimiter', 'get_resource_limiter'
+]
+
+_limiters = {}
+_lock = threading.Lock()
+
+
+def get_resource_limiter(name):
+    """Returns a :class:`ResourceLimiter` for a resource with a ``name``, or ``None`` if
+    there is no limit set for it in ``SMARTFIELDS_RESOURCE_LIMITS`` setting.
+
+    """
+    if name is None or name not in RESOURCE_LIMITS:
+        return None
+    limiter = _limiters.get(name)
+    if limiter is None:
+        with _lock:
+            limiter = _limiters.get(name)
+            if limiter is None:
+                limiter = _limiters[name] = ResourceLimiter(
+                    name, RESOURCE_LIMITS[name], lock_dir=RESOURCE_LOCK_DIR)
+    return limiter
+
+
+class ResourceLimiter(object):
+    """Limits the number of simultaneous users of a named resource to ``limit`` per
+    host. Every slot is a lock file in ``lock_dir``, so the limit is shared by all
+    processes on the host. On platforms without ``fcntl`` the limit is only enforced
+    within the current process.
+
+    """
+    min_sleep_time = 0.05
+    max_sleep_time = 1
+
+    def __init__(self, name, limit, lock_dir=None):
+        assert limit > 0, "Resource limit has to be a positive number."
+        self.name = name
+        self.limit = limit
+        self.lock_dir = lock_dir or os.path.join(tempfile.gettempdir(), 'smartfields')
+        self._semaphore = None
+        if fcntl is None:
+            self._semaphore = threading.BoundedSemaphore(limit)
+
+    def _try_acquire(self):
+        if self._semaphore is not None:
+            if self._semaphore.acquire(False):
+                return self._semaphore
+            return None
+        if not os.path.isdir(self.lock_dir):
+            try:
+                os.makedirs(self.lock_dir)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        for idx in range(self.limit):
+            path = os.path.join(self.lock_dir, "%s.%s.lock" % (self.name, idx))
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                os.close(fd)
+                if e.errno not in (errno.EAGAIN, errno.EACCES, errno.EWOULDBLOCK):
+                    raise
+            else:
+                return fd
+        return None
+
+    def acquire(self, on_wait=None, block=True):
+        """Blocks until a slot becomes available and returns it. ``on_wait`` is called
+        once, if all slots are taken at the moment. With ``block=False`` ``None`` is
+        returned right away instead of waiting.
+
+        """
+        slot = self._try_acquire()
+        if not block:
+            return slot
+        sleep_time = self.min_sleep_time
+        if slot is None and on_wait is not None:
+            on_wait()
+        while slot is None:
+            time.sleep(sleep_time)
+            sleep_time = min(sleep_time*2, self.max_sleep_time)
+            slot = self._try_acquire()
+        return slot
+
+    def release(self, slot):
+        if slot is self._semaphore:
+            self._semaphore.release()
+        else:
+            fcntl.flock(slot, fcntl.LOCK_UN)
+            os.close(slot)
+
+    @contextmanager
+    def slot(self, on_wait=None):
+        """Context manager, which holds a slot, see :meth:`acquire`."""
+        slot = self.acquire(on_wait=on_wait)
+        try:
+            yield slot
+        finally:
+            self.release(slot)
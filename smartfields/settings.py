@@ -12,3 +12,63 @@ PLUPLOAD_OPTIONS = getattr(settings, 'SMARTFIELDS_PLUPLOAD_OPTIONS', {
     'flash_swf_url': "%s/js/Moxie.swf" % PLUPLOAD_URL,
     'silverlight_xap_url': "%s/js/Moxie.xap" % PLUPLOAD_URL,
 })
+
+# Backend responsible for asynchronous processing.
+ASYNC_BACKEND = getattr(
+    settings, 'SMARTFIELDS_ASYNC_BACKEND', 'smartfields.backends.ThreadBackend')
+
+# By default asynchronous processing is done by a process wide pool of worker threads.
+ASYNC_MAX_WORKERS = getattr(settings, 'SMARTFIELDS_ASYNC_MAX_WORKERS', 4)
+
+# Number of asynchronous dependencies of a single field that are allowed to be
+# processed at the same time. Thread processing a field is helped by a process wide pool
+# of `SMARTFIELDS_ASYNC_MAX_WORKERS * (SMARTFIELDS_ASYNC_PARALLELISM - 1)` threads.
+ASYNC_PARALLELISM = getattr(settings, 'SMARTFIELDS_ASYNC_PARALLELISM', 1)
+
+# Maximum number of tasks waiting for a free worker, `0` means no limit.
+ASYNC_QUEUE_SIZE = getattr(settings, 'SMARTFIELDS_ASYNC_QUEUE_SIZE', 100)
+
+# What to do when the queue is full: 'block' - wait until a worker frees up a slot,
+# 'reject' - fail processing right away with an error status.
+ASYNC_QUEUE_FULL = getattr(settings, 'SMARTFIELDS_ASYNC_QUEUE_FULL', 'block')
+
+# Cache of files produced by file processors, keyed by a content of the source file,
+# processor and its parameters. Whenever the same file is processed again the output
+# is taken from the cache.
+FILE_CACHE = getattr(settings, 'SMARTFIELDS_FILE_CACHE', False)
+
+# Import path to a storage class for cached files, `None` means default storage.
+FILE_CACHE_STORAGE = getattr(settings, 'SMARTFIELDS_FILE_CACHE_STORAGE', None)
+
+# Directory within the storage, where cached files are kept.
+FILE_CACHE_LOCATION = getattr(settings, 'SMARTFIELDS_FILE_CACHE_LOCATION', 'smartfields_cache')
+
+# Maximum total size of cached files in bytes, least recently used files are evicted
+# once it is exceeded.
+FILE_CACHE_MAX_SIZE = getattr(settings, 'SMARTFIELDS_FILE_CACHE_MAX_SIZE', 512*1024*1024)
+
+# Number of seconds after which index of cached files is rebuilt from the storage, so
+# files added and evicted by other processes are accounted for.
+FILE_CACHE_RESCAN_INTERVAL = getattr(settings, 'SMARTFIELDS_FILE_CACHE_RESCAN_INTERVAL', 60)
+
+# Limits on the number of processors, which are using the same resource at the same
+# time on this host, ex: `{'ffmpeg': 2, 'image': 4}`. Processors declare a resource
+# they use with a `resource` attribute.
+RESOURCE_LIMITS = getattr(settings, 'SMARTFIELDS_RESOURCE_LIMITS', {})
+
+# Directory for lock files, which are used for limiting resources across processes.
+RESOURCE_LOCK_DIR = getattr(settings, 'SMARTFIELDS_RESOURCE_LOCK_DIR', None)
+
+# Minimum time in seconds between progress updates of the same dependency, that are
+# written to the cache, while it is being processed asynchronously.
+STATUS_UPDATE_INTERVAL = getattr(settings, 'SMARTFIELDS_STATUS_UPDATE_INTERVAL', 0.5)
+
+# Number of times saving is retried, whenever it fails due to a collision of unique
+# values, which were generated without checking for collisions, see `optimistic`
+# argument of `UniqueProcessor`.
+UNIQUE_MAX_RETRIES = getattr(settings, 'SMARTFIELDS_UNIQUE_MAX_RETRIES', 10)
+
+# Whether fingerprints of configurations of dependencies, that produced current values,
+# are recorded in the database, so stale values can be found and reprocessed, once
+# processors or their parameters have changed.
+DEPENDENCY_FINGERPRINTS = getattr(settings, 'SMARTFIELDS_DEPENDENCY_FINGERPRINTS', False)
@@ -1,9 +1,11 @@
-import os, errno, uuid, threading
+import os, errno, uuid, threading, logging, hashlib, inspect
+from contextlib import contextmanager
 
 from django.conf import settings
 from django.core import validators
 from django.core.files import base, temp
-from django.utils.encoding import force_text
+from django.utils.encoding import force_text, force_bytes
+import six
 from six.moves import queue as six_queue
 try:
     from django.utils.deconstruct import deconstructible
@@ -27,10 +29,12 @@ except ImportError:
 
 
 __all__ = [
-    'VALUE_NOT_SET', 'ProcessingError', 'NamedTemporaryFile', 'UploadTo',
-    'AsynchronousFileReader'
+    'VALUE_NOT_SET', 'ProcessingError', 'NamedTemporaryFile', 'StreamFile', 'UploadTo',
+    'AsynchronousFileReader', 'WorkerPool'
 ]
 
+logger = logging.getLogger('smartfields')
+
 def get_model_name(instance):
     return getattr(instance._meta, 'model_name',
                    instance._meta.object_name.lower())
@@ -38,11 +42,111 @@ def get_model_name(instance):
 def get_empty_values(field):
     return getattr(field, 'empty_values', list(validators.EMPTY_VALUES))
 
+def get_topological_order(graph):
+    """Takes a graph in a form of a list of sets, where each set contains indices of
+    nodes that the node with the same index depends on, and returns indices sorted
+    in such way that each node goes after all of it's dependencies, while preserving
+    the original order as much as possible.
+
+    """
+    order, done = [], set()
+    while len(order) < len(graph):
+        ready = [idx for idx, deps in enumerate(graph)
+                 if idx not in done and deps <= done]
+        assert ready, "Dependencies are circular."
+        order.append(ready[0])
+        done.add(ready[0])
+    return order
+
 
 class VALUE_NOT_SET(object):
     pass
 
 
+def stash_value(instance, key, value):
+    """Stashes a previous ``value`` on the ``instance``, unless there is one already
+    stashed under the same ``key``. Stash is kept per instance, so different instances
+    can be safely processed concurrently.
+
+    """
+    instance.__dict__.setdefault('_smartfields_stash', {}).setdefault(key, value)
+
+
+def get_stashed_value(instance, key):
+    return instance.__dict__.get('_smartfields_stash', {}).get(key, VALUE_NOT_SET)
+
+
+def pop_stashed_value(instance, key):
+    return instance.__dict__.get('_smartfields_stash', {}).pop(key, VALUE_NOT_SET)
+
+
+@contextmanager
+def processing_context(instance):
+    """Sets up a dictionary on an ``instance``, which processors can use to share
+    state with each other, while dependencies of a field are being processed.
+
+    """
+    context = instance.__dict__.get('_smartfields_context')
+    if context is not None:
+        yield context
+        return
+    context = instance.__dict__['_smartfields_context'] = {}
+    try:
+        yield context
+    finally:
+        instance.__dict__.pop('_smartfields_context', None)
+
+
+def get_processing_context(instance):
+    """Returns a dictionary set up by :func:`processing_context`, or ``None`` if a field
+    of the ``instance`` is not being processed at the moment.
+
+    """
+    if instance is not None:
+        return instance.__dict__.get('_smartfields_context')
+
+
+def get_content_hash(f, chunk_size=64*1024):
+    """Computes a SHA-256 hex digest of a file's content, keeping file's position intact."""
+    content_hash = hashlib.sha256()
+    cur_pos = f.tell()
+    f.seek(0)
+    while True:
+        chunk = f.read(chunk_size)
+        if not chunk:
+            break
+        content_hash.update(force_bytes(chunk))
+    f.seek(cur_pos)
+    return content_hash.hexdigest()
+
+
+def get_fingerprint(value):
+    """Returns a string representation of a ``value``, which is stable across processes,
+    hence suitable for generating cache keys. Any arguments used to construct
+    deconstructible objects, such as processors, are part of the fingerprint.
+
+    """
+    if value is None or isinstance(
+            value, (bool, float, bytes) + six.integer_types + six.string_types):
+        return repr(value)
+    if isinstance(value, dict):
+        return "{%s}" % ",".join(sorted(
+            "%s:%s" % (get_fingerprint(k), get_fingerprint(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return "[%s]" % ",".join(get_fingerprint(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return "{%s}" % ",".join(sorted(get_fingerprint(v) for v in value))
+    if inspect.isclass(value) or inspect.isroutine(value):
+        return "%s.%s" % (getattr(value, '__module__', None),
+                          getattr(value, '__qualname__', value.__name__))
+    path = get_fingerprint(type(value))
+    if hasattr(value, '_constructor_args'):
+        return "%s(%s)" % (path, get_fingerprint(value._constructor_args))
+    if hasattr(value, '__dict__'):
+        return "%s(%s)" % (path, get_fingerprint(vars(value)))
+    return "%s(%r)" % (path, value)
+
+
 class ProcessingError(Exception):
     pass
 
@@ -72,6 +176,25 @@ class NamedTemporaryFile(base.File):
             if e.errno != errno.ENOENT:
                 raise
 
+
+class StreamFile(base.File):
+    """Behaves just like `django.core.files.base.ContentFile`, except that it wraps an
+    existing in memory stream, instead of making a copy of its content.
+
+    """
+    def __bool__(self):
+        return True
+
+    def __nonzero__(self):      # Python 2 compatibility
+        return type(self).__bool__(self)
+
+    def open(self, mode=None):
+        self.seek(0)
+        return self
+
+    def close(self):
+        pass
+
 @deconstructible
 class UploadTo(object):
     """This is an upload filename generator to be used to create a function to be
@@ -230,3 +353,56 @@ class AsynchronousFileReader(threading.Thread):
     def eof(self):
         '''Check whether there is no more content to expect.'''
         return not self.is_alive() and self._queue.empty()
+
+
+class WorkerPool(object):
+    """A fixed number of daemon threads executing callables from a bounded queue.
+    Threads are started lazily, whenever a task is submitted, so a pool can be
+    safely created before the process is forked.
+
+    :keyword int max_workers: maximum number of tasks executed concurrently.
+
+    :keyword int queue_size: maximum number of tasks waiting for a free worker,
+    ``0`` means queue size is unlimited.
+
+    """
+
+    def __init__(self, max_workers, queue_size=0):
+        assert max_workers > 0, "max_workers should be a positive number"
+        self.max_workers = max_workers
+        self._queue = six_queue.Queue(maxsize=queue_size)
+        self._workers = []
+        self._lock = threading.Lock()
+
+    def submit(self, task, block=True):
+        """Puts a callable on the queue. Raises ``queue.Full`` if queue has no room
+        for a new task and ``block=False``.
+
+        """
+        assert callable(task), "task has to be a function"
+        self._start_workers()
+        self._queue.put(task, block=block)
+
+    def join(self):
+        """Blocks until all submitted tasks are done."""
+        self._queue.join()
+
+    def _start_workers(self):
+        with self._lock:
+            # threads do not survive a fork, so keep track of live ones only
+            self._workers = [w for w in self._workers if w.is_alive()]
+            while len(self._workers) < self.max_workers:
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            try:
+                task()
+            except BaseException:
+                logger.exception("Unhandled error in a smartfields worker.")
+            finally:
+                self._queue.task_done()
@@ -0,0 +1,14 @@
+import time
+
+
+def report(label, seconds, count=None):
+    if count:
+        print("%-60s %8.3fs %12.0f/s" % (label, seconds, count/seconds))
+    else:
+        print("%-60s %8.3fs" % (label, seconds))
+
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
@@ -0,0 +1,39 @@
+"""Iterating over a large queryset of a model with and without smartfields."""
+import os
+
+from django.db import connection, transaction
+
+from benchmarks import report, timed
+from test_app.models import PlainBenchmark, SmartBenchmark
+
+ROWS = int(os.environ.get('BENCHMARK_ROWS', 100000))
+
+
+def populate():
+    PlainBenchmark.objects.bulk_create([
+        PlainBenchmark(name="Name %s" % n, slug="name-%s" % n) for n in range(ROWS)])
+    with connection.cursor() as cursor:
+        cursor.execute("INSERT INTO %s (name, slug) SELECT name, slug FROM %s" % (
+            SmartBenchmark._meta.db_table, PlainBenchmark._meta.db_table))
+
+
+def iterate(queryset):
+    for _ in queryset.iterator():
+        pass
+
+
+def initialize(model):
+    # mimics loading through regular `__init__`, i.e. prior to `from_db` fast path
+    for values in model.objects.values_list('id', 'name', 'slug').iterator():
+        model(*values)
+
+
+def run():
+    with transaction.atomic():
+        populate()
+        report("plain model: %s rows" % ROWS, timed(iterate, PlainBenchmark.objects.all()), ROWS)
+        report("smartfields model: %s rows" % ROWS,
+               timed(iterate, SmartBenchmark.objects.all()), ROWS)
+        report("smartfields model, regular __init__: %s rows" % ROWS,
+               timed(initialize, SmartBenchmark), ROWS)
+        transaction.set_rollback(True)
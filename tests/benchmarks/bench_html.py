@@ -0,0 +1,36 @@
+"""Stripping tags out of a large rich text document with BeautifulSoup compared to the
+streaming engine, both for a field without a length limit and for one, where parsing
+can stop early. Size of a document is set with `BENCHMARK_HTML_SIZE` in kilobytes."""
+import os
+
+from django.db import models
+
+from benchmarks import report, timed
+from smartfields.processors import HTMLProcessor
+
+SIZE = int(os.environ.get('BENCHMARK_HTML_SIZE', 2048))
+REPEAT = int(os.environ.get('BENCHMARK_HTML_REPEAT', 3))
+
+PARAGRAPH = (
+    '<p class="lead">Turkish and his partner <b>Tommy</b> get involved with an '
+    '<a href="https://example.com/brick-top?id=1&amp;ref=2">unscrupulous</a> boxing '
+    'promoter, <i>Brick Top</i> &mdash; <em>a diamond</em> goes missing.<br/>'
+    '<!-- editor note --><span style="color: red">Bullet-Tooth</span> Tony</p>\n')
+
+
+def get_document():
+    return "<div>%s</div>" % (PARAGRAPH * (SIZE * 1024 // len(PARAGRAPH)))
+
+
+def run():
+    document = get_document()
+    dependees = [
+        ("TextField", models.TextField()),
+        ("CharField(max_length=255)", models.CharField(max_length=255)),
+    ]
+    for engine in HTMLProcessor.engines:
+        processor = HTMLProcessor(engine=engine)
+        for label, dependee in dependees:
+            seconds = timed(lambda: [processor.process(document, dependee=dependee)
+                                     for _ in range(REPEAT)])
+            report("%s engine, %s KB into %s" % (engine, SIZE, label), seconds, REPEAT)
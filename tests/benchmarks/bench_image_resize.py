@@ -0,0 +1,74 @@
+"""Downscaling a large JPEG with and without `reducing_gap` scale parameter, both on
+its own and through an image shared while a field is processed. Every variant is run
+in a separate process, so peak memory usage can be compared."""
+import os, multiprocessing, resource, tempfile, time
+
+from django.core.files.base import File
+from PIL import Image
+
+from benchmarks import report
+from smartfields.dependencies import Dependency
+from smartfields.processors import ImageProcessor
+from smartfields.utils import processing_context
+
+WIDTH, HEIGHT = (int(os.environ.get('BENCHMARK_IMAGE_WIDTH', 6000)),
+                 int(os.environ.get('BENCHMARK_IMAGE_HEIGHT', 4000)))
+ROUNDS = int(os.environ.get('BENCHMARK_ROUNDS', 3))
+
+
+class Manager(object):
+
+    def __init__(self, processor):
+        self.dependencies = [Dependency(suffix='resized', processor=processor)]
+
+
+class Field(object):
+
+    def __init__(self, processor):
+        self.manager = Manager(processor)
+
+
+class Instance(object):
+    pass
+
+
+def resize(path, scale, shared, conn):
+    processor = ImageProcessor(format='JPEG', scale=scale)
+    field, instance = Field(processor), Instance()
+    start = time.time()
+    for _ in range(ROUNDS):
+        with open(path, 'rb') as f:
+            if shared:
+                # same way processors are invoked while a field is processed
+                with processing_context(instance):
+                    processor.process(File(f), instance=instance, field=field,
+                                      **processor.get_params())
+            else:
+                processor.process(File(f), **processor.get_params())
+    conn.send((time.time() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+    conn.close()
+
+
+def run():
+    fd, path = tempfile.mkstemp(suffix='.jpg')
+    os.close(fd)
+    try:
+        Image.effect_noise((WIDTH, HEIGHT), 64).convert('RGB').save(path, 'JPEG', quality=90)
+        for label, scale, shared in [
+                ("exact", {'max_width': 320, 'max_height': 320}, False),
+                ("reducing_gap=3.0", {'max_width': 320, 'max_height': 320, 'reducing_gap': 3.0}, False),
+                ("reducing_gap=2.0", {'max_width': 320, 'max_height': 320, 'reducing_gap': 2.0}, False),
+                ("reducing_gap=1.0", {'max_width': 320, 'max_height': 320, 'reducing_gap': 1.0}, False),
+                ("exact, shared image", {'max_width': 320, 'max_height': 320}, True),
+                ("reducing_gap=2.0, shared image",
+                 {'max_width': 320, 'max_height': 320, 'reducing_gap': 2.0}, True)]:
+            parent_conn, child_conn = multiprocessing.Pipe()
+            proc = multiprocessing.Process(
+                target=resize, args=(path, scale, shared, child_conn))
+            proc.start()
+            seconds, max_rss = parent_conn.recv()
+            proc.join()
+            report("%sx%s JPEG -> 320px, %s (max RSS %s MB)" % (
+                WIDTH, HEIGHT, label, max_rss // 1024), seconds/ROUNDS)
+    finally:
+        os.remove(path)
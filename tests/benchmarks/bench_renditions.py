@@ -0,0 +1,46 @@
+"""Producing several renditions of the same image, with the source decoded once and
+shared by all of them, compared to decoding it for every rendition."""
+import os, io, time
+
+from django.core.files.base import File
+from PIL import Image
+
+from benchmarks import report
+from smartfields.processors import ImageProcessor
+from smartfields.utils import processing_context
+
+WIDTH, HEIGHT = (int(os.environ.get('BENCHMARK_IMAGE_WIDTH', 4000)),
+                 int(os.environ.get('BENCHMARK_IMAGE_HEIGHT', 3000)))
+
+PROCESSORS = [
+    ImageProcessor(format='JPEG', scale={'max_width': 2048}),
+    ImageProcessor(format='JPEG', scale={'max_width': 1024}),
+    ImageProcessor(format='JPEG', scale={'max_width': 640}),
+    ImageProcessor(format='JPEG', scale={'max_width': 320}),
+    ImageProcessor(format='PNG', scale={'max_width': 128}),
+]
+
+
+class Instance(object):
+    pass
+
+
+def render(value, instance):
+    for processor in PROCESSORS:
+        processor.process(value, instance=instance, **processor.get_params())
+
+
+def run():
+    source = io.BytesIO()
+    Image.effect_noise((WIDTH, HEIGHT), 64).convert('RGB').save(source, 'JPEG', quality=90)
+    value = File(source, name='source.jpg')
+    instance = Instance()
+    start = time.time()
+    render(value, instance)
+    report("%s renditions of %sx%s JPEG, decoded each time" % (
+        len(PROCESSORS), WIDTH, HEIGHT), time.time() - start)
+    start = time.time()
+    with processing_context(instance):
+        render(value, instance)
+    report("%s renditions of %sx%s JPEG, shared image" % (
+        len(PROCESSORS), WIDTH, HEIGHT), time.time() - start)
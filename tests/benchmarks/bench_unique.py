@@ -0,0 +1,73 @@
+"""Saving instances with a unique slug into a table, where the same slug is already
+taken many times, with candidates picked from a single query compared to checking
+candidates one by one. Every query is delayed by `BENCHMARK_DB_LATENCY` milliseconds,
+to account for a round trip to a database server, that in-memory SQLite doesn't have."""
+import os, time
+
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from benchmarks import report, timed
+from test_app.models import UniqueBenchmark
+
+COLLISIONS = int(os.environ.get('BENCHMARK_COLLISIONS', 9000))
+SAVES = int(os.environ.get('BENCHMARK_SAVES', 200))
+LATENCY = float(os.environ.get('BENCHMARK_DB_LATENCY', 0.5))
+
+
+def delay(execute, sql, params, many, context):
+    time.sleep(LATENCY/1000)
+    return execute(sql, params, many, context)
+
+
+def populate():
+    with connection.cursor() as cursor:
+        cursor.executemany(
+            "INSERT INTO %s (name, slug) VALUES (%%s, %%s)" % UniqueBenchmark._meta.db_table,
+            [("Untitled", "untitled")] + [
+                ("Untitled", "untitled-%s" % n) for n in range(COLLISIONS)])
+
+
+def save():
+    for _ in range(SAVES):
+        UniqueBenchmark.objects.create(name="Untitled")
+
+
+def check_one_by_one(processor):
+    # picking candidates the way it was done prior to a single query, i.e. one
+    # `exists()` query for every random candidate
+    manager = UniqueBenchmark._default_manager
+    def get_taken(instance, dependee, value, prefix, iexact=False):
+        if not manager.filter(**{'%s__iexact' % dependee.name: value}).exists():
+            return set()
+        return set([value])
+    def get_number(value, taken, padding, strategy, iexact=False):
+        for _ in range(processor.max_attempts):
+            number = processor.get_random(padding)
+            if not manager.filter(slug__iexact="%s-%s" % (value, number)).exists():
+                return number
+    processor.get_taken, processor.get_number = get_taken, get_number
+
+
+def run():
+    processor = UniqueBenchmark._meta.get_field('slug').manager.dependencies[0]._processor
+    variants = [
+        ("exists() per candidate", lambda: check_one_by_one(processor)),
+        ("single query, random", lambda: setattr(processor, 'strategy', 'random')),
+        ("single query, counter", lambda: setattr(processor, 'strategy', 'counter')),
+    ]
+    for label, setup in variants:
+        with transaction.atomic():
+            populate()
+            setup()
+            try:
+                with CaptureQueriesContext(connection) as queries, \
+                     connection.execute_wrapper(delay):
+                    seconds = timed(save)
+            finally:
+                processor.__dict__.pop('get_taken', None)
+                processor.__dict__.pop('get_number', None)
+                processor.__dict__.pop('strategy', None)
+            report("%s: %s taken, %.1f queries/save" % (
+                label, COLLISIONS, float(len(queries))/SAVES), seconds, SAVES)
+            transaction.set_rollback(True)
@@ -6,6 +6,7 @@ from decimal import Decimal, InvalidOperation
 
 from smartfields import fields, processors
 from smartfields.dependencies import Dependency, FileDependency
+from smartfields.query import SmartfieldsManager
 from smartfields.utils import UploadTo
 
 # PRE PROCESSING
@@ -79,6 +80,44 @@ class TextTesting(models.Model):
     ])
     html_plain = fields.TextField()
 
+
+class OptimisticTesting(models.Model):
+    title = fields.CharField(max_length=32)
+    slug = fields.SlugField(max_length=9, unique=True, dependencies=[
+        Dependency(default=_title_getter, processor=processors.SlugProcessor(optimistic=True))
+    ])
+
+
+class BulkTesting(models.Model):
+    title = fields.CharField(max_length=32, dependencies=[
+        Dependency(attname='slug', processor=processors.SlugProcessor)
+    ])
+    slug = models.SlugField(max_length=9, unique=True)
+    image = fields.ImageField(upload_to=UploadTo(name='image'), blank=True, dependencies=[
+        FileDependency(suffix='thumb', processor=processors.ImageProcessor(
+            format=processors.ImageFormat('PNG'), scale={'max_width': 50}))
+    ])
+
+    objects = SmartfieldsManager()
+
+# ASYNC PROCESSING TESTING
+
+class JoinUpperProcessor(processors.BaseProcessor):
+
+    def process(self, value, instance, **kwargs):
+        return "%s %s" % (value, instance.title_upper)
+
+
+class AsyncTesting(models.Model):
+
+    title = fields.CharField(max_length=32, dependencies=[
+        Dependency(suffix='joined', default='', async_=True, processor=JoinUpperProcessor,
+                   after=['upper']),
+        Dependency(suffix='upper', default='', async_=True, processor=ToUpperProcessor),
+        Dependency(suffix='lower', default='', async_=True, processor=processors.BaseProcessor),
+    ])
+
+
 # FILE TESTING
 
 
@@ -110,6 +149,11 @@ class FileTesting(models.Model):
     field_4 = fields.FileField(upload_to='testing', keep_orphans=True)
 
 
+class AsyncFileTesting(models.Model):
+    field_1 = fields.FileField(upload_to='testing', dependencies=[
+        FileDependency(suffix='lower', async_=True, processor=_file_to_lower)
+    ])
+
 
 class ImageTesting(models.Model):
     image_1 = models.ImageField(
@@ -178,6 +222,30 @@ class DependencyTesting(models.Model):
     image_4 = fields.ImageField(upload_to=UploadTo(name='image_4'))
 
 
+class DraftImageTesting(models.Model):
+    # source is decoded at a reduced size, which is large enough for both renditions
+    image = fields.ImageField(upload_to=UploadTo(name='image'), dependencies=[
+        FileDependency(suffix='large', processor=processors.ImageProcessor(
+            format=processors.ImageFormat('PNG'), scale={'width':100, 'reducing_gap':2.0})),
+        FileDependency(suffix='small', processor=processors.ImageProcessor(
+            format=processors.ImageFormat('PNG'), scale={'width':50, 'reducing_gap':2.0})),
+    ])
+
+
+class FingerprintTesting(models.Model):
+    # values, which are the same as previous ones, are not processed again
+    title = fields.CharField(max_length=32, fingerprint=True, dependencies=[
+        Dependency(suffix='upper', processor=ToUpperProcessor)
+    ])
+    title_upper = models.CharField(max_length=32)
+    image = fields.ImageField(
+        upload_to=UploadTo(name='image'), blank=True, fingerprint=True, dependencies=[
+            FileDependency(suffix='thumb', processor=processors.ImageProcessor(
+                format=processors.ImageFormat('PNG'), scale={'max_width': 50}))
+        ])
+    image_fingerprint = models.CharField(max_length=64, blank=True)
+
+
 def _name_getter(name, instance):
     return instance.label
 
@@ -197,6 +265,15 @@ video_tag_processor = processors.HTMLTagProcessor(template=
     '<source type="video/mp4" src="{base_url}{instance.video_1_mp4.url}"/></video>')
 
 
+class HTMLTagTesting(models.Model):
+    # tag is rendered once and stored in the database together with a file
+    document = fields.FileField(upload_to='testing', blank=True, dependencies=[
+        Dependency(suffix='html_tag', processor=processors.HTMLTagProcessor(
+            template='<a href="{base_url}{value.url}">{value.name_base}</a>'))
+    ])
+    document_html_tag = models.TextField(blank=True)
+
+
 class VideoTesting(models.Model):
 
     video_1 = fields.FileField(
@@ -218,3 +295,65 @@ class VideoTesting(models.Model):
     def has_upload_permission(self, user, field_name=None):
         is_auth = user.is_authenticated if django.VERSION >= (1, 10) else user.is_authenticated()
         return (field_name == 'video_1' and is_auth and user.username == 'test_user')
+
+
+class MultiOutputVideoTesting(models.Model):
+    # testing transcoding into multiple formats with a single ffmpeg process
+    video_1 = fields.FileField(
+        upload_to=UploadTo(name='video_1'), dependencies=[
+            FileDependency(suffix='webm', async_=True, processor=processors.FFMPEGProcessor(
+                multi_output=True, format='webm', vcodec='libvpx', vbitrate='128k',
+                maxrate='128k', bufsize='256k', width='trunc(oh*a/2)*2', height=240,
+                threads=4, acodec='libvorbis')),
+            FileDependency(suffix='mp4', async_=True, processor=processors.FFMPEGProcessor(
+                multi_output=True, format='mp4', vcodec='libx264', vbitrate='128k',
+                maxrate='128k', bufsize='256k', width='trunc(oh*a/2)*2', height=240,
+                threads=0, acodec='libmp3lame')),
+            FileDependency(suffix='ogv', async_=True, processor=processors.FFMPEGProcessor(
+                format='ogv', vcodec='libtheora', vbitrate='128k', maxrate='128k',
+                bufsize='256k', width='trunc(oh*a/2)*2', height=240, threads=0,
+                acodec='libvorbis')),
+        ])
+
+
+class SuffixProcessor(processors.BaseProcessor):
+    # processors of the same field append all of their suffixes in one call
+
+    def get_group_key(self):
+        return type(self)
+
+    def process_many(self, value, jobs, **kwargs):
+        return ["%s_%s" % (value, params['suffix']) for _, params in jobs]
+
+
+class GroupTesting(models.Model):
+    title = fields.CharField(max_length=32, dependencies=[
+        Dependency(suffix='foo', default='', processor=SuffixProcessor(suffix='foo')),
+        Dependency(suffix='bar', default='', processor=SuffixProcessor(suffix='bar')),
+    ])
+
+
+# BENCHMARKING
+
+def _benchmark_name_getter(value, instance, **kwargs):
+    return instance.name
+
+
+class PlainBenchmark(models.Model):
+    name = models.CharField(max_length=64)
+    slug = models.SlugField(max_length=64)
+
+
+class SmartBenchmark(models.Model):
+    name = fields.CharField(max_length=64)
+    slug = fields.SlugField(max_length=64, dependencies=[
+        Dependency(default=_benchmark_name_getter, pre_processor=processors.SlugProcessor)
+    ])
+
+
+class UniqueBenchmark(models.Model):
+    name = fields.CharField(max_length=64)
+    # leaves room for 4 digits, once a slug is taken
+    slug = fields.SlugField(max_length=40, unique=True, dependencies=[
+        Dependency(default=_benchmark_name_getter, processor=processors.SlugProcessor)
+    ])
@@ -1,9 +1,14 @@
+from test_suite.test_async import *
+from test_suite.test_cache import *
+from test_suite.test_commands import *
 from test_suite.test_crispy import *
 from test_suite.test_fields import *
 from test_suite.test_files import *
 from test_suite.test_misc import *
 from test_suite.test_pre_processing import *
 from test_suite.test_processors import *
+from test_suite.test_query import *
+from test_suite.test_resources import *
 from test_suite.test_text import *
 from test_suite.test_utils import *
 from test_suite.test_view import *
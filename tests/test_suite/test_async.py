@@ -0,0 +1,273 @@
+import os, shutil, threading, time
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
+from six.moves import queue
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from smartfields.backends import get_worker_pool, get_helper_pool
+from smartfields.backends.database import DatabaseBackend
+from smartfields.dependencies import Dependency
+from smartfields.managers import AsyncHandler
+from smartfields.models import ProcessingTask
+from smartfields.utils import WorkerPool, ProcessingError, get_topological_order
+
+from test_app.models import AsyncTesting, AsyncFileTesting
+from test_suite.test_files import add_base
+
+
+class WorkerPoolTestCase(TestCase):
+
+    def test_bounded_workers(self):
+        pool = WorkerPool(2)
+        lock = threading.Lock()
+        state = {'running': 0, 'max_running': 0}
+        def task():
+            with lock:
+                state['running']+= 1
+                state['max_running'] = max(state['max_running'], state['running'])
+            time.sleep(0.01)
+            with lock:
+                state['running']-= 1
+        for _ in range(10):
+            pool.submit(task)
+        pool.join()
+        self.assertEqual(state['running'], 0)
+        self.assertEqual(state['max_running'], 2)
+
+    def test_reject(self):
+        pool = WorkerPool(1, queue_size=1)
+        release = threading.Event()
+        pool.submit(release.wait)
+        # wait for the worker to pick up the first task, so second one stays queued
+        while pool._queue.qsize():
+            time.sleep(0.001)
+        pool.submit(release.wait)
+        self.assertRaises(queue.Full, pool.submit, release.wait, block=False)
+        release.set()
+        pool.join()
+
+    def test_failing_task(self):
+        pool = WorkerPool(1)
+        results = []
+        def failing():
+            raise ValueError("foo")
+        pool.submit(failing)
+        pool.submit(lambda: results.append('bar'))
+        pool.join()
+        self.assertEqual(results, ['bar'])
+
+
+class AsyncProcessingTestCase(TestCase):
+
+    def test_async_processing(self):
+        instance = AsyncTesting.objects.create(title='foo')
+        get_worker_pool().join()
+        self.assertEqual(instance.title_upper, 'FOO')
+        self.assertEqual(instance.title_joined, 'foo FOO')
+        self.assertEqual(instance.smartfields_get_field_status('title')['state'], 'complete')
+        self.assertEqual(instance.smartfields_get_field_status('title')['state'], 'ready')
+
+    def test_parallel_processing(self):
+        manager = AsyncTesting._meta.get_field('title').manager
+        self.assertEqual(manager.get_async_graph(), [set([1]), set(), set()])
+        for _ in range(10):
+            instance = AsyncTesting(title='bar')
+            AsyncHandler(manager, instance, parallelism=3).run()
+            self.assertEqual(instance.title_upper, 'BAR')
+            self.assertEqual(instance.title_lower, 'bar')
+            self.assertEqual(instance.title_joined, 'bar BAR')
+
+    def test_helper_pool(self):
+        manager = AsyncTesting._meta.get_field('title').manager
+        threads = set()
+        process = manager._process
+        def process_spy(*args, **kwargs):
+            threads.add(threading.current_thread())
+            return process(*args, **kwargs)
+        with mock.patch.object(manager, '_process', process_spy):
+            for _ in range(10):
+                AsyncHandler(manager, AsyncTesting(title='bar'), parallelism=3).run()
+        # no threads are started for a field, a shared pool helps the caller instead
+        self.assertLessEqual(
+            threads, set(get_helper_pool()._workers) | set([threading.current_thread()]))
+        instance = AsyncTesting(title='bar')
+        def failing(*args, **kwargs):
+            raise ValueError("foo")
+        with mock.patch.object(manager, '_process', failing):
+            self.assertRaises(ValueError, AsyncHandler(manager, instance, parallelism=3).run)
+        self.assertEqual(instance.smartfields_get_field_status('title')['state'], 'error')
+
+    def test_concurrent_progress(self):
+        manager = AsyncTesting._meta.get_field('title').manager
+        dependency = manager.dependencies[1]
+        started = []
+        def process(processor, value, **kwargs):
+            started.append(value)
+            # both instances are being processed by the same processor at this point
+            while len(started) < 2:
+                time.sleep(0.001)
+            processor.set_progress(0.5)
+            return value.upper()
+        reported = {}
+        def process_instance(title):
+            def progress_setter(processor, progress, **info):
+                reported[title].append(progress)
+            reported[title] = []
+            manager._process(dependency, AsyncTesting(title=title),
+                             progress_setter=progress_setter)
+        with mock.patch.object(type(dependency._processor), 'process', process):
+            threads = [threading.Thread(target=process_instance, args=(title,))
+                       for title in ['foo', 'bar']]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(reported, {'foo': [0, 0.5, 1], 'bar': [0, 0.5, 1]})
+        self.assertFalse(hasattr(dependency._processor, 'progress_setter'))
+
+    def test_progress(self):
+        manager = AsyncTesting._meta.get_field('title').manager
+        instance = AsyncTesting(title='bar')
+        handler = AsyncHandler(manager, instance)
+        setters = [handler.get_progress_setter(0.25, idx) for idx in range(4)]
+        setters[2](None, 1)
+        setters[0](None, 0.5)
+        self.assertEqual(manager.get_status(instance)['progress'], 0.375)
+
+    def test_progress_throttling(self):
+        manager = AsyncTesting._meta.get_field('title').manager
+        instance = AsyncTesting(title='bar')
+        handler = AsyncHandler(manager, instance, status_interval=60)
+        setter = handler.get_progress_setter(0.5, 0)
+        setter(None, 0)
+        setter(None, 0.5, fps=24.0)
+        self.assertEqual(manager.get_status(instance)['progress'], 0)
+        # progress of other dependencies is not throttled
+        handler.get_progress_setter(0.5, 1)(None, 0.5, fps=30.0)
+        status = manager.get_status(instance)
+        self.assertEqual((status['progress'], status['fps']), (0.5, 30.0))
+        setter(None, 1)
+        self.assertEqual(manager.get_status(instance)['progress'], 0.75)
+
+
+class DependencyGraphTestCase(TestCase):
+
+    def test_topological_order(self):
+        self.assertEqual(get_topological_order([set(), set(), set()]), [0, 1, 2])
+        self.assertEqual(get_topological_order([set([2]), set([0]), set()]), [2, 0, 1])
+        self.assertRaises(AssertionError, get_topological_order, [set([1]), set([0])])
+
+    def test_after(self):
+        d1 = Dependency(suffix='foo', processor=lambda x: x, after=['bar'])
+        d2 = Dependency(attname='bar', processor=lambda x: x)
+        self.assertTrue(d1.is_after(d2))
+        self.assertFalse(d2.is_after(d1))
+
+
+class DatabaseBackendTestCase(TransactionTestCase):
+
+    def setUp(self):
+        self.backend = DatabaseBackend()
+        self.patcher = mock.patch(
+            'smartfields.managers.get_backend', return_value=self.backend)
+        self.patcher.start()
+
+    def tearDown(self):
+        self.patcher.stop()
+
+    def test_queue(self):
+        instance = AsyncTesting.objects.create(title='foo')
+        task = ProcessingTask.objects.get()
+        self.assertEqual(str(task), "test_app.asynctesting-%s-title" % instance.pk)
+        self.assertEqual(task.state, ProcessingTask.PENDING)
+        self.assertEqual(instance.smartfields_get_field_status('title')['state'], 'queued')
+        call_command('smartfields_worker', once=True, verbosity=0)
+        self.assertFalse(ProcessingTask.objects.exists())
+        self.assertEqual(instance.smartfields_get_field_status('title')['state'], 'complete')
+
+    def test_stale_tasks(self):
+        AsyncTesting.objects.create(title='foo')
+        task = self.backend.claim()
+        self.assertEqual(ProcessingTask.objects.get(pk=task.pk).state, ProcessingTask.RUNNING)
+        self.assertIsNone(self.backend.claim())
+        self.assertEqual(self.backend.requeue_stale(3600), 0)
+        self.assertEqual(self.backend.requeue_stale(-1), 1)
+        self.assertEqual(self.backend.work(once=True), 1)
+        self.assertFalse(ProcessingTask.objects.exists())
+
+
+class DatabaseBackendStashTestCase(TransactionTestCase):
+    media_path = add_base("media")
+
+    def setUp(self):
+        self.tearDown()
+        os.makedirs(self.media_path)
+        self.backend = DatabaseBackend()
+        patcher = mock.patch('smartfields.managers.get_backend', return_value=self.backend)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        if os.path.exists(self.media_path): shutil.rmtree(self.media_path)
+
+    def replace_file(self):
+        instance = AsyncFileTesting.objects.create(
+            field_1=ContentFile(b"FOO", name="foo.txt"))
+        call_command('smartfields_worker', once=True, verbosity=0)
+        instance = AsyncFileTesting.objects.get(pk=instance.pk)
+        old_paths = [instance.field_1.path, instance.field_1_lower.path]
+        instance.field_1 = ContentFile(b"BAR", name="bar.txt")
+        instance.save()
+        # previous values are kept until the task is done
+        for path in old_paths:
+            self.assertTrue(os.path.isfile(path))
+        self.assertTrue(ProcessingTask.objects.get().stash)
+        return instance, old_paths
+
+    def test_enqueue_on_commit(self):
+        instance = AsyncFileTesting.objects.create(
+            field_1=ContentFile(b"FOO", name="foo.txt"))
+        call_command('smartfields_worker', once=True, verbosity=0)
+        instance = AsyncFileTesting.objects.get(pk=instance.pk)
+        claimed = []
+        do_update = AsyncFileTesting._do_update
+        def _do_update(*args, **kwargs):
+            # a worker polling right before the row is updated
+            claimed.append(self.backend.claim())
+            return do_update(*args, **kwargs)
+        with mock.patch.object(AsyncFileTesting, '_do_update', _do_update):
+            with transaction.atomic():
+                instance.field_1 = ContentFile(b"BAR", name="bar.txt")
+                instance.save()
+                claimed.append(self.backend.claim())
+        self.assertEqual(claimed, [None, None])
+        call_command('smartfields_worker', once=True, verbosity=0)
+        instance = AsyncFileTesting.objects.get(pk=instance.pk)
+        self.assertEqual(instance.field_1.read(), b"BAR")
+        self.assertEqual(instance.field_1_lower.read(), b"bar")
+
+    def test_cleanup(self):
+        instance, old_paths = self.replace_file()
+        call_command('smartfields_worker', once=True, verbosity=0)
+        instance = AsyncFileTesting.objects.get(pk=instance.pk)
+        self.assertEqual(instance.field_1_lower.read(), b"bar")
+        for path in old_paths:
+            self.assertFalse(os.path.isfile(path))
+
+    def test_restore(self):
+        instance, old_paths = self.replace_file()
+        new_path = instance.field_1.path
+        with mock.patch('smartfields.managers.FieldManager._process',
+                        side_effect=ProcessingError("boom")):
+            call_command('smartfields_worker', once=True, verbosity=0)
+        instance = AsyncFileTesting.objects.get(pk=instance.pk)
+        self.assertEqual([instance.field_1.path, instance.field_1_lower.path], old_paths)
+        for path in old_paths:
+            self.assertTrue(os.path.isfile(path))
+        self.assertFalse(os.path.isfile(new_path))
+        self.assertEqual(instance.smartfields_get_field_status('field_1')['state'], 'error')
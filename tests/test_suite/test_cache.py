@@ -0,0 +1,127 @@
+import os, time
+from django.core.files.base import File, ContentFile
+from django.core.files.storage import default_storage
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from smartfields import processors
+from smartfields.cache import FileCache
+
+from test_app.models import DependencyTesting
+from test_suite.test_files import FileBaseTestCase, add_base
+
+
+class FileCacheTestCase(FileBaseTestCase):
+
+    def test_processing_cache(self):
+        file_cache = FileCache(location='smartfields_cache')
+        lenna_rect = File(open(add_base("media/static/images/lenna_rect.jpg"), 'rb'))
+        with mock.patch('smartfields.dependencies.get_file_cache', return_value=file_cache):
+            instance_1 = DependencyTesting.objects.create(image_2=lenna_rect)
+            self.assertEqual((file_cache.hits, file_cache.misses), (0, 2))
+            self.assertEqual(len(file_cache), 2)
+            with mock.patch.object(processors.ImageProcessor, 'process') as process:
+                instance_2 = DependencyTesting.objects.create(image_2=lenna_rect)
+                self.assertFalse(process.called)
+            self.assertEqual((file_cache.hits, file_cache.misses), (2, 2))
+        lenna_rect.close()
+        self.assertEqual(instance_2.image_3.width, 100)
+        self.assertEqual(instance_2.image_4.width, 150)
+        # cached output is copied over, rather than shared
+        self.assertNotEqual(instance_1.image_3.path, instance_2.image_3.path)
+        self.assertEqual(instance_1.image_3.size, instance_2.image_3.size)
+        instance_1.delete()
+        self.assertTrue(os.path.isfile(instance_2.image_3.path))
+        instance_2.delete()
+        # cache recovers its index from the storage
+        file_cache = FileCache(location='smartfields_cache')
+        self.assertEqual(len(file_cache), 2)
+        file_cache.clear()
+        self.assertEqual(len(file_cache), 0)
+        self.assertEqual(default_storage.listdir('smartfields_cache'), ([], []))
+
+    def test_lru_eviction(self):
+        file_cache = FileCache(location='smartfields_cache', max_size=10)
+        file_cache.set('a', ContentFile(b"aaaa", name="a.txt"))
+        file_cache.set('b', ContentFile(b"bbbb", name="b.txt"))
+        self.assertEqual(file_cache.get('a').read(), b"aaaa")
+        file_cache.set('c', ContentFile(b"cccc", name="c.txt"))
+        # 'b' is least recently used
+        self.assertIsNone(file_cache.get('b'))
+        self.assertEqual(file_cache.get('c').read(), b"cccc")
+        self.assertEqual(file_cache.size, 8)
+        self.assertEqual((file_cache.hits, file_cache.misses, file_cache.evictions), (2, 1, 1))
+        self.assertFalse(default_storage.exists('smartfields_cache/b.txt'))
+
+    def test_cached_file(self):
+        file_cache = FileCache(location='smartfields_cache')
+        file_cache.set('a', ContentFile(b"aaaa", name="a.txt"))
+        opened = []
+        storage_open = default_storage.open
+        def open_spy(*args, **kwargs):
+            opened.append(storage_open(*args, **kwargs))
+            return opened[-1]
+        with mock.patch.object(default_storage, 'open', side_effect=open_spy):
+            cached_file = file_cache.get('a')
+        # file in the cache is closed right away, a temporary copy is returned instead
+        self.assertTrue(opened[0].closed)
+        self.assertTrue(hasattr(cached_file, 'temporary_file_path'))
+        self.assertEqual(cached_file.read(), b"aaaa")
+        path = cached_file.temporary_file_path()
+        cached_file.close()
+        self.assertFalse(os.path.exists(path))
+        # file, that is already in the cache, is not saved under another name
+        FileCache(location='smartfields_cache').set('a', ContentFile(b"aaaa", name="a.txt"))
+        self.assertEqual(default_storage.listdir('smartfields_cache'), ([], ['a.txt']))
+
+    def test_shared_max_size(self):
+        # caches stand in for different processes sharing the same storage
+        file_cache_1 = FileCache(location='smartfields_cache', max_size=10, rescan_interval=0)
+        file_cache_2 = FileCache(location='smartfields_cache', max_size=10, rescan_interval=0)
+        file_cache_1.set('a', ContentFile(b"aaaa", name="a.txt"))
+        file_cache_2.set('b', ContentFile(b"bbbb", name="b.txt"))
+        file_cache_1.get('a').close()
+        file_cache_1.set('c', ContentFile(b"cccc", name="c.txt"))
+        self.assertEqual(sorted(default_storage.listdir('smartfields_cache')[1]),
+                         ['a.txt', 'c.txt'])
+        self.assertEqual(file_cache_1.size, 8)
+
+    def test_rescan_interval(self):
+        file_cache = FileCache(location='smartfields_cache', max_size=10, rescan_interval=60)
+        file_cache.set('a', ContentFile(b"aaaa", name="a.txt"))
+        other_cache = FileCache(location='smartfields_cache', max_size=10)
+        other_cache.set('b', ContentFile(b"bbbb", name="b.txt"))
+        with mock.patch.object(default_storage, 'listdir') as listdir:
+            with mock.patch.object(default_storage, 'size') as size:
+                file_cache.set('c', ContentFile(b"cc", name="c.txt"))
+        # index is updated in place, rather than rebuilt from the storage
+        self.assertFalse(listdir.called)
+        self.assertFalse(size.called)
+        self.assertEqual((len(file_cache), file_cache.size), (2, 6))
+        with mock.patch('smartfields.cache.time.time', return_value=time.time() + 60):
+            file_cache.set('d', ContentFile(b"dd", name="d.txt"))
+        # files added by another process are accounted for once interval is up
+        names = default_storage.listdir('smartfields_cache')[1]
+        self.assertEqual(len(names), 3)
+        self.assertIn('c.txt', names)
+        self.assertIn('d.txt', names)
+        self.assertEqual(file_cache.size, 8)
+
+    def test_cache_key(self):
+        file_cache = FileCache(location='smartfields_cache')
+        processor = processors.ImageProcessor(format='PNG')
+        key = file_cache.get_key(ContentFile(b"foo"), processor, {'scale': {'width': 10}})
+        self.assertEqual(
+            key, file_cache.get_key(ContentFile(b"foo"), processors.ImageProcessor(
+                format='PNG'), {'scale': {'width': 10}}))
+        self.assertNotEqual(
+            key, file_cache.get_key(ContentFile(b"bar"), processor, {'scale': {'width': 10}}))
+        self.assertNotEqual(
+            key, file_cache.get_key(ContentFile(b"foo"), processor, {'scale': {'width': 20}}))
+        self.assertNotEqual(
+            key, file_cache.get_key(ContentFile(b"foo"), processors.ImageProcessor(
+                format='GIF'), {'scale': {'width': 10}}))
+        self.assertFalse(file_cache.is_cacheable(
+            ContentFile(b"foo"), processors.RenameFileProcessor()))
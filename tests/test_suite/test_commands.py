@@ -0,0 +1,234 @@
+import json, os, shutil, tempfile, warnings
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from six import StringIO
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from smartfields import processors
+from smartfields.dependencies import Dependency
+from smartfields.models import DependencyFingerprint
+
+from test_app.models import TextTesting
+
+
+class ReprocessCommandTestCase(TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.checkpoint = os.path.join(self.tmp_dir, 'checkpoint.json')
+        self.pks = [TextTesting.objects.create(title="title %s" % idx,
+                                               summary="<b>foo %s</b>" % idx).pk
+                    for idx in range(5)]
+        # simulate outdated values
+        TextTesting.objects.update(summary_plain='', summary_beginning='')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def reprocess(self, *args, **kwargs):
+        out = StringIO()
+        kwargs.setdefault('verbosity', 1)
+        call_command('smartfields_reprocess', 'test_app.TextTesting', *args,
+                     stdout=out, **kwargs)
+        return out.getvalue()
+
+    def get_plain(self):
+        return list(TextTesting.objects.order_by('pk').values_list(
+            'summary_plain', flat=True))
+
+    def test_reprocess(self):
+        out = self.reprocess('summary', chunk_size=2)
+        self.assertEqual(self.get_plain(), ["foo %s" % idx for idx in range(5)])
+        self.assertEqual(
+            list(TextTesting.objects.values_list('summary_beginning', flat=True)),
+            ["foo %s" % idx for idx in range(5)])
+        self.assertIn("Reprocessed 5 instance(s) of test_app.TextTesting", out)
+        self.assertIn("0 failed", out)
+
+    def test_resume(self):
+        with open(self.checkpoint, 'w') as f:
+            json.dump({'model': 'test_app.TextTesting', 'fields': ['summary'],
+                       'last_pk': self.pks[2], 'processed': 3}, f)
+        out = self.reprocess('summary', chunk_size=1, checkpoint=self.checkpoint)
+        self.assertIn("Resuming after pk=%s" % self.pks[2], out)
+        self.assertEqual(self.get_plain(), ['', '', '', "foo 3", "foo 4"])
+        self.assertFalse(os.path.exists(self.checkpoint))
+        # checkpoint of some other run
+        with open(self.checkpoint, 'w') as f:
+            json.dump({'model': 'test_app.TextTesting', 'fields': ['title'],
+                       'last_pk': self.pks[2], 'processed': 3}, f)
+        self.assertRaises(CommandError, self.reprocess, 'summary',
+                          checkpoint=self.checkpoint)
+
+    def test_interrupted(self):
+        calls = []
+        def save(instance, *args, **kwargs):
+            if len(calls) == 3:
+                raise KeyboardInterrupt
+            calls.append(instance.pk)
+            return original_save(instance, *args, **kwargs)
+        original_save = TextTesting.save
+        with mock.patch.object(TextTesting, 'save', save):
+            self.assertRaises(KeyboardInterrupt, self.reprocess, 'summary',
+                              chunk_size=2, checkpoint=self.checkpoint)
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f)['last_pk'], self.pks[1])
+        self.reprocess('summary', chunk_size=2, checkpoint=self.checkpoint)
+        self.assertEqual(self.get_plain(), ["foo %s" % idx for idx in range(5)])
+
+    def test_failures(self):
+        def smartfields_process(instance, field_names=None):
+            if instance.pk == self.pks[1]:
+                raise ValueError("broken")
+            return original(instance, field_names)
+        original = TextTesting.smartfields_process
+        err = StringIO()
+        with mock.patch.object(TextTesting, 'smartfields_process', smartfields_process):
+            out = self.reprocess('summary', stderr=err)
+        self.assertIn("1 failed", out)
+        self.assertIn("Failed to reprocess pk=%s: ValueError: broken" % self.pks[1],
+                      err.getvalue())
+        self.assertEqual(self.get_plain(), ['foo 0', '', 'foo 2', 'foo 3', 'foo 4'])
+
+    def test_retry_failed(self):
+        def smartfields_process(instance, field_names=None):
+            if instance.pk in self.pks[1:3]:
+                raise ValueError("broken")
+            return original(instance, field_names)
+        original = TextTesting.smartfields_process
+        with mock.patch.object(TextTesting, 'smartfields_process', smartfields_process):
+            out = self.reprocess('summary', chunk_size=2, checkpoint=self.checkpoint,
+                                 stderr=StringIO())
+        self.assertIn("2 failed", out)
+        # checkpoint is kept for the failed instances
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f)['failed'], [str(pk) for pk in self.pks[1:3]])
+        out = self.reprocess('summary', checkpoint=self.checkpoint)
+        self.assertIn("2 failed instance(s) are skipped", out)
+        self.assertEqual(self.get_plain(), ['foo 0', '', '', 'foo 3', 'foo 4'])
+        self.assertTrue(os.path.exists(self.checkpoint))
+        out = self.reprocess('summary', checkpoint=self.checkpoint, retry_failed=True)
+        self.assertIn("Retrying 2 failed instance(s).", out)
+        self.assertIn("Reprocessed 2 instance(s)", out)
+        self.assertEqual(self.get_plain(), ["foo %s" % idx for idx in range(5)])
+        self.assertFalse(os.path.exists(self.checkpoint))
+        self.assertRaises(CommandError, self.reprocess, 'summary', retry_failed=True)
+
+    def test_dry_run(self):
+        out = self.reprocess('summary', 'summary_plain', chunk_size=2, dry_run=True)
+        self.assertEqual(self.get_plain(), [''] * 5)
+        self.assertIn("5 instance(s) of test_app.TextTesting would be reprocessed in "
+                      "3 chunk(s) by 1 worker(s)", out)
+        self.assertIn("summary: HTMLProcessor", out)
+        self.assertIn("summary_plain: CropProcessor", out)
+        self.assertIn("10 processor invocation(s) in total", out)
+
+    def test_max_rate(self):
+        with mock.patch('time.sleep') as sleep:
+            self.reprocess('summary', chunk_size=1, max_rate=1000000)
+            self.assertFalse(sleep.called)
+            self.reprocess('summary', chunk_size=1, max_rate=1)
+            self.assertEqual(sleep.call_count, 5)
+
+    def test_errors(self):
+        self.assertRaises(CommandError, self.reprocess, 'foo')
+        self.assertRaises(CommandError, call_command, 'smartfields_reprocess',
+                          'test_app.Missing', verbosity=0)
+        self.assertRaises(CommandError, self.reprocess, chunk_size=0)
+
+
+class StaleDependenciesTestCase(TestCase):
+
+    def setUp(self):
+        for module in ['smartfields.managers', 'smartfields.models',
+                       'smartfields.management.commands.smartfields_reprocess']:
+            patcher = mock.patch('%s.DEPENDENCY_FINGERPRINTS' % module, True)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.pks = [TextTesting.objects.create(title="title %s" % idx,
+                                               summary="<b>foo %s</b>" % idx).pk
+                    for idx in range(3)]
+        self.dependency = TextTesting._meta.get_field('summary').manager.dependencies[0]
+
+    def test_config_fingerprint(self):
+        fingerprints = [Dependency(processor=processors.CropProcessor(padding=padding))
+                        .get_config_fingerprint() for padding in [1, 1, 2]]
+        self.assertEqual(fingerprints[0], fingerprints[1])
+        self.assertNotEqual(fingerprints[0], fingerprints[2])
+        processor = processors.ImageProcessor()
+        fingerprint = Dependency(processor=processor).get_config_fingerprint()
+        with mock.patch.object(processor, 'get_version', return_value='0.0.1'):
+            self.assertNotEqual(Dependency(processor=processor).get_config_fingerprint(),
+                                fingerprint)
+
+    def test_stale(self):
+        instance = TextTesting.objects.get(pk=self.pks[0])
+        fields = ['title', 'slug', 'summary', 'summary_plain']
+        self.assertEqual(instance.smartfields_get_stale(fields), {})
+        self.assertEqual(set(DependencyFingerprint.objects.filter(
+            object_pk=str(instance.pk)).values_list('field_name', 'dependency')), set([
+                ('title', 'title'), ('slug', 'slug'), ('summary', 'summary_plain'),
+                ('summary_plain', 'summary_beginning')]))
+        # fields, that were never set, were never processed either
+        self.assertEqual(sorted(instance.smartfields_get_stale()), ['html', 'loopback'])
+        with mock.patch.object(self.dependency, 'get_config_fingerprint',
+                               return_value='changed'):
+            self.assertEqual(instance.smartfields_get_stale(fields),
+                             {'summary': [self.dependency]})
+            TextTesting.objects.filter(pk=instance.pk).update(summary_plain='')
+            instance = TextTesting.objects.get(pk=instance.pk)
+            with self.assertNumQueries(0):
+                instance.smartfields_process_stale(stale={'summary': [self.dependency]})
+            self.assertEqual(instance.summary_plain, 'foo 0')
+            instance.save()
+            self.assertEqual(instance.smartfields_get_stale(fields), {})
+        # values, that were never recorded, are stale
+        DependencyFingerprint.objects.filter(object_pk=str(instance.pk)).delete()
+        self.assertEqual(sorted(instance.smartfields_get_stale(['summary', 'title'])),
+                         ['summary', 'title'])
+
+    def test_delete(self):
+        instance = TextTesting.objects.get(pk=self.pks[0])
+        self.assertTrue(DependencyFingerprint.objects.filter(object_pk=str(instance.pk)))
+        # deferred fields are forgotten too
+        TextTesting.objects.defer('summary').get(pk=instance.pk).delete()
+        self.assertFalse(DependencyFingerprint.objects.filter(object_pk=str(self.pks[0])))
+        self.assertEqual(DependencyFingerprint.objects.filter(
+            object_pk=str(self.pks[1])).count(), 4)
+
+    def test_reprocess_stale(self):
+        TextTesting.objects.update(summary_plain='', summary_beginning='')
+        out = StringIO()
+        with mock.patch.object(self.dependency, 'get_config_fingerprint',
+                               return_value='changed'):
+            call_command('smartfields_reprocess', 'test_app.TextTesting', 'summary',
+                         'summary_plain', stale_only=True, dry_run=True, stdout=out)
+            self.assertIn("3 instance(s) have stale dependencies", out.getvalue())
+            self.assertIn("summary: HTMLProcessor x3", out.getvalue())
+            self.assertIn("3 processor invocation(s) in total", out.getvalue())
+            call_command('smartfields_reprocess', 'test_app.TextTesting', 'summary',
+                         'summary_plain', stale_only=True, stdout=out)
+            self.assertIn("Reprocessed 3 instance(s)", out.getvalue())
+            self.assertEqual(
+                list(TextTesting.objects.order_by('pk').values_list(
+                    'summary_plain', 'summary_beginning')),
+                [("foo %s" % idx, "foo %s" % idx) for idx in range(3)])
+            out = StringIO()
+            call_command('smartfields_reprocess', 'test_app.TextTesting', 'summary',
+                         'summary_plain', stale_only=True, stdout=out)
+            self.assertIn("Reprocessed 0 instance(s)", out.getvalue())
+
+    def test_fingerprints_off(self):
+        with mock.patch('smartfields.management.commands.smartfields_reprocess.'
+                        'DEPENDENCY_FINGERPRINTS', False):
+            self.assertRaises(CommandError, call_command, 'smartfields_reprocess',
+                              'test_app.TextTesting', stale_only=True, verbosity=0)
+        with mock.patch('smartfields.models.DEPENDENCY_FINGERPRINTS', False), \
+             warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            TextTesting.objects.get(pk=self.pks[0]).smartfields_get_stale()
+        self.assertEqual([w.category for w in caught], [RuntimeWarning])
@@ -3,8 +3,16 @@ from django.core.files.base import File
 from django.conf import settings
 from django.test import TestCase
 from django.utils.encoding import force_bytes
+from PIL import JpegImagePlugin
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
-from test_app.models import FileTesting, ImageTesting, DependencyTesting, RenameFileTesting
+from smartfields import processors
+
+from test_app.models import FileTesting, ImageTesting, DependencyTesting, RenameFileTesting, \
+    HTMLTagTesting, FingerprintTesting, DraftImageTesting
 
 
 def add_base(path):
@@ -105,6 +113,60 @@ class FileTestCase(FileBaseTestCase):
         # testing keep_orphans=True
         self.assertTrue(os.path.isfile(field_4_path))
 
+    def test_deferred_file_field(self):
+        instance = FileTesting.objects.create()
+        foo_bar = File(open(add_base("media/static/defaults/foo-bar.txt"), 'r'))
+        instance.field_1 = foo_bar
+        instance.save()
+        foo_bar.close()
+        field_1_path = instance.field_1.path
+        field_1_foo_path = instance.field_1_foo.path
+        with self.assertNumQueries(1):
+            instance = FileTesting.objects.only('pk').get(pk=instance.pk)
+        # dependent attribute initializes the deferred field it depends on
+        with self.assertNumQueries(1):
+            self.assertEqual(instance.field_1_foo.path, field_1_foo_path)
+            self.assertEqual(instance.field_1.path, field_1_path)
+        self.assertEqual(instance.bar.url, "/static/defaults/bar.txt")
+        # files are cleaned up, even if fields were deferred
+        instance = FileTesting.objects.only('pk').get(pk=instance.pk)
+        instance.delete()
+        self.assertFalse(os.path.isfile(field_1_path))
+        self.assertFalse(os.path.isfile(field_1_foo_path))
+
+    def test_html_tag(self):
+        instance = HTMLTagTesting.objects.create(
+            document=File(open(add_base("static/defaults/foo.txt"), 'rb'), name="foo.txt"))
+        instance.document.close()
+        tag = '<a href="//example.com/media/testing/foo.txt">foo.txt</a>'
+        self.assertEqual(instance.document_html_tag, tag)
+        # stored, so reading it doesn't render it again
+        processor = HTMLTagTesting._meta.get_field('document').manager.dependencies[0]._processor
+        with mock.patch.object(processor, 'render') as render, self.assertNumQueries(1):
+            instance = HTMLTagTesting.objects.get(pk=instance.pk)
+            self.assertEqual(instance.document.html_tag, tag)
+            self.assertFalse(render.called)
+        instance.document = None
+        instance.save()
+        self.assertEqual(HTMLTagTesting.objects.get(pk=instance.pk).document_html_tag, "")
+
+    def test_html_tag_base_url(self):
+        processor = processors.HTMLTagProcessor(template='{base_url}/{value}')
+        with mock.patch('smartfields.processors.text.Site.objects.get_current') as current:
+            current.return_value.domain = 'example.org'
+            tags = [processor.process(n, None, None) for n in range(3)]
+            # lazy, until it is accessed
+            self.assertFalse(current.called)
+            self.assertEqual([str(tag) for tag in tags],
+                             ['//example.org/0', '//example.org/1', '//example.org/2'])
+            self.assertEqual(current.call_count, 1)
+            processor = processors.HTMLTagProcessor(template='{base_url}/{value}', lazy=False)
+            self.assertEqual(processor.process('foo', None, None), '//example.org/foo')
+            processor = processors.HTMLTagProcessor(
+                template='{base_url}/{value}', base_url='http://cdn')
+            self.assertEqual(str(processor.process('foo', None, None)), 'http://cdn/foo')
+            self.assertEqual(current.call_count, 2)
+
 
 class ImageTestCase(FileBaseTestCase):
 
@@ -247,6 +309,41 @@ class ImageTestCase(FileBaseTestCase):
         self.assertEqual(instance.image_4.path, image_4.path)
         instance.delete()
 
+    def test_shared_image(self):
+        lenna_rect = File(open(add_base("media/static/images/lenna_rect.jpg"), 'rb'))
+        instance = DependencyTesting()
+        instance.image_2 = lenna_rect
+        get_image = processors.ImageProcessor.get_image
+        with mock.patch.object(processors.ImageProcessor, 'get_image', autospec=True,
+                               side_effect=get_image) as spy:
+            instance.save()
+        lenna_rect.close()
+        # source is decoded once for both renditions
+        self.assertEqual(spy.call_count, 1)
+        self.assertEqual(instance.image_3.width, 100)
+        self.assertEqual(instance.image_4.width, 150)
+        self.assertNotIn('_smartfields_context', instance.__dict__)
+        instance.delete()
+
+    def test_shared_image_draft(self):
+        lenna_rect = File(open(add_base("media/static/images/lenna_rect.jpg"), 'rb'))
+        instance = DraftImageTesting()
+        instance.image = lenna_rect
+        drafts = []
+        draft = JpegImagePlugin.JpegImageFile.draft
+        def draft_spy(image, mode, size):
+            result = draft(image, mode, size)
+            drafts.append((size, image.size))
+            return result
+        with mock.patch.object(JpegImagePlugin.JpegImageFile, 'draft', draft_spy):
+            instance.save()
+        lenna_rect.close()
+        # 400x225 source is decoded at half the size, still twice as big as both
+        self.assertEqual(drafts, [((200, 112), (200, 113))])
+        self.assertEqual((instance.image_large.width, instance.image_large.height), (100, 56))
+        self.assertEqual((instance.image_small.width, instance.image_small.height), (50, 28))
+        instance.delete()
+
     def test_forward_dependency(self):
         instance = DependencyTesting.objects.create()
         lenna_rect = File(open(add_base("media/static/images/lenna_rect.jpg"), 'rb'))
@@ -302,3 +399,68 @@ class ImageTestCase(FileBaseTestCase):
         self.assertTrue(os.path.isfile(bar_path))
         instance.delete()
         self.assertFalse(os.path.isfile(bar_path))
+
+
+class FingerprintTestCase(FileBaseTestCase):
+
+    def open_image(self, name):
+        return File(open(add_base("media/static/images/%s" % name), 'rb'), name=name)
+
+    def get_files(self, instance):
+        path = os.path.dirname(instance.image.path)
+        return sorted(os.path.relpath(os.path.join(root, name), path)
+                      for root, _, names in os.walk(path) for name in names)
+
+    def get_processor(self, name):
+        return FingerprintTesting._meta.get_field(name).manager.dependencies[0]._processor
+
+    def test_scalar(self):
+        instance = FingerprintTesting.objects.create(title='foo')
+        self.assertEqual(instance.title_upper, 'FOO')
+        instance = FingerprintTesting.objects.get(pk=instance.pk)
+        with mock.patch.object(self.get_processor('title'), 'process') as process:
+            instance.title = 'foo'
+            instance.save()
+            self.assertFalse(process.called)
+        self.assertEqual(instance.title_upper, 'FOO')
+        instance.title = 'bar'
+        instance.save()
+        self.assertEqual(instance.title_upper, 'BAR')
+
+    def test_file(self):
+        image = self.open_image('lenna_rect.jpg')
+        instance = FingerprintTesting.objects.create(image=image)
+        image.close()
+        fingerprint = instance.image_fingerprint
+        self.assertEqual(len(fingerprint), 64)
+        self.assertEqual(instance.image_thumb.width, 50)
+        files = self.get_files(instance)
+        image_name, thumb_name = instance.image.name, instance.image_thumb.name
+        instance = FingerprintTesting.objects.get(pk=instance.pk)
+        # same bytes uploaded again, with and without a stored fingerprint
+        for stored in [fingerprint, '']:
+            FingerprintTesting.objects.update(image_fingerprint=stored)
+            instance = FingerprintTesting.objects.get(pk=instance.pk)
+            image = self.open_image('lenna_rect.jpg')
+            with mock.patch.object(self.get_processor('image'), 'process') as process:
+                instance.image = image
+                instance.save()
+                self.assertFalse(process.called)
+            image.close()
+            instance = FingerprintTesting.objects.get(pk=instance.pk)
+            self.assertEqual(instance.image.name, image_name)
+            self.assertEqual(instance.image_thumb.name, thumb_name)
+            # missing fingerprint is filled in
+            self.assertEqual(instance.image_fingerprint, fingerprint)
+            self.assertEqual(self.get_files(instance), files)
+        # different image is processed
+        image = self.open_image('lenna_square.png')
+        instance.image = image
+        instance.save()
+        image.close()
+        instance = FingerprintTesting.objects.get(pk=instance.pk)
+        self.assertNotEqual(instance.image.name, image_name)
+        self.assertNotEqual(instance.image_fingerprint, fingerprint)
+        self.assertEqual(len(instance.image_fingerprint), 64)
+        self.assertEqual(instance.image_thumb.width, 50)
+        self.assertEqual(instance.image_thumb.height, 50)
@@ -1,11 +1,31 @@
 from django.test import TestCase
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
 from smartfields.dependencies import FileDependency
 
+from test_app.models import TextTesting
+
 class MiscTestCase(TestCase):
 
     def test_file_dependency(self):
         self.assertEqual(
             FileDependency(storage='foo', upload_to='somewhere', keep_orphans=True),
             FileDependency(storage='foo', upload_to='somewhere', keep_orphans=True)
-        )
\ No newline at end of file
+        )
+
+    def test_compiled_model(self):
+        managers = TextTesting._smartfields_managers_list
+        self.assertIsInstance(managers, tuple)
+        self.assertEqual([m.field.name for m in managers], [
+            'title', 'slug', 'summary', 'summary_plain', 'loopback', 'html'])
+        self.assertIs(TextTesting().smartfields_managers, managers)
+        summary = TextTesting._meta.get_field('summary')
+        summary_plain = TextTesting._meta.get_field('summary_plain')
+        self.assertEqual(summary.manager.sync_dependencies, tuple(summary.manager.dependencies))
+        self.assertEqual(summary.manager.async_dependencies, ())
+        with mock.patch.object(TextTesting._meta, 'get_field') as get_field:
+            self.assertIs(summary.manager.dependencies[0]._dependee, summary_plain)
+            self.assertFalse(get_field.called)
@@ -1,5 +1,11 @@
 from decimal import Decimal
 from django.test import TestCase
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from smartfields.processors import SlugProcessor
 
 from test_app.models import PreProcessorTesting
 
@@ -26,3 +32,14 @@ class PreProcessingTestCase(TestCase):
     def test_slug(self):
         instance = PreProcessorTesting(field_3='Foo%BAR')
         self.assertEqual(instance.field_3, 'foobar')
+
+    def test_loading_from_db(self):
+        instance = PreProcessorTesting(field_3='Foo BAR')
+        instance.field_1 = "56.1"
+        instance.save()
+        with mock.patch.object(SlugProcessor, 'process') as process:
+            instance = PreProcessorTesting.objects.get(pk=instance.pk)
+            self.assertFalse(process.called)
+            self.assertEqual(instance.field_3, 'foo-bar')
+            instance.field_3 = 'Bar'
+            self.assertTrue(process.called)
@@ -1,6 +1,23 @@
+import io, os, shutil, subprocess, sys, tempfile, threading, time
+from django.core.files.base import File, ContentFile
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import TemporaryUploadedFile
 from django.test import TestCase
+from PIL import Image, JpegImagePlugin
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
-from smartfields.processors import ImageProcessor, ImageFormat
+from smartfields.managers import AsyncHandler
+from smartfields.processors import ImageProcessor, ImageFormat, ExternalFileProcessor, \
+    FFMPEGProcessor
+from smartfields.processors.base import LineReader
+from smartfields.resources import ResourceLimiter
+from smartfields.utils import ProcessingError, processing_context
+
+from test_app.models import GroupTesting, MultiOutputVideoTesting, SuffixProcessor
+from test_suite.test_files import FileBaseTestCase, add_base
 
 class ImageProcessorsTestCase(TestCase):
 
@@ -83,3 +100,354 @@ class ImageProcessorsTestCase(TestCase):
         p = ImageProcessor()
         self.assertIsNone(p.get_ext())
         self.assertEquals(p.get_ext(format=ImageFormat('TIFF', ext='')), '')
+
+    def test_image_input_output(self):
+        p = ImageProcessor(format=ImageFormat('PNG'), scale={'width': 100})
+        path = add_base("static/images/lenna_rect.jpg")
+        # image is read directly from a temporary file
+        upload = TemporaryUploadedFile('lenna_rect.jpg', 'image/jpeg', 0, None)
+        with open(path, 'rb') as f:
+            shutil.copyfileobj(f, upload)
+        stream, is_opened = p.open_stream(upload)
+        self.assertTrue(is_opened)
+        self.assertEqual(stream.name, upload.temporary_file_path())
+        stream.close()
+        upload.close()
+        # as well as from a file handle, which keeps its position
+        with open(path, 'rb') as f:
+            f.seek(10)
+            image_file = File(f)
+            stream, is_opened = p.open_stream(image_file)
+            self.assertIs(stream, f)
+            self.assertFalse(is_opened)
+            out = p.process(image_file, **p.get_params())
+            self.assertEqual(f.tell(), 10)
+        self.assertTrue(out)
+        self.assertIsInstance(out.file, io.BytesIO)
+        self.assertEqual(Image.open(out).size, (100, 56))
+        # non seekable streams are buffered
+        r, w = os.pipe()
+        os.write(w, b"foo")
+        os.close(w)
+        with os.fdopen(r, 'rb') as f:
+            stream, is_opened = p.open_stream(File(f))
+        self.assertTrue(is_opened)
+        self.assertEqual(stream.getvalue(), b"foo")
+
+    def test_fast_downscaling(self):
+        source = io.BytesIO()
+        Image.linear_gradient('L').resize((1600, 1200)).convert('RGB').save(source, 'JPEG')
+        self.assertRaises(AssertionError, ImageProcessor(scale={'reducing_gap': 0.5}).check_params)
+        p = ImageProcessor(format='PNG', scale={'width': 100, 'reducing_gap': 2.0})
+        p.check_params()
+        drafts = []
+        draft = JpegImagePlugin.JpegImageFile.draft
+        def draft_spy(image, mode, size):
+            result = draft(image, mode, size)
+            drafts.append((size, image.size))
+            return result
+        with mock.patch.object(JpegImagePlugin.JpegImageFile, 'draft', draft_spy):
+            out = p.process(File(source), **p.get_params())
+        # decoded at 1/8 of the size, which is still at least twice as big
+        self.assertEqual(drafts, [((200, 150), (200, 150))])
+        self.assertEqual(Image.open(out).size, (100, 75))
+        # quality path is unaffected
+        p = ImageProcessor(format='PNG', scale={'width': 100})
+        with mock.patch.object(JpegImagePlugin.JpegImageFile, 'draft', draft_spy):
+            out = p.process(File(source), **p.get_params())
+        self.assertEqual(len(drafts), 1)
+        self.assertEqual(Image.open(out).size, (100, 75))
+
+    def test_shared_image(self):
+        source = io.BytesIO()
+        Image.linear_gradient('L').resize((1600, 1200)).save(source, 'PNG')
+        value = File(source, name='source.png')
+        class Instance(object): pass
+        instance = Instance()
+        large = ImageProcessor(format='PNG', scale={'width': 400})
+        small = ImageProcessor(format='PNG', scale={'width': 100})
+        resized = []
+        resize_to = ImageProcessor.resize_to
+        def resize_to_spy(processor, image, size, **kwargs):
+            resized.append((image.size, size))
+            return resize_to(processor, image, size, **kwargs)
+        with mock.patch.object(ImageProcessor, 'resize_to', resize_to_spy):
+            with processing_context(instance):
+                out_large = large.process(value, instance=instance, **large.get_params())
+                out_small = small.process(value, instance=instance, **small.get_params())
+            self.assertEqual(Image.open(out_large).size, (400, 300))
+            self.assertEqual(Image.open(out_small).size, (100, 75))
+            # smaller rendition is produced from the larger one
+            self.assertEqual(resized, [((1600, 1200), (400, 300)), ((400, 300), (100, 75))])
+            # without a processing context source is decoded every time
+            del resized[:]
+            small.process(value, instance=instance, **small.get_params())
+            self.assertEqual(resized, [((1600, 1200), (100, 75))])
+
+
+SCRIPT = """import sys, time
+sys.stdout.write("foo\\nbar\\rbaz")
+sys.stdout.flush()
+sys.stderr.write("error\\n")
+sys.stderr.flush()
+time.sleep(float(sys.argv[1]))
+sys.stdout.write("\\nlast")
+"""
+
+
+class ExternalFileProcessorTestCase(TestCase):
+
+    def setUp(self):
+        fd, self.script = tempfile.mkstemp(suffix='.py')
+        with os.fdopen(fd, 'w') as f:
+            f.write(SCRIPT)
+
+    def tearDown(self):
+        os.remove(self.script)
+
+    def get_processor(self, stdout_handler, stderr_handler):
+        class Processor(ExternalFileProcessor):
+            pass
+        Processor.stdout_handler = staticmethod(stdout_handler)
+        Processor.stderr_handler = staticmethod(stderr_handler)
+        return Processor(cmd_template="%s %s {sleep}" % (sys.executable, self.script))
+
+    def test_output_handlers(self):
+        stdout, stderr = [], []
+        def stdout_handler(line, count=0):
+            stdout.append((line, count))
+            return (count + 1,)
+        p = self.get_processor(stdout_handler, stderr.append)
+        start = time.time()
+        p.execute([sys.executable, self.script, '0'])
+        # no polling delays
+        self.assertLess(time.time() - start, p.sleep_time)
+        self.assertEqual(stdout, [
+            ("foo\n", 0), ("bar\n", 1), ("baz\n", 2), ("last", 3)])
+        self.assertEqual(stderr, ["error\n"])
+
+    def test_processing_error(self):
+        def stdout_handler(line):
+            raise ProcessingError("Invalid output")
+        p = self.get_processor(stdout_handler, None)
+        start = time.time()
+        self.assertRaises(ProcessingError, p.execute, [sys.executable, self.script, '10'])
+        # process is terminated right away
+        self.assertLess(time.time() - start, 5)
+
+
+class FFMPEGProcessorTestCase(FileBaseTestCase):
+
+    def test_multi_output(self):
+        manager = MultiOutputVideoTesting._meta.get_field('video_1').manager
+        webm, mp4, ogv = manager.dependencies
+        self.assertEqual(webm.group, (webm, mp4))
+        self.assertIs(mp4.group, webm.group)
+        self.assertIsNone(ogv.group)
+        commands = []
+        def execute(processor, cmd):
+            commands.append(cmd)
+            for arg in cmd:
+                if arg.startswith(tempfile.gettempdir()):
+                    with open(arg, 'wb') as f:
+                        f.write(arg.rsplit('.', 1)[-1].encode())
+        name = default_storage.save('video_1/foo.mov', ContentFile(b'video'))
+        for parallelism in (1, 3):
+            instance = MultiOutputVideoTesting(video_1=name)
+            with mock.patch.object(FFMPEGProcessor, 'execute', autospec=True,
+                                   side_effect=execute):
+                AsyncHandler(manager, instance, parallelism=parallelism).run()
+            self.assertEqual(len(commands), 2)
+            multi_cmd, single_cmd = sorted(commands, key=len, reverse=True)
+            self.assertEqual(multi_cmd.count('-i'), 1)
+            self.assertEqual(multi_cmd.count('-codec:v'), 2)
+            self.assertIn('libvpx', multi_cmd)
+            self.assertIn('libx264', multi_cmd)
+            self.assertEqual(single_cmd.count('-codec:v'), 1)
+            for suffix in ('webm', 'mp4', 'ogv'):
+                field_file = getattr(instance, 'video_1_%s' % suffix)
+                self.assertTrue(field_file.name.endswith('.%s' % suffix))
+                with field_file as f:
+                    f.open('rb')
+                    self.assertEqual(f.read(), suffix.encode())
+            self.assertEqual(manager.get_status(instance)['state'], 'complete')
+            del commands[:]
+
+    def test_multi_output_progress(self):
+        manager = MultiOutputVideoTesting._meta.get_field('video_1').manager
+        webm, mp4, ogv = manager.dependencies
+        instance = MultiOutputVideoTesting()
+        handler = AsyncHandler(manager, instance)
+        group_setter = handler.get_progress_setter(2.0/3, ('group', id(webm.group)))
+        group_setter(None, 0.75)
+        # a dependency of the group, which starts later, doesn't reset the progress
+        group_setter(None, 0)
+        self.assertEqual(manager.get_status(instance)['progress'], 0.5)
+        self.assertRaises(AssertionError, FFMPEGProcessor,
+                          cmd_template="ffmpeg -i {input} {output}", multi_output=True)
+
+    def test_group_with_lone_progress(self):
+        manager = MultiOutputVideoTesting._meta.get_field('video_1').manager
+        webm, mp4, ogv = manager.dependencies
+        instance = MultiOutputVideoTesting()
+        handler = AsyncHandler(manager, instance)
+        # group weighs as much as both of its dependencies
+        group_setter = handler.get_progress_setter(2.0/3, ('group', id(webm.group)))
+        lone_setter = handler.get_progress_setter(1.0/3, 2)
+        lone_setter(None, 1)
+        self.assertAlmostEqual(manager.get_status(instance)['progress'], 1.0/3)
+        group_setter(None, 0.5)
+        self.assertAlmostEqual(manager.get_status(instance)['progress'], 2.0/3)
+        lone_setter(None, 1)
+        self.assertAlmostEqual(manager.get_status(instance)['progress'], 2.0/3)
+        group_setter(None, 1)
+        self.assertAlmostEqual(manager.get_status(instance)['progress'], 1)
+
+    def test_selected_group_dependencies(self):
+        manager = GroupTesting._meta.get_field('title').manager
+        foo, bar = manager.dependencies
+        self.assertEqual(foo.group, (foo, bar))
+        instance = GroupTesting(title='title')
+        process_many = SuffixProcessor.process_many
+        with mock.patch.object(SuffixProcessor, 'process_many', autospec=True,
+                               side_effect=process_many) as mocked:
+            manager.process(instance, force=True)
+            self.assertEqual((instance.title_foo, instance.title_bar),
+                             ('title_foo', 'title_bar'))
+            self.assertEqual(len(mocked.call_args[0][2]), 2)
+            # outputs are not produced for dependencies, that are not processed
+            instance.title = 'other'
+            manager.process(instance, force=True, dependencies=[bar])
+            self.assertEqual(len(mocked.call_args[0][2]), 1)
+        self.assertEqual((instance.title_foo, instance.title_bar),
+                         ('title_foo', 'other_bar'))
+
+    def test_progress_pipe(self):
+        reported = []
+        p = FFMPEGProcessor(progress_pipe=True).with_progress_setter(
+            lambda processor, progress, **info: reported.append((progress, info)))
+        reader = LineReader(p.stdout_handler, (8.0,))
+        reader.feed(b"frame=96\nfps=24.00\nbitrate=1024.0kbits/s\ntotal_size=N/A\n"
+                    b"out_time_us=4000000\nout_time_ms=4000000\nspeed=2.0x\n"
+                    b"progress=continue\nframe=192\nout_time_us=8000000\nprogress=end\n")
+        reader.feed(b'')
+        self.assertEqual(reported, [
+            (0.5, {'frame': 96, 'fps': 24.0, 'bitrate': '1024.0kbits/s', 'speed': '2.0x'}),
+            (0.99, {'frame': 192})
+        ])
+        # without duration there is no progress
+        del reported[:]
+        reader = LineReader(p.stdout_handler, (None,))
+        reader.feed(b"out_time_us=4000000\nprogress=continue\n")
+        self.assertEqual(reported, [])
+        self.assertRaises(ProcessingError, p.error_handler,
+                          "foo.mov: Invalid data found when processing input")
+
+    def test_get_duration(self):
+        p = FFMPEGProcessor(progress_pipe=True)
+        in_file = mock.Mock(path='/foo/bar.mov')
+        with mock.patch('subprocess.check_output', return_value=b"12.5\n") as check_output:
+            self.assertEqual(p.get_duration(in_file), 12.5)
+            self.assertEqual(check_output.call_args[0][0][-1], '/foo/bar.mov')
+        with mock.patch('subprocess.check_output', return_value=b"N/A\n"):
+            self.assertIsNone(p.get_duration(in_file))
+        with mock.patch('subprocess.check_output', side_effect=OSError):
+            self.assertIsNone(p.get_duration(in_file))
+        with mock.patch('subprocess.check_output',
+                        side_effect=subprocess.CalledProcessError(1, 'ffprobe')):
+            self.assertRaises(ProcessingError, p.get_duration, in_file)
+        with mock.patch.object(p, 'get_duration', return_value=12.5), \
+             mock.patch.object(p, 'execute') as execute:
+            p.transcode(in_file, ['ffmpeg', '-i', '/foo/bar.mov', 'out.webm'])
+            execute.assert_called_once_with(
+                ['ffmpeg'] + p.progress_args + ['-i', '/foo/bar.mov', 'out.webm'],
+                stdout_args=(12.5,))
+
+    def test_segmented_transcoding(self):
+        p = FFMPEGProcessor(segment_time=10, segment_workers=2, format='webm',
+                            vcodec='libvpx', vbitrate='128k', maxrate='128k',
+                            bufsize='256k', width=320, height=240, threads=1,
+                            acodec='libvorbis')
+        self.assertTrue(p.progress_pipe)
+        self.assertRaises(AssertionError, FFMPEGProcessor, segment_time=10,
+                          multi_output=True)
+        reported = []
+        p.progress_setter = lambda processor, progress, **info: reported.append(progress)
+        def run(cmd):
+            if '-segment_time' in cmd:
+                self.assertEqual(cmd[cmd.index('-segment_time') + 1], '10')
+                for idx in range(3):
+                    with open(cmd[-1] % idx, 'wb') as f:
+                        f.write(b'segment_%d ' % idx)
+            else:
+                with open(cmd[cmd.index('-i') + 1]) as list_file, \
+                     open(cmd[-1], 'wb') as out_file:
+                    for line in list_file:
+                        with open(line.strip()[6:-1], 'rb') as f:
+                            out_file.write(f.read())
+        def execute(cmd, stdout_args=()):
+            self.assertEqual(cmd[1:1 + len(p.progress_args)], p.progress_args)
+            self.assertEqual(stdout_args[0], 10.0)
+            with open(cmd[cmd.index('-i') + 1], 'rb') as in_file, \
+                 open(cmd[-1], 'wb') as out_file:
+                out_file.write(in_file.read().replace(b'segment', b'webm'))
+            stdout_args[2](0.5)
+        in_file = mock.Mock(path='/foo/bar.mov')
+        with mock.patch.object(p, 'run', side_effect=run), \
+             mock.patch.object(p, 'execute', side_effect=execute):
+            out_file = p.process(in_file, instance=MultiOutputVideoTesting(),
+                                 field=MultiOutputVideoTesting._meta.get_field('video_1'),
+                                 **p.default_params)
+        self.assertTrue(out_file.name.endswith('.webm'))
+        with open(out_file.name, 'rb') as f:
+            self.assertEqual(f.read(), b'webm_0 webm_1 webm_2 ')
+        os.remove(out_file.name)
+        self.assertEqual(len(reported), 6)
+        self.assertEqual(sorted(reported), reported)
+        self.assertEqual(reported[-1], 0.99)
+
+    def test_segmented_transcoding_slots(self):
+        p = FFMPEGProcessor(segment_time=10, segment_workers=4, format='webm',
+                            vcodec='libvpx', vbitrate='128k', maxrate='128k',
+                            bufsize='256k', width=320, height=240, threads=1,
+                            acodec='libvorbis')
+        lock_dir = tempfile.mkdtemp()
+        limiter = ResourceLimiter('ffmpeg', 3, lock_dir=lock_dir)
+        lock, running = threading.Lock(), [0, 0]
+        def run(cmd):
+            if '-segment_time' in cmd:
+                for idx in range(6):
+                    with open(cmd[-1] % idx, 'wb') as f:
+                        f.write(b'segment_%d ' % idx)
+            else:
+                open(cmd[-1], 'wb').close()
+        def execute(cmd, stdout_args=()):
+            with lock:
+                running[0]+= 1
+                running[1] = max(running)
+            time.sleep(0.05)
+            with lock:
+                running[0]-= 1
+        instance = MultiOutputVideoTesting()
+        def transcode(*slots):
+            running[1] = 0
+            with mock.patch('smartfields.processors.video.get_resource_limiter',
+                            return_value=limiter), \
+                 mock.patch.object(p, 'run', side_effect=run), \
+                 mock.patch.object(p, 'execute', side_effect=execute) as mocked:
+                out_file = p.process(mock.Mock(path='/foo/bar.mov'), instance=instance,
+                                     field=instance._meta.get_field('video_1'),
+                                     **p.default_params)
+                self.assertEqual(mocked.call_count, 6)
+            os.remove(out_file.name)
+            for slot in slots:
+                limiter.release(slot)
+            return running[1]
+        try:
+            # one slot is held by the dependency, so only two more processes can be run
+            self.assertEqual(transcode(limiter.acquire()), 3)
+            # the rest is taken by others, segments are transcoded one by one
+            self.assertEqual(
+                transcode(limiter.acquire(), limiter.acquire(), limiter.acquire()), 1)
+        finally:
+            shutil.rmtree(lock_dir)
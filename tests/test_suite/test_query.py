@@ -0,0 +1,115 @@
+import re, threading
+from django.core.files.base import File
+from django.db import connection, connections
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from smartfields import query
+from smartfields.query import SmartfieldsQuerySet
+
+from test_app.models import BulkTesting
+from test_suite.test_files import FileBaseTestCase, add_base
+
+
+class BulkProcessingTestCase(FileBaseTestCase):
+
+    def get_selects(self, queries):
+        return [q['sql'] for q in queries if q['sql'].startswith('SELECT')]
+
+    def test_bulk_create(self):
+        BulkTesting.objects.create(title='Snatch')
+        with CaptureQueriesContext(connection) as queries:
+            BulkTesting.objects.bulk_create(
+                [BulkTesting(title='Snatch') for _ in range(5)] +
+                [BulkTesting(title='Lord of War') for _ in range(3)])
+        # single query for collisions of the whole batch
+        self.assertEqual(len(self.get_selects(queries)), 1)
+        slugs = list(BulkTesting.objects.values_list('slug', flat=True))
+        self.assertEqual(len(set(slugs)), 9)
+        self.assertEqual(len([s for s in slugs if re.match(r'^snatch-\d$', s)]), 5)
+        self.assertIn('lord-of-w', slugs)
+        self.assertEqual(len([s for s in slugs if re.match(r'^lord-of-\d$', s)]), 2)
+
+    def test_bulk_files(self):
+        # instances are processed concurrently, so each needs a file of its own
+        images = [File(open(add_base("media/static/images/lenna_rect.jpg"), 'rb'),
+                       name="lenna_rect.jpg") for _ in range(4)]
+        closed = []
+        close_all = connections.close_all
+        def close_spy():
+            closed.append(threading.current_thread())
+            close_all()
+        with mock.patch.object(connections, 'close_all', side_effect=close_spy):
+            instances = BulkTesting.objects.bulk_create(
+                [BulkTesting(title='Image', image=image) for image in images], workers=3)
+        # every worker closes its own connection
+        self.assertEqual(len(set(closed)), 3)
+        self.assertNotIn(threading.current_thread(), closed)
+        for image in images:
+            image.close()
+        for instance in instances:
+            self.assertEqual(instance.image_thumb.width, 50)
+        self.assertEqual(len(set(instance.image_thumb.path for instance in instances)), 4)
+        instance = BulkTesting.objects.get(slug=instances[0].slug)
+        self.assertEqual(instance.image.width, 400)
+
+    def test_bulk_update(self):
+        instances = BulkTesting.objects.bulk_create(
+            [BulkTesting(title='Title %s' % n) for n in range(3)])
+        instances = list(BulkTesting.objects.order_by('pk'))
+        for instance in instances:
+            instance.title = 'Snatch'
+        BulkTesting.objects.bulk_update(instances, ['title'])
+        slugs = list(BulkTesting.objects.order_by('pk').values_list('slug', flat=True))
+        self.assertEqual(slugs, [instance.slug for instance in instances])
+        self.assertEqual(slugs[0], 'snatch')
+        self.assertEqual(len(set(slugs)), 3)
+        # updating to the same value doesn't collide with itself
+        self.assertEqual(BulkTesting.objects.filter(slug='snatch').update(title='Snatch'), 1)
+        self.assertEqual(BulkTesting.objects.filter(slug='snatch').count(), 1)
+        # instances are loaded in chunks
+        with mock.patch.object(SmartfieldsQuerySet, 'update_chunk_size', 2), \
+             CaptureQueriesContext(connection) as queries:
+            self.assertEqual(BulkTesting.objects.update(title='Lord of War'), 3)
+        self.assertEqual(len([sql for sql in self.get_selects(queries)
+                              if 'LIMIT 2' in sql]), 3)
+        slugs = set(BulkTesting.objects.values_list('slug', flat=True))
+        self.assertEqual(len(slugs), 3)
+        self.assertIn('lord-of-w', slugs)
+        # expressions are written as is
+        BulkTesting.objects.update(title=F('slug'))
+        self.assertEqual(set(BulkTesting.objects.values_list('title', flat=True)), slugs)
+
+    def test_bulk_update_fallback(self):
+        BulkTesting.objects.bulk_create([BulkTesting(title='Title %s' % n) for n in range(2)])
+        instances = list(BulkTesting.objects.order_by('pk'))
+        for instance in instances:
+            instance.title = 'Snatch'
+        # django<2.2 has no `QuerySet.bulk_update`
+        with mock.patch.object(query, '_has_bulk_update', False):
+            self.assertEqual(BulkTesting.objects.bulk_update(instances, ['title']), 2)
+            self.assertEqual(BulkTesting.objects.update(title='Lord of War'), 2)
+        slugs = list(BulkTesting.objects.order_by('pk').values_list('slug', flat=True))
+        self.assertEqual(slugs[0], 'lord-of-w')
+        self.assertEqual(len(set(slugs)), 2)
+
+    def test_atomic_update(self):
+        BulkTesting.objects.bulk_create([BulkTesting(title='Title %s' % n) for n in range(3)])
+        bulk_update = SmartfieldsQuerySet.bulk_update
+        calls = []
+        def bulk_update_spy(queryset, *args, **kwargs):
+            calls.append(args)
+            if len(calls) > 1:
+                raise ValueError("Failed chunk")
+            return bulk_update(queryset, *args, **kwargs)
+        with mock.patch.object(SmartfieldsQuerySet, 'update_chunk_size', 2), \
+             mock.patch.object(SmartfieldsQuerySet, 'bulk_update', bulk_update_spy):
+            self.assertRaises(ValueError, BulkTesting.objects.update, title='Snatch')
+        # first chunk is rolled back together with the failed one
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(sorted(BulkTesting.objects.values_list('title', flat=True)),
+                         ['Title 0', 'Title 1', 'Title 2'])
@@ -0,0 +1,103 @@
+import shutil, tempfile, threading, time
+from django.core.files.base import File
+from django.test import TestCase
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from smartfields import resources
+from smartfields.resources import ResourceLimiter
+
+from test_app.models import DependencyTesting
+from test_suite.test_files import FileBaseTestCase, add_base
+
+
+class ResourceLimiterTestCase(TestCase):
+
+    def setUp(self):
+        self.lock_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.lock_dir)
+
+    def test_slots(self):
+        limiter = ResourceLimiter('ffmpeg', 2, lock_dir=self.lock_dir)
+        # another limiter with the same lock directory stands in for another process
+        other = ResourceLimiter('ffmpeg', 2, lock_dir=self.lock_dir)
+        waits = []
+        slot_1 = limiter.acquire(on_wait=lambda: waits.append(1))
+        slot_2 = other.acquire(on_wait=lambda: waits.append(2))
+        self.assertEqual(waits, [])
+        acquired = []
+        def worker():
+            with limiter.slot(on_wait=lambda: waits.append(3)):
+                acquired.append(True)
+        thread = threading.Thread(target=worker)
+        thread.start()
+        time.sleep(0.2)
+        self.assertEqual((waits, acquired), ([3], []))
+        other.release(slot_2)
+        thread.join(5)
+        self.assertEqual(acquired, [True])
+        limiter.release(slot_1)
+        # other resources are limited separately
+        with ResourceLimiter('image', 1, lock_dir=self.lock_dir).slot():
+            pass
+
+    def test_semaphore_fallback(self):
+        with mock.patch.object(resources, 'fcntl', None):
+            limiter = ResourceLimiter('image', 1, lock_dir=self.lock_dir)
+        waits = []
+        slot = limiter.acquire()
+        def worker():
+            with limiter.slot(on_wait=lambda: waits.append(True)):
+                pass
+        thread = threading.Thread(target=worker)
+        thread.start()
+        time.sleep(0.2)
+        self.assertEqual(waits, [True])
+        limiter.release(slot)
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
+
+    def test_get_resource_limiter(self):
+        self.assertIsNone(resources.get_resource_limiter('ffmpeg'))
+        with mock.patch.object(resources, 'RESOURCE_LIMITS', {'ffmpeg': 3}), \
+             mock.patch.dict(resources._limiters, clear=True):
+            limiter = resources.get_resource_limiter('ffmpeg')
+            self.assertEqual(limiter.limit, 3)
+            self.assertIs(resources.get_resource_limiter('ffmpeg'), limiter)
+            self.assertIsNone(resources.get_resource_limiter(None))
+
+
+class ResourceLimitedProcessingTestCase(FileBaseTestCase):
+
+    def test_queued_status(self):
+        lock_dir = tempfile.mkdtemp()
+        limiter = ResourceLimiter('image', 1, lock_dir=lock_dir)
+        instance = DependencyTesting()
+        manager = instance._smartfields_managers['image_2']
+        dependency = manager.dependencies[0]
+        lenna_rect = File(open(add_base("media/static/images/lenna_rect.jpg"), 'rb'),
+                          name="lenna_rect.jpg")
+        statuses = []
+        set_status = manager.set_status
+        def status_spy(instance, status):
+            statuses.append(status['state'])
+            set_status(instance, status)
+        with mock.patch('smartfields.dependencies.get_resource_limiter',
+                        return_value=limiter), \
+             mock.patch.object(manager, 'set_status', side_effect=status_spy):
+            slot = limiter.acquire()
+            thread = threading.Thread(
+                target=dependency.process, args=(instance, lenna_rect))
+            thread.start()
+            time.sleep(0.2)
+            self.assertEqual(manager.get_status(instance)['state'], 'queued')
+            limiter.release(slot)
+            thread.join(5)
+        lenna_rect.close()
+        shutil.rmtree(lock_dir)
+        self.assertEqual(statuses, ['queued', 'busy'])
+        self.assertEqual(instance.image_3.width, 100)
@@ -1,10 +1,19 @@
 import re
+from django.db import connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.db.utils import IntegrityError
+try:
+    from unittest import mock
+except ImportError:
+    import mock
 
+from smartfields import fields, processors
+from smartfields.dependencies import Dependency
 from smartfields.models import SmartfieldsModelMixin
+from smartfields.processors.text import HTMLStreamer
 
-from test_app.models import TextTesting
+from test_app.models import TextTesting, OptimisticTesting, BulkTesting
 from test_suite.test_files import add_base
 
 
@@ -70,6 +79,53 @@ class TextTestCase(TestCase):
         self.assertEqual(len(instance.summary_beginning), 100)
         self.assertEqual(instance.summary_beginning, instance.summary_plain[:100])
 
+    def test_html_stream(self):
+        soup_processor = processors.HTMLProcessor(engine='soup')
+        stream_processor = processors.HTMLProcessor(engine='stream')
+        for name in ['snatch', 'lord_of_war']:
+            descr = open(add_base("static/defaults/%s.html" % name), 'r')
+            value = descr.read()
+            descr.close()
+            # parsers differ in whitespace only
+            self.assertEqual(re.sub(r'\s+', ' ', stream_processor.process(value)),
+                             re.sub(r'\s+', ' ', soup_processor.process(value)))
+        value = '<p>a &amp; b<br/>c<!-- comment --><b class="x">bold<i>it</b> ' \
+                'tail<script>if (a<b) x();</script>&nbsp;'
+        self.assertEqual(stream_processor.process(value),
+                         'a &amp; bcboldit tailif (a<b) x();\xa0')
+        class KeepProcessor(processors.HTMLProcessor):
+            def process_tag(self, tag):
+                if tag.name == 'script':
+                    tag.extract()
+                else:
+                    tag.hidden = tag.name not in ('b', 'i', 'br')
+        for engine in ['soup', 'stream']:
+            self.assertEqual(KeepProcessor(engine=engine).process(value),
+                             'a &amp; b<br/>c<b class="x">bold<i>it</i></b> tail\xa0')
+        # python<3.4 parser doesn't convert character references on its own
+        streamer = HTMLStreamer(lambda tag: None)
+        streamer.convert_charrefs = False
+        self.assertEqual(
+            streamer.render('<p title="&quot;">&lt;&amp;&#62;&#x3c;&nbsp;&foo;</p>'),
+            '<p title="&quot;">&lt;&amp;&gt;&lt;\xa0&amp;foo;</p>')
+
+    def test_html_stream_limit(self):
+        tags = []
+        class TagProcessor(processors.HTMLProcessor):
+            def process_tag(self, tag):
+                tags.append(tag.name)
+                super(TagProcessor, self).process_tag(tag)
+        processor = TagProcessor(engine='stream')
+        value = "<p>%s</p>" % "</p><p>".join(["paragraph %s" % n for n in range(1000)])
+        dependee = TextTesting._meta.get_field('summary_beginning')
+        self.assertEqual(processor.process(value, dependee=dependee),
+                         "".join(["paragraph %s" % n for n in range(1000)])[:100])
+        # parsing stopped once there was enough text
+        self.assertLess(len(tags), 20)
+        self.assertEqual(processor.process(value, dependee=dependee, padding=10),
+                         "".join(["paragraph %s" % n for n in range(1000)])[:90])
+        self.assertRaises(AssertionError, processors.HTMLProcessor, engine='foo')
+
     def test_slug(self):
         # make sure slug is in lower case and cropped
         instance = TextTesting.objects.get(title='Snatch')
@@ -91,6 +147,49 @@ class TextTestCase(TestCase):
         # make sure infinite loop is impossible
         self.assertRaises(IntegrityError, TextTesting.objects.create, title='Lord of War')
 
+    def test_unique_single_query(self):
+        field = TextTesting._meta.get_field('slug')
+        p = processors.SlugProcessor(strategy='counter')
+        for _ in range(3):
+            instance = TextTesting(title='Snatch')
+            with self.assertNumQueries(1):
+                instance.slug = p(instance.title, instance=instance, field=field,
+                                  dependee=field)
+            instance.save()
+        self.assertEqual(list(TextTesting.objects.filter(
+            slug__startswith='snatch').order_by('slug').values_list('slug', flat=True)),
+                         ['snatch', 'snatch-2', 'snatch-3', 'snatch-4'])
+        # instance doesn't collide with itself
+        with self.assertNumQueries(1):
+            self.assertEqual(p('SNATCH-4', instance=instance, field=field,
+                               dependee=field), 'snatch-4')
+        self.assertEqual(p('Snatch', instance=instance, field=field,
+                           dependee=field), 'snatch-4')
+        self.assertRaises(AssertionError, processors.UniqueProcessor, strategy='foo')
+
+    def test_unique_number(self):
+        p = processors.SlugProcessor()
+        # padding includes the separator, so 2 leaves room for a single digit
+        taken = set(['foo'] + ['foo-%s' % n for n in range(10) if n != 5])
+        for _ in range(10):
+            self.assertEqual(p.get_number('foo', taken, 2, 'random'), 5)
+            self.assertIn(p.get_number('foo', taken, 3, 'random'), range(5, 100))
+        self.assertEqual(p.get_number('foo', taken, 2, 'counter'), 5)
+        taken.add('foo-5')
+        self.assertIsNone(p.get_number('foo', taken, 2, 'random'))
+        self.assertIsNone(p.get_number('foo', taken, 2, 'counter'))
+        self.assertEqual(p.get_number('foo', taken, 3, 'counter'), 10)
+        self.assertEqual(p.get_number('FOO', taken, 3, 'counter', iexact=True), 10)
+        # numbers are picked at random, when there are too many of them to enumerate
+        self.assertIn(p.get_number('foo', taken, None, 'random'), range(10, 10**10))
+
+    def test_unique_dependee(self):
+        # `slug` is set by a dependency of `title`, it is the one checked for collisions
+        BulkTesting.objects.create(title='Other')
+        BulkTesting.objects.filter(title='Other').update(slug='snatch')
+        instance = BulkTesting.objects.create(title='Snatch')
+        self.assertRegexpMatches(instance.slug, re.compile(r'^snatch-\d$'))
+
     def test_stashed_value(self):
         instance = TextTesting.objects.create(loopback='foo')
         self.assertEqual(instance.loopback_foo, '')
@@ -112,3 +211,115 @@ class TextTestCase(TestCase):
         instance.save()
         self.assertEqual(instance.html_plain, "FOO")
         
+
+    def test_update_fields(self):
+        instance = TextTesting.objects.get(title='Snatch')
+        instance.title = 'Changed'
+        instance.summary = '<b>short</b> summary'
+        title_manager = TextTesting._meta.get_field('title').manager
+        with mock.patch.object(title_manager, 'handle') as handle:
+            instance.save(update_fields=['summary'])
+            self.assertFalse(handle.called)
+        instance = TextTesting.objects.get(pk=instance.pk)
+        self.assertEqual(instance.title, 'Snatch')
+        # values set by dependencies of dependencies were saved as well
+        self.assertEqual(instance.summary_plain, 'short summary')
+        self.assertEqual(instance.summary_beginning, 'short summary')
+        # value that hasn't changed doesn't drag its dependees along
+        with CaptureQueriesContext(connection) as queries:
+            instance.save(update_fields=['summary'])
+        updates = [q['sql'] for q in queries if q['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertIn('"summary" =', updates[0])
+        self.assertNotIn('"summary_plain" =', updates[0])
+        with mock.patch.object(title_manager, 'handle') as handle:
+            instance.save(update_fields=['title'])
+            self.assertTrue(handle.called)
+        instance = TextTesting.objects.only('summary').get(pk=instance.pk)
+        instance.summary = '<i>deferred</i>'
+        instance.save(update_fields=['summary'])
+        self.assertEqual(TextTesting.objects.values_list(
+            'summary_plain', 'summary_beginning').get(pk=instance.pk),
+                         ('deferred', 'deferred'))
+
+    def test_deferred_fields(self):
+        with self.assertNumQueries(1):
+            instances = list(TextTesting.objects.only('title').order_by('pk'))
+            self.assertEqual([i.title for i in instances], ['Snatch', 'Lord of War'])
+        instance = instances[0]
+        self.assertEqual(instance.get_deferred_fields(), set([
+            'slug', 'summary', 'summary_plain', 'summary_beginning', 'loopback',
+            'loopback_foo', 'html', 'html_plain']))
+        # saving doesn't touch deferred fields
+        with self.assertNumQueries(1):
+            instance.save()
+        # deferred field is loaded without being processed
+        with self.assertNumQueries(1):
+            self.assertEqual(instance.slug, 'snatch')
+            self.assertEqual(instance.slug, 'snatch')
+        descr_plain = open(add_base("static/defaults/snatch.txt"), 'r')
+        self.assertEqual(self.strip(instance.summary_plain), self.strip(descr_plain.read()))
+        descr_plain.close()
+        instance.html = "<h1>foo</h1>"
+        instance.save()
+        self.assertEqual(TextTesting.objects.get(pk=instance.pk).html_plain, "FOO")
+
+    def test_stash_per_instance(self):
+        manager = TextTesting._smartfields_managers['html']
+        instance_1 = TextTesting.objects.get(title='Snatch')
+        instance_2 = TextTesting.objects.get(title='Lord of War')
+        instance_1.html = "<h1>foo</h1>"
+        self.assertTrue(manager.has_stashed_value(instance_1))
+        self.assertFalse(manager.has_stashed_value(instance_2))
+        # saving another instance neither processes nor discards the stash
+        instance_2.save()
+        self.assertEqual(instance_2.html_plain, "")
+        self.assertTrue(manager.has_stashed_value(instance_1))
+        instance_1.save()
+        self.assertFalse(manager.has_stashed_value(instance_1))
+        self.assertEqual(instance_1.html_plain, "FOO")
+
+
+class OptimisticUniqueTestCase(TestCase):
+
+    def get_selects(self, queries):
+        return [q['sql'] for q in queries if q['sql'].startswith('SELECT')]
+
+    def test_optimistic_unique(self):
+        with CaptureQueriesContext(connection) as queries:
+            instance = OptimisticTesting.objects.create(title='Snatch')
+        self.assertEqual(instance.slug, 'snatch')
+        self.assertEqual(self.get_selects(queries), [])
+        with CaptureQueriesContext(connection) as queries:
+            instance = OptimisticTesting.objects.create(title='Snatch')
+        self.assertRegexpMatches(instance.slug, re.compile(r'^snatch-\d$'))
+        self.assertEqual(len(self.get_selects(queries)), 1)
+        # whole transaction is not affected by a collision
+        with transaction.atomic():
+            OptimisticTesting.objects.create(title='Lord of War')
+            instance = OptimisticTesting.objects.create(title='Lord of War')
+        self.assertRegexpMatches(instance.slug, re.compile(r'^lord-of-\d$'))
+        self.assertEqual(OptimisticTesting.objects.count(), 4)
+        # updating doesn't collide with itself
+        instance.title = 'Lord of War'
+        instance.save()
+        self.assertEqual(OptimisticTesting.objects.get(pk=instance.pk).slug, instance.slug)
+
+    def test_unresolved_conflict(self):
+        OptimisticTesting.objects.create(title='Snatch')
+        # collision that can't be resolved by regenerating a value is reraised
+        with mock.patch('smartfields.processors.SlugProcessor.get_taken',
+                        return_value=set()):
+            self.assertRaises(IntegrityError, OptimisticTesting.objects.create,
+                              title='Snatch')
+        manager = OptimisticTesting._meta.get_field('slug').manager
+        with mock.patch.object(manager, 'resolve_conflict', return_value=True) as resolve, \
+             mock.patch('smartfields.models.UNIQUE_MAX_RETRIES', 3):
+            self.assertRaises(IntegrityError, OptimisticTesting.objects.create,
+                              title='Snatch')
+        self.assertEqual(resolve.call_count, 3)
+
+    def test_optimistic_pre_processor(self):
+        field = fields.SlugField(name='slug', dependencies=[
+            Dependency(pre_processor=processors.SlugProcessor(optimistic=True))])
+        self.assertRaises(AssertionError, field.manager.compile)